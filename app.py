@@ -7,16 +7,29 @@ import altair as alt
 import pandas as pd
 import streamlit as st
 
-from data.database import init_db
-from data.repositories import HabitRepository, SettingsRepository, UserRepository
+from data.database import ShardRouter
+from data.instrumentation import RECORDER
+from data.models import STATUS_CODES, HabitLog, day_from_number, from_epoch_seconds
+from data.purge import HabitPurger
+from data.repositories import HabitRepository, SettingsCache, SettingsRepository, UserRepository
 from data.seed import TEMPLATES
-from domain.logic import BestHourCalculator, StreakCalculator, XpCalculator, WildcardRule
+from data.write_behind import IMMEDIATE, LogWriteQueue
+from domain.logic import WEEKDAYS, XpCalculator
 from services.auth import AuthService, DEMO_EMAIL, DEMO_PASSWORD
 from services.ics_export import generate_ics
 from services.smart_reminders import SmartReminderService
 from services.theming import apply_theme, theme_options
 
-DB_CONN = init_db()
+# Users spread over DB_SHARDS database files; users from before sharding stay on shard 0.
+DB_SHARDS = 4
+# "immediate" commits each log_action; "batched" or "journaled" opt into the write-behind queue.
+LOG_DURABILITY = IMMEDIATE
+SETTINGS_CACHE = SettingsCache()
+# Days of history the Today screen reads for the 14-day reminder window.
+TODAY_WINDOW_DAYS = 14
+# Show the queries each rerun issued in the sidebar, and where to log slow ones.
+QUERY_REPORT = False
+SLOW_QUERY_LOG = None
 
 
 def load_translations(lang: str):
@@ -47,7 +60,36 @@ def render_header():
     st.caption("Hoy cuenta. Cada mini win suma.")
 
 
+@st.cache_resource(show_spinner=False)
+def db_router():
+    return ShardRouter(shard_count=DB_SHARDS, strategy="directory", size=8, read_size=8)
+
+
+@st.cache_resource(show_spinner=False)
+def habit_purgers():
+    return [HabitPurger(shard).start() for shard in db_router().shards]
+
+
+@st.cache_resource(show_spinner=False)
+def log_write_queue():
+    if LOG_DURABILITY == IMMEDIATE:
+        return None
+    return LogWriteQueue(db_router(), durability=LOG_DURABILITY).start()
+
+
+@st.cache_data(max_entries=512, show_spinner=False)
+def cached_habits(user_id, habits_version, _habit_repo: HabitRepository):
+    return _habit_repo.list_habits(user_id)
+
+
+def load_habits(habit_repo: HabitRepository, user_id):
+    # The data version changes on every habit write, so stale lists are never reused.
+    return cached_habits(user_id, habit_repo.habits_version(user_id), habit_repo)
+
+
 def parse_log_timestamp(log):
+    if log.get("created_ts") is not None:
+        return from_epoch_seconds(log["created_ts"])
     raw_value = log.get("created_at") or log.get("timestamp")
     if not raw_value:
         return None
@@ -57,6 +99,16 @@ def parse_log_timestamp(log):
         return None
 
 
+def parse_logs(logs):
+    parsed_logs = []
+    for log in logs:
+        log_timestamp = parse_log_timestamp(log)
+        if not log_timestamp or log.get("status") not in STATUS_CODES:
+            continue
+        parsed_logs.append(HabitLog.from_log(log, log_timestamp))
+    return parsed_logs
+
+
 def _valid_email(email: str) -> bool:
     return re.match(r"^[^\s@]+@[^\s@]+\.[^\s@]+$", email or "") is not None
 
@@ -151,26 +203,29 @@ def onboarding_screen(habit_repo: HabitRepository, settings_repo: SettingsReposi
             if not (3 <= len(selected) <= 5):
                 st.error("Selecciona entre 3 y 5 hábitos para continuar.")
                 return
-            for habit in template_habits:
-                if habit["name"] in selected:
-                    habit_repo.add_habit(st.session_state.user_id, habit)
+            new_habits = [habit for habit in template_habits if habit["name"] in selected]
         else:
             habits = [line.strip() for line in raw_habits.splitlines() if line.strip()]
             if not (3 <= len(habits) <= 5):
                 st.error("Ingresa entre 3 y 5 hábitos para continuar.")
                 return
-            for habit_name in habits:
-                habit_repo.add_habit(
-                    st.session_state.user_id,
-                    {
-                        "name": habit_name,
-                        "emoji": "✨",
-                        "frequency": "daily",
-                        "category": "Personal",
-                    },
-                )
-
-        settings_repo.set(st.session_state.user_id, "onboarded", "1")
+            new_habits = [
+                {
+                    "name": habit_name,
+                    "emoji": "✨",
+                    "frequency": "daily",
+                    "category": "Personal",
+                }
+                for habit_name in habits
+            ]
+
+        # The settings transaction is the outer one, so a failed commit also drops the cached
+        # "onboarded" value; the habit transaction forgets habit lists read inside the block.
+        with settings_repo.transaction(user_id=st.session_state.user_id):
+            with habit_repo.transaction(user_id=st.session_state.user_id):
+                for habit in new_habits:
+                    habit_repo.add_habit(st.session_state.user_id, habit)
+                settings_repo.set(st.session_state.user_id, "onboarded", "1")
         st.session_state.onboarded = True
         st.experimental_rerun()
 
@@ -178,13 +233,16 @@ def onboarding_screen(habit_repo: HabitRepository, settings_repo: SettingsReposi
 def today_screen(habit_repo: HabitRepository, settings_repo: SettingsRepository):
     st.markdown("## Hoy")
     st.caption("Marca tus mini wins y suma racha.")
-    habits = habit_repo.list_today_habits(st.session_state.user_id)
+    habits = load_habits(habit_repo, st.session_state.user_id)
 
     if not habits:
         st.info("Aún no tienes hábitos. Ve a Hábitos para crear uno nuevo.")
         return
 
-    for habit in habits:
+    due_habits = habit_repo.list_today_habits(st.session_state.user_id)
+    if not due_habits:
+        st.info("Hoy no tienes hábitos programados.")
+    for habit in due_habits:
         with st.container(border=True):
             st.markdown(f"### {habit.get('emoji') or '✨'} {habit['name']}")
             st.caption(habit.get("category") or "General")
@@ -194,25 +252,26 @@ def today_screen(habit_repo: HabitRepository, settings_repo: SettingsRepository)
             if col2.button("Saltar", key=f"skip_{habit['id']}"):
                 habit_repo.log_action(habit["id"], "skipped", user_id=st.session_state.user_id)
 
-    logs = habit_repo.list_all_logs(st.session_state.user_id)
-    parsed_logs = []
-    for log in logs:
-        log_timestamp = parse_log_timestamp(log)
-        if not log_timestamp:
-            continue
-        parsed_logs.append({"timestamp": log_timestamp, "status": log["status"]})
-    streak = StreakCalculator().calculate(parsed_logs)
+    streak = habit_repo.get_streak(st.session_state.user_id)["current"]
     xp_result = XpCalculator().calculate(total_xp=0, streak=streak)
-    wildcard = WildcardRule().has_wildcard(parsed_logs)
+    wildcard = habit_repo.has_wildcard(st.session_state.user_id)
 
     st.info(f"Racha: {streak} | XP ganado hoy: {xp_result['earned']}")
     if wildcard:
         st.info("Tienes un wildcard disponible esta semana.")
 
+    logs = habit_repo.iter_log_records(
+        st.session_state.user_id,
+        since=datetime.utcnow().date() - timedelta(days=TODAY_WINDOW_DAYS - 1),
+    )
     reminder_service = SmartReminderService()
-    dnd_start = int(settings_repo.get(st.session_state.user_id, "dnd_start", "22"))
-    dnd_end = int(settings_repo.get(st.session_state.user_id, "dnd_end", "7"))
-    recommendation = reminder_service.build_recommendation(logs, dnd_start, dnd_end)
+    dnd = settings_repo.get_many(st.session_state.user_id, {"dnd_start": "22", "dnd_end": "7"})
+    recommendation = reminder_service.build_recommendation(
+        logs,
+        int(dnd["dnd_start"]),
+        int(dnd["dnd_end"]),
+        histogram=habit_repo.minute_histogram(st.session_state.user_id),
+    )
     if recommendation["suggested"]:
         hour, minute = recommendation["suggested"]
         st.info(f"Mejor hora sugerida: {hour:02d}:{minute:02d}")
@@ -229,7 +288,7 @@ def today_screen(habit_repo: HabitRepository, settings_repo: SettingsRepository)
 def habits_screen(habit_repo: HabitRepository):
     st.markdown("## Hábitos")
 
-    habits = habit_repo.list_habits(st.session_state.user_id)
+    habits = load_habits(habit_repo, st.session_state.user_id)
     if habits:
         for habit in habits:
             with st.container(border=True):
@@ -237,6 +296,8 @@ def habits_screen(habit_repo: HabitRepository):
                 st.caption(habit.get("category") or "General")
                 if st.button("Eliminar", key=f"delete_{habit['id']}"):
                     habit_repo.delete_habit(habit["id"], user_id=st.session_state.user_id)
+                    for purger in habit_purgers():
+                        purger.wake()
                     st.experimental_rerun()
 
     st.markdown("### Nuevo hábito")
@@ -244,12 +305,18 @@ def habits_screen(habit_repo: HabitRepository):
     category = st.selectbox("Categoría", ["Salud", "Trabajo", "Estudio", "Bienestar", "Personal"])
     emoji = st.text_input("Emoji", value="✨")
     frequency = st.selectbox("Frecuencia", ["daily", "weekly"])
+    days = []
+    if frequency == "weekly":
+        days = st.multiselect("Días", list(WEEKDAYS), default=["MON", "WED", "FRI"])
     suggested_time = st.text_input("Hora sugerida (HH:MM)", value="19:30")
 
     if st.button("Guardar"):
         if not name:
             st.error("Ingresa un nombre para el hábito.")
             return
+        if frequency == "weekly" and not days:
+            st.error("Elige al menos un día para un hábito semanal.")
+            return
         habit_repo.add_habit(
             st.session_state.user_id,
             {
@@ -257,6 +324,7 @@ def habits_screen(habit_repo: HabitRepository):
                 "category": category,
                 "emoji": emoji,
                 "frequency": frequency,
+                "days": ",".join(days) or None,
                 "suggested_time": suggested_time or None,
             },
         )
@@ -266,67 +334,55 @@ def habits_screen(habit_repo: HabitRepository):
 def stats_screen(habit_repo: HabitRepository):
     st.markdown("## Estadísticas")
 
-    thirty_days_ago = (datetime.utcnow() - timedelta(days=30)).date().isoformat()
-    logs = habit_repo.list_logs_since(st.session_state.user_id, thirty_days_ago)
+    thirty_days_ago = (datetime.utcnow() - timedelta(days=30)).date()
+    stats = habit_repo.list_daily_stats(st.session_state.user_id, thirty_days_ago)
 
-    if not logs:
+    if not stats:
         st.info("Aún no hay registros. Completa un hábito para ver tu progreso.")
         return
 
-    rows = []
-    for log in logs:
-        log_timestamp = parse_log_timestamp(log)
-        if not log_timestamp:
-            continue
-        date_value = log.get("date") or log_timestamp.date().isoformat()
-        rows.append(
-            {
-                "date": datetime.fromisoformat(date_value).date(),
-                "status": log["status"],
-                "habit_id": log["habit_id"],
-                "timestamp": log_timestamp,
-            }
-        )
-
-    df = pd.DataFrame(rows)
-    habits = habit_repo.list_habits(st.session_state.user_id)
+    df = pd.DataFrame(stats)
+    df["date"] = df["day"].map(day_from_number)
+    habits = load_habits(habit_repo, st.session_state.user_id)
     habit_map = {habit["id"]: habit["name"] for habit in habits}
     df["habit_name"] = df["habit_id"].map(habit_map).fillna("Hábito")
-    completed = df[df["status"] == "completed"]
+    completed = df[df["completed"] > 0]
 
     st.subheader("Completados por día (últimos 30 días)")
-    daily_counts = completed.groupby("date").size().reset_index(name="count")
+    daily_counts = completed.groupby("date")["completed"].sum().reset_index(name="count")
     bar = alt.Chart(daily_counts).mark_bar(color="#8839ef").encode(x="date:T", y="count:Q")
     st.altair_chart(bar, use_container_width=True)
 
     st.subheader("Tasa de completado por hábito")
-    habit_counts = completed.groupby("habit_name").size().reset_index(name="count")
+    habit_counts = completed.groupby("habit_name")["completed"].sum().reset_index(name="count")
     bar2 = alt.Chart(habit_counts).mark_bar(color="#04a5e5").encode(x="habit_name:N", y="count:Q")
     st.altair_chart(bar2, use_container_width=True)
 
     st.subheader("Racha actual por hábito")
-    streaks = []
-    for habit_id, group in df.groupby("habit_id"):
-        logs_for_habit = [
-            {"timestamp": row["timestamp"], "status": row["status"]}
-            for row in group.to_dict("records")
-        ]
-        streak_value = StreakCalculator().calculate(logs_for_habit)
-        streaks.append({"habit_name": habit_map.get(habit_id, str(habit_id)), "streak": streak_value})
+    habit_streaks = habit_repo.list_habit_streaks(st.session_state.user_id)
+    streaks = [
+        {
+            "habit_name": habit_map.get(habit_id, str(habit_id)),
+            "streak": habit_streaks[habit_id]["current"] if habit_id in habit_streaks else 0,
+        }
+        for habit_id in df["habit_id"].unique()
+    ]
 
     streaks_df = pd.DataFrame(streaks).sort_values("streak", ascending=False)
     st.dataframe(streaks_df, use_container_width=True)
 
-    best_hour = BestHourCalculator().best_hour(
-        [{"timestamp": row["timestamp"], "status": row["status"]} for row in rows]
-    )
+    best_hour = habit_repo.minute_histogram(st.session_state.user_id).best_hour()
     if best_hour:
         st.info(f"Mejor hora: {best_hour[0]:02d}:{best_hour[1]:02d}")
 
 
 def settings_screen(settings_repo: SettingsRepository):
     st.markdown("## Ajustes")
-    current_language = settings_repo.get(st.session_state.user_id, "language", "es_419")
+    current = settings_repo.get_many(
+        st.session_state.user_id,
+        {"language": "es_419", "dnd_start": "22", "dnd_end": "7"},
+    )
+    current_language = current["language"]
     language = st.selectbox(
         "Idioma",
         ["es_419", "en"],
@@ -336,44 +392,66 @@ def settings_screen(settings_repo: SettingsRepository):
         "No molestar desde",
         min_value=0,
         max_value=23,
-        value=int(settings_repo.get(st.session_state.user_id, "dnd_start", "22")),
+        value=int(current["dnd_start"]),
     )
     dnd_end = st.number_input(
         "No molestar hasta",
         min_value=0,
         max_value=23,
-        value=int(settings_repo.get(st.session_state.user_id, "dnd_end", "7")),
+        value=int(current["dnd_end"]),
     )
 
     st.caption("El tema se cambia desde el selector del sidebar.")
 
     if st.button("Guardar ajustes"):
-        settings_repo.set(st.session_state.user_id, "language", language)
-        settings_repo.set(st.session_state.user_id, "dnd_start", str(dnd_start))
-        settings_repo.set(st.session_state.user_id, "dnd_end", str(dnd_end))
+        settings_repo.set_many(
+            st.session_state.user_id,
+            {"language": language, "dnd_start": str(dnd_start), "dnd_end": str(dnd_end)},
+        )
         st.session_state.language = language
         st.session_state.translations = load_translations(language)
         st.experimental_rerun()
 
 
+def render_query_report(report):
+    with st.sidebar.expander(f"Consultas: {report.calls} · {report.total_ms:.1f} ms"):
+        st.dataframe(pd.DataFrame(report.rows()), hide_index=True)
+        if RECORDER.slow_queries:
+            st.caption("Consultas lentas")
+            st.code(
+                "\n".join(
+                    f"{entry.elapsed_ms:.1f} ms  {entry.fingerprint}" for entry in RECORDER.slow_queries
+                )
+            )
+
+
 def main():
     st.set_page_config(page_title="MiniWins", layout="wide")
     ensure_session()
-
-    user_repo = UserRepository(DB_CONN)
+    RECORDER.slow_log_path = SLOW_QUERY_LOG
+    with RECORDER.capture() as report:
+        render_app()
+    if QUERY_REPORT:
+        render_query_report(report)
+
+
+def render_app():
+    router = db_router()
+    # Cached, so the purgers start once per process and keep draining habit_purges.
+    habit_purgers()
+    user_repo = UserRepository(router)
     auth_service = AuthService(user_repo)
-    habit_repo = HabitRepository(DB_CONN)
-    settings_repo = SettingsRepository(DB_CONN)
+    habit_repo = HabitRepository(router, log_queue=log_write_queue())
+    settings_repo = SettingsRepository(router, cache=SETTINGS_CACHE)
 
-    theme = settings_repo.get(st.session_state.user_id, "theme", st.session_state.theme)
-    st.session_state.theme = theme
+    user_settings = settings_repo.get_many(
+        st.session_state.user_id,
+        {"theme": st.session_state.theme, "language": "es_419", "onboarded": "0"},
+    )
+    st.session_state.theme = user_settings["theme"]
     apply_theme(st.session_state.theme)
 
-    language = (
-        settings_repo.get(st.session_state.user_id, "language", "es_419")
-        if st.session_state.user_id
-        else "es_419"
-    )
+    language = user_settings["language"] if st.session_state.user_id else "es_419"
     st.session_state.language = language
     st.session_state.translations = load_translations(language)
 
@@ -382,7 +460,7 @@ def main():
         return
 
     if st.session_state.user_id and not st.session_state.get("onboarded"):
-        st.session_state.onboarded = settings_repo.get(st.session_state.user_id, "onboarded", "0") == "1"
+        st.session_state.onboarded = user_settings["onboarded"] == "1"
 
     st.sidebar.title("MiniWins")
     st.sidebar.caption(st.session_state.email or "")
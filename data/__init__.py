@@ -1,13 +1,32 @@
 """Data layer package for MiniWins."""
+from data.async_repositories import (
+    AsyncHabitRepository,
+    AsyncSettingsRepository,
+    AsyncUserRepository,
+    DatabaseExecutor,
+)
 from data.database import Database, get_connection, init_db
-from data.repositories import AuthRepository, HabitRepository, SettingsRepository, UserRepository
+from data.repositories import (
+    AuthRepository,
+    HabitListCache,
+    HabitRepository,
+    SettingsCache,
+    SettingsRepository,
+    UserRepository,
+)
 
 __all__ = [
+    "AsyncHabitRepository",
+    "AsyncSettingsRepository",
+    "AsyncUserRepository",
+    "DatabaseExecutor",
     "Database",
     "get_connection",
     "init_db",
     "AuthRepository",
+    "HabitListCache",
     "HabitRepository",
+    "SettingsCache",
     "SettingsRepository",
     "UserRepository",
 ]
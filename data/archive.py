@@ -0,0 +1,302 @@
+from __future__ import annotations
+
+import json
+import sqlite3
+from collections import defaultdict
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from data.database import DB_PATH, transaction
+from data.instrumentation import run_many, run_query
+from data.models import epoch_seconds, from_epoch_seconds
+
+ARCHIVE_DIR = DB_PATH.parent / "archive"
+RETENTION_DAYS = 365
+ARCHIVE_BATCH_SIZE = 5000
+# SQLite refuses more than ten attached databases per connection by default.
+MAX_ATTACHED_ARCHIVES = 8
+# Temp table holding rows of archives that could not be attached; see attach_archives().
+OVERFLOW_TABLE = "overflow_habit_logs"
+
+UPDATE_CATALOG_QUERY = """
+    UPDATE log_archives SET
+        row_count = row_count + ?,
+        min_ts = MIN(COALESCE(min_ts, ?), ?),
+        max_ts = MAX(COALESCE(max_ts, ?), ?)
+    WHERE year = ?
+"""
+
+
+def archive_schema(year: int) -> str:
+    return f"archive_{int(year)}"
+
+
+def archived_years(
+    connection: sqlite3.Connection,
+    since_ts: int | None = None,
+    until_ts: int | None = None,
+) -> list[tuple[int, str]]:
+    """Return (year, path) for archives holding rows in [since_ts, until_ts), newest first."""
+    rows = run_query(
+        connection,
+        """
+        SELECT year, path FROM log_archives
+        WHERE row_count > 0
+          AND (? IS NULL OR max_ts >= ?)
+          AND (? IS NULL OR min_ts < ?)
+        ORDER BY year DESC
+        """,
+        [since_ts, since_ts, until_ts, until_ts],
+        fetch="all",
+    )
+    return [(row[0], row[1]) for row in rows]
+
+
+def attach_archives(
+    connection: sqlite3.Connection,
+    since_ts: int | None = None,
+    until_ts: int | None = None,
+    user_id: int | None = None,
+) -> list[str]:
+    """Make the archives a time range reaches into readable and return their log tables.
+
+    Up to MAX_ATTACHED_ARCHIVES years are attached. Years past that limit, or
+    that cannot be attached because a transaction is open, are copied into a
+    temp table (only ``user_id``'s rows in the range, when given), listed last.
+    The temp table is refilled on every call, so read it before the next one.
+    """
+    archives = archived_years(connection, since_ts, until_ts)
+    if not connection.in_transaction:
+        _attach_group(connection, archives[:MAX_ATTACHED_ARCHIVES])
+    attached = _attached_schemas(connection)
+    tables = [
+        f"{archive_schema(year)}.habit_logs" for year, _ in archives if archive_schema(year) in attached
+    ]
+    overflow = [(year, path) for year, path in archives if archive_schema(year) not in attached]
+    if overflow:
+        tables.append(_copy_overflow(connection, overflow, since_ts, until_ts, user_id))
+    return tables
+
+
+def archive_groups(
+    connection: sqlite3.Connection,
+    since_ts: int | None = None,
+    until_ts: int | None = None,
+):
+    """Attach the archives of a time range a group at a time, yielding each group's schema names.
+
+    Each group replaces the previous one, so finish with it before asking for
+    the next. Needs a connection without an open transaction.
+    """
+    archives = archived_years(connection, since_ts, until_ts)
+    for start in range(0, len(archives), MAX_ATTACHED_ARCHIVES):
+        group = archives[start : start + MAX_ATTACHED_ARCHIVES]
+        _attach_group(connection, group)
+        yield [archive_schema(year) for year, _ in group]
+
+
+def log_source(connection: sqlite3.Connection, tables: list[str]) -> str:
+    """FROM-clause expression covering the hot habit_logs table plus the given archive tables."""
+    if not tables:
+        return "habit_logs"
+    columns = ", ".join(_columns(connection, "main"))
+    selects = [f"SELECT {columns} FROM {table}" for table in ("main.habit_logs", *tables)]
+    return f"({' UNION ALL '.join(selects)})"
+
+
+class LogArchiver:
+    """Moves logs older than the retention horizon into one SQLite file per year."""
+
+    def __init__(
+        self,
+        archive_dir: Path | str | None = None,
+        retention_days: int = RETENTION_DAYS,
+        batch_size: int = ARCHIVE_BATCH_SIZE,
+    ) -> None:
+        self.archive_dir = Path(archive_dir) if archive_dir else None
+        self.retention_days = retention_days
+        self.batch_size = batch_size
+
+    def path_for(self, year: int, connection: sqlite3.Connection | None = None) -> Path:
+        return self._directory(connection) / f"habit_logs_{int(year)}.db"
+
+    def horizon(self, now: datetime | None = None) -> int:
+        now = now or datetime.utcnow()
+        return epoch_seconds(now - timedelta(days=self.retention_days))
+
+    def run(self, connection: sqlite3.Connection, now: datetime | None = None) -> dict[int, int]:
+        """Archive everything older than the horizon in batches; return rows moved per year."""
+        if connection.in_transaction:
+            raise RuntimeError("LogArchiver.run needs a connection without an open transaction.")
+        cutoff = self.horizon(now)
+        moved = defaultdict(int)
+        while True:
+            rows = run_query(
+                connection,
+                "SELECT id, created_ts FROM habit_logs WHERE created_ts < ? ORDER BY id LIMIT ?",
+                [cutoff, self.batch_size],
+                fetch="all",
+            )
+            if not rows:
+                break
+            by_year = defaultdict(list)
+            for log_id, created_ts in rows:
+                by_year[from_epoch_seconds(created_ts).year].append((log_id, created_ts))
+            years = sorted(by_year)
+            # A batch can reach into more years than may be attached at once.
+            for start in range(0, len(years), MAX_ATTACHED_ARCHIVES):
+                group = years[start : start + MAX_ATTACHED_ARCHIVES]
+                for year in group:
+                    self._prepare(connection, year, group)
+                with transaction(connection):
+                    for year in group:
+                        self._move(connection, year, by_year[year])
+                        moved[year] += len(by_year[year])
+        return dict(moved)
+
+    def _prepare(self, connection: sqlite3.Connection, year: int, group: list[int]) -> None:
+        path = self.path_for(year, connection).resolve()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with transaction(connection):
+            run_query(
+                connection,
+                "INSERT OR IGNORE INTO log_archives (year, path) VALUES (?, ?)", [year, str(path)]
+            )
+        stored = run_query(
+            connection, "SELECT path FROM log_archives WHERE year = ?", [year], fetch="one"
+        )
+        schema = archive_schema(year)
+        if schema not in _attached_schemas(connection):
+            attached = _attached_schemas(connection)
+            if len(attached) >= MAX_ATTACHED_ARCHIVES:
+                keep = {archive_schema(member) for member in group}
+                run_query(connection, f"DETACH DATABASE {sorted(attached - keep)[0]}")
+            _attach(connection, year, stored[0])
+
+    def _directory(self, connection: sqlite3.Connection | None) -> Path:
+        if self.archive_dir is not None:
+            return self.archive_dir
+        # Each shard file gets its own archive folder so yearly files never mix.
+        databases = run_query(connection, "PRAGMA database_list", fetch="all") if connection else []
+        main = next((row[2] for row in databases if row[1] == "main"), "")
+        if not main:
+            return ARCHIVE_DIR
+        return Path(main).parent / "archive" / Path(main).stem
+
+    def _move(self, connection: sqlite3.Connection, year: int, entries: list[tuple[int, int]]) -> None:
+        schema = archive_schema(year)
+        ids = json.dumps([log_id for log_id, _ in entries])
+        columns = ", ".join(_columns(connection, "main"))
+        run_query(
+            connection,
+            f"INSERT OR IGNORE INTO {schema}.habit_logs ({columns}) "
+            f"SELECT {columns} FROM main.habit_logs WHERE id IN (SELECT value FROM json_each(?))",
+            [ids],
+        )
+        run_query(
+            connection,
+            "DELETE FROM main.habit_logs WHERE id IN (SELECT value FROM json_each(?))", [ids]
+        )
+        low = min(created_ts for _, created_ts in entries)
+        high = max(created_ts for _, created_ts in entries)
+        run_query(connection, UPDATE_CATALOG_QUERY, [len(entries), low, low, high, high, year])
+
+
+def _attach_group(connection: sqlite3.Connection, archives: list[tuple[int, str]]) -> None:
+    attached = _attached_schemas(connection)
+    missing = [(year, path) for year, path in archives if archive_schema(year) not in attached]
+    if not missing:
+        return
+    if connection.in_transaction:
+        raise RuntimeError("Log archives cannot be attached inside a transaction.")
+    wanted = {archive_schema(year) for year, _ in archives}
+    spare = [name for name in attached if name.startswith("archive_") and name not in wanted]
+    while spare and len(attached) + len(missing) > MAX_ATTACHED_ARCHIVES:
+        name = spare.pop()
+        run_query(connection, f"DETACH DATABASE {name}")
+        attached.discard(name)
+    for year, path in missing:
+        _attach(connection, year, path)
+
+
+def _copy_overflow(
+    connection: sqlite3.Connection,
+    archives: list[tuple[int, str]],
+    since_ts: int | None,
+    until_ts: int | None,
+    user_id: int | None,
+) -> str:
+    # Read through separate connections: ATTACH is capped and refused inside a transaction.
+    opened = not connection.in_transaction
+    columns = _columns(connection, "main")
+    run_query(connection, f"DROP TABLE IF EXISTS temp.{OVERFLOW_TABLE}")
+    run_query(connection, f"CREATE TEMP TABLE {OVERFLOW_TABLE} AS SELECT * FROM main.habit_logs WHERE 0")
+    insert = (
+        f"INSERT INTO temp.{OVERFLOW_TABLE} ({', '.join(columns)}) "
+        f"VALUES ({', '.join('?' for _ in columns)})"
+    )
+    for _, path in archives:
+        archive = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            present = set(_columns(archive, "main"))
+            projection = ", ".join(column if column in present else "NULL" for column in columns)
+            rows = run_query(
+                archive,
+                f"SELECT {projection} FROM habit_logs "
+                "WHERE (? IS NULL OR user_id = ?) AND (? IS NULL OR created_ts >= ?) "
+                "AND (? IS NULL OR created_ts < ?)",
+                [user_id, user_id, since_ts, since_ts, until_ts, until_ts],
+            )
+            run_many(connection, insert, rows)
+        finally:
+            archive.close()
+    if opened and connection.in_transaction:
+        # Only the temp table was written; don't leave a read transaction open behind it.
+        connection.commit()
+    return f"temp.{OVERFLOW_TABLE}"
+
+
+def _attach(connection: sqlite3.Connection, year: int, path: str) -> None:
+    schema = archive_schema(year)
+    run_query(connection, f"ATTACH DATABASE ? AS {schema}", [path])
+    run_query(
+        connection,
+        f"CREATE TABLE IF NOT EXISTS {schema}.habit_logs AS SELECT * FROM main.habit_logs WHERE 0"
+    )
+    run_query(
+        connection,
+        f"CREATE UNIQUE INDEX IF NOT EXISTS {schema}.idx_archive_logs_id ON habit_logs(id)"
+    )
+    run_query(
+        connection,
+        f"CREATE INDEX IF NOT EXISTS {schema}.idx_archive_logs_user_ts "
+        "ON habit_logs(user_id, created_ts)"
+    )
+    run_query(
+        connection,
+        f"CREATE INDEX IF NOT EXISTS {schema}.idx_archive_logs_habit ON habit_logs(habit_id)"
+    )
+    archived = set(_columns(connection, schema))
+    for row in run_query(connection, "PRAGMA main.table_info(habit_logs)", fetch="all"):
+        column, declared_type, default = row[1], row[2], row[4]
+        if column not in archived:
+            definition = declared_type if default is None else f"{declared_type} DEFAULT {default}"
+            run_query(connection, f"ALTER TABLE {schema}.habit_logs ADD COLUMN {column} {definition}")
+    if connection.in_transaction:
+        connection.commit()
+
+
+def _attached_schemas(connection: sqlite3.Connection) -> set[str]:
+    return {row[1] for row in run_query(connection, "PRAGMA database_list", fetch="all")} - {"main", "temp"}
+
+
+def _columns(connection: sqlite3.Connection, schema: str) -> list[str]:
+    return [row[1] for row in run_query(connection, f"PRAGMA {schema}.table_info(habit_logs)", fetch="all")]
+
+
+if __name__ == "__main__":
+    from data.database import init_db
+
+    conn = init_db()
+    moved = LogArchiver().run(conn)
+    print(f"Archived {sum(moved.values())} logs into {len(moved)} yearly files.")
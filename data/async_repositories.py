@@ -0,0 +1,175 @@
+import asyncio
+import concurrent.futures
+import functools
+import threading
+from itertools import islice
+
+from data.database import ConnectionPool
+from data.repositories import (
+    LOG_PAGE_SIZE,
+    HabitRepository,
+    SettingsRepository,
+    UserRepository,
+)
+
+ASYNC_WORKERS = 8
+
+
+class _Job:
+    __slots__ = ("thread_id", "cancelled")
+
+    def __init__(self):
+        self.thread_id = None
+        self.cancelled = False
+
+
+class DatabaseExecutor:
+    """Runs blocking repository calls on a dedicated thread pool.
+
+    Every worker checks connections out of ``connections`` (a ConnectionPool
+    or ShardRouter), which hands each thread its own connection. A call that
+    is cancelled or times out before it starts never runs; one that is already
+    running has its current statement interrupted, so its transaction rolls
+    back. Work between statements cannot be stopped, but its result is dropped.
+    """
+
+    def __init__(self, connections=None, workers=ASYNC_WORKERS, timeout=None, db_path=None):
+        self.owns_connections = connections is None
+        self.connections = connections or ConnectionPool(db_path, size=workers, read_size=workers)
+        self.timeout = timeout
+        self._threads = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="miniwins-db"
+        )
+        self._lock = threading.Lock()
+
+    async def run(self, fn, *args, timeout=None, **kwargs):
+        timeout = self.timeout if timeout is None else timeout
+        job = _Job()
+        call = functools.partial(fn, *args, **kwargs)
+        future = asyncio.get_running_loop().run_in_executor(self._threads, self._execute, job, call)
+        try:
+            if timeout is None:
+                return await future
+            return await asyncio.wait_for(future, timeout)
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            self._interrupt(job)
+            raise
+
+    def close(self, wait=True):
+        self._threads.shutdown(wait=wait, cancel_futures=True)
+        if self.owns_connections:
+            self.connections.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+    def _execute(self, job, call):
+        with self._lock:
+            if job.cancelled:
+                raise concurrent.futures.CancelledError()
+            job.thread_id = threading.get_ident()
+        try:
+            return call()
+        finally:
+            with self._lock:
+                job.thread_id = None
+
+    def _interrupt(self, job):
+        # Holding the lock keeps the worker from moving on to another job meanwhile.
+        with self._lock:
+            job.cancelled = True
+            if job.thread_id is not None:
+                self.connections.interrupt(job.thread_id)
+
+
+def _delegate(repository_class, name):
+    sync_method = getattr(repository_class, name)
+
+    @functools.wraps(sync_method)
+    async def method(self, *args, timeout=None, **kwargs):
+        return await self.executor.run(getattr(self.sync, name), *args, timeout=timeout, **kwargs)
+
+    return method
+
+
+class _AsyncRepository:
+    async def atomic(self, fn, *args, user_id=None, timeout=None):
+        """Run ``fn(sync_repository, *args)`` in one transaction on one worker."""
+
+        def call():
+            with self.sync.transaction(user_id=user_id):
+                return fn(self.sync, *args)
+
+        return await self.executor.run(call, timeout=timeout)
+
+
+class AsyncHabitRepository(_AsyncRepository):
+    def __init__(self, executor, habit_cache=None):
+        self.executor = executor
+        self.sync = HabitRepository(executor.connections, habit_cache=habit_cache)
+
+    seed_template = _delegate(HabitRepository, "seed_template")
+    add_habit = _delegate(HabitRepository, "add_habit")
+    list_today_habits = _delegate(HabitRepository, "list_today_habits")
+    list_habits = _delegate(HabitRepository, "list_habits")
+    habits_version = _delegate(HabitRepository, "habits_version")
+    delete_habit = _delegate(HabitRepository, "delete_habit")
+    log_action = _delegate(HabitRepository, "log_action")
+    log_actions_bulk = _delegate(HabitRepository, "log_actions_bulk")
+    write_log_rows = _delegate(HabitRepository, "write_log_rows")
+    get_streak = _delegate(HabitRepository, "get_streak")
+    list_habit_streaks = _delegate(HabitRepository, "list_habit_streaks")
+    has_wildcard = _delegate(HabitRepository, "has_wildcard")
+    minute_histogram = _delegate(HabitRepository, "minute_histogram")
+    verify_streaks = _delegate(HabitRepository, "verify_streaks")
+    list_daily_stats = _delegate(HabitRepository, "list_daily_stats")
+    rebuild_daily_stats = _delegate(HabitRepository, "rebuild_daily_stats")
+    list_all_logs = _delegate(HabitRepository, "list_all_logs")
+    list_log_window = _delegate(HabitRepository, "list_log_window")
+    list_logs_since = _delegate(HabitRepository, "list_logs_since")
+    check_index_usage = _delegate(HabitRepository, "check_index_usage")
+
+    async def iter_logs(
+        self, user_id, since=None, until=None, page_size=LOG_PAGE_SIZE, columns=None, timeout=None
+    ):
+        """Async counterpart of HabitRepository.iter_logs; ``timeout`` applies per page."""
+        logs = self.sync.iter_logs(user_id, since, until, page_size, columns)
+        async for log in self._pages(logs, page_size, timeout):
+            yield log
+
+    async def iter_log_records(self, user_id, since=None, until=None, page_size=LOG_PAGE_SIZE, timeout=None):
+        """Async counterpart of HabitRepository.iter_log_records."""
+        logs = self.sync.iter_log_records(user_id, since, until, page_size)
+        async for log in self._pages(logs, page_size, timeout):
+            yield log
+
+    async def _pages(self, logs, page_size, timeout):
+        while True:
+            page = await self.executor.run(lambda: list(islice(logs, page_size)), timeout=timeout)
+            for log in page:
+                yield log
+            if len(page) < page_size:
+                return
+
+
+class AsyncSettingsRepository(_AsyncRepository):
+    def __init__(self, executor, cache=None):
+        self.executor = executor
+        self.sync = SettingsRepository(executor.connections, cache=cache)
+
+    get = _delegate(SettingsRepository, "get")
+    get_many = _delegate(SettingsRepository, "get_many")
+    set = _delegate(SettingsRepository, "set")
+    set_many = _delegate(SettingsRepository, "set_many")
+
+
+class AsyncUserRepository:
+    def __init__(self, executor):
+        self.executor = executor
+        self.sync = UserRepository(executor.connections)
+
+    get_by_email = _delegate(UserRepository, "get_by_email")
+    create_user = _delegate(UserRepository, "create_user")
@@ -0,0 +1,276 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Callable
+
+from data.database import DB_PATH, connection_source
+
+BACKUP_DIR = DB_PATH.parent / "backups"
+BACKUP_STEP_PAGES = 256
+# Sleep between backup steps so writers queued behind the copy get the disk.
+BACKUP_PAUSE = 0.005
+KEEP_SNAPSHOTS = 7
+# How long a snapshot waits for the write lock it holds while pinning its read snapshots.
+LOCK_TIMEOUT = 30.0
+MANIFEST_NAME = "manifest.json"
+
+Progress = Callable[[str, int, int], None]
+
+
+class BackupService:
+    """Online, point-in-time snapshots of the live database files.
+
+    Each source (every shard under a ShardRouter) and the yearly log archives
+    it catalogs are copied with the SQLite backup API, ``step_pages`` pages at
+    a time with ``pause`` seconds between steps. On WAL databases the copy runs
+    inside one read transaction, so it is consistent and never restarts while
+    writers keep committing. The read transactions on a source and its archives
+    all start under the source's write lock, so rows LogArchiver moves during
+    the copy are neither doubled nor lost. Snapshots land in ``backup_dir/<timestamp>`` with
+    a manifest of checksums; only the newest ``keep`` are kept.
+    """
+
+    def __init__(
+        self,
+        connection=None,
+        backup_dir: Path | str | None = None,
+        step_pages: int = BACKUP_STEP_PAGES,
+        pause: float = BACKUP_PAUSE,
+        keep: int = KEEP_SNAPSHOTS,
+    ) -> None:
+        self.connections = connection_source(connection)
+        self.backup_dir = Path(backup_dir or BACKUP_DIR)
+        self.step_pages = step_pages
+        self.pause = pause
+        self.keep = keep
+
+    def snapshot(self, progress: Progress | None = None) -> Path:
+        """Copy every database file into a new snapshot directory and rotate old ones."""
+        stamp = datetime.utcnow().strftime("%Y%m%dT%H%M%S%fZ")
+        staging = self.backup_dir / f".{stamp}.partial"
+        staging.mkdir(parents=True)
+        try:
+            files = []
+            for source in getattr(self.connections, "shards", [self.connections]):
+                with source.connection(readonly=True) as connection:
+                    path = _main_file(connection)
+                    name = path.name if path else "memory.db"
+                    pinned = not connection.in_transaction
+                    archives = []
+                    try:
+                        archives = self._pin(path, connection)
+                        files.append(self._copy(connection, path, staging, name, progress))
+                        for archive, archive_connection in archives:
+                            # Archive folders are per shard by default, but a shared archive_dir is not.
+                            archive_name = f"archive/{Path(name).stem}/{archive.name}"
+                            files.append(
+                                self._copy(archive_connection, archive, staging, archive_name, progress)
+                            )
+                    finally:
+                        if pinned and connection.in_transaction:
+                            connection.rollback()
+                        for _, archive_connection in archives:
+                            archive_connection.close()
+            manifest = {"created_at": datetime.utcnow().isoformat(), "files": files}
+            (staging / MANIFEST_NAME).write_text(json.dumps(manifest, indent=2), encoding="utf-8")
+            target = self.backup_dir / stamp
+            os.replace(staging, target)
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        self.rotate()
+        return target
+
+    def snapshots(self) -> list[Path]:
+        """Finished snapshot directories, oldest first."""
+        if not self.backup_dir.exists():
+            return []
+        return sorted(
+            path
+            for path in self.backup_dir.iterdir()
+            if path.is_dir() and (path / MANIFEST_NAME).exists()
+        )
+
+    def rotate(self) -> list[Path]:
+        """Delete all but the newest ``keep`` snapshots; return the ones removed."""
+        removed = self.snapshots()[: -self.keep] if self.keep else self.snapshots()
+        for path in removed:
+            shutil.rmtree(path)
+        return removed
+
+    def verify(self, snapshot: Path | str | None = None) -> list[str]:
+        """Return the problems found in a snapshot (the latest by default); empty means sound."""
+        snapshot = self._resolve(snapshot)
+        try:
+            manifest = json.loads((snapshot / MANIFEST_NAME).read_text(encoding="utf-8"))
+        except (OSError, ValueError) as error:
+            return [f"{snapshot.name}: unreadable manifest ({error})"]
+        problems = []
+        for entry in manifest["files"]:
+            path = snapshot / entry["name"]
+            if not path.exists():
+                problems.append(f"{entry['name']}: missing")
+                continue
+            if _sha256(path) != entry["sha256"]:
+                problems.append(f"{entry['name']}: checksum mismatch")
+                continue
+            connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+            try:
+                result = [row[0] for row in connection.execute("PRAGMA integrity_check")]
+            except sqlite3.DatabaseError as error:
+                result = [str(error)]
+            finally:
+                connection.close()
+            if result != ["ok"]:
+                problems.append(f"{entry['name']}: {'; '.join(result)}")
+        return problems
+
+    def restore(
+        self, snapshot: Path | str | None = None, target_dir: Path | str | None = None
+    ) -> list[Path]:
+        """Verify a snapshot, then copy its files back; return the paths written.
+
+        Without ``target_dir`` the live files are overwritten in place through
+        the backup API, which takes each file's write lock for the copy.
+        Sessions still open should be restarted afterwards.
+        """
+        snapshot = self._resolve(snapshot)
+        problems = self.verify(snapshot)
+        if problems:
+            raise ValueError(f"Snapshot {snapshot.name} failed verification: {'; '.join(problems)}")
+        manifest = json.loads((snapshot / MANIFEST_NAME).read_text(encoding="utf-8"))
+        restored = []
+        for entry in manifest["files"]:
+            if target_dir is not None:
+                target = Path(target_dir) / entry["name"]
+            elif entry["source"]:
+                target = Path(entry["source"])
+            else:
+                continue
+            target.parent.mkdir(parents=True, exist_ok=True)
+            source = sqlite3.connect(f"file:{snapshot / entry['name']}?mode=ro", uri=True)
+            destination = sqlite3.connect(target)
+            try:
+                source.backup(destination)
+            finally:
+                destination.close()
+                source.close()
+            restored.append(target)
+        if hasattr(self.connections, "forget"):
+            self.connections.forget()
+        return restored
+
+    def _pin(self, path, connection):
+        """Start read snapshots of a source and its archives; return (path, connection) per archive.
+
+        LogArchiver moves rows under the source's write lock, so holding it while
+        the snapshots start means no move is half-seen between the two. Archives
+        are not in WAL mode, so their snapshots also hold the archiver off until
+        they are copied.
+        """
+        lock = sqlite3.connect(path, timeout=LOCK_TIMEOUT) if path is not None else None
+        archives = []
+        try:
+            if lock is not None:
+                lock.execute("BEGIN IMMEDIATE")
+            # Outside WAL a pinned read would block every writer for the whole copy.
+            if connection.execute("PRAGMA journal_mode").fetchone()[0] == "wal":
+                _begin_read(connection)
+            for row in connection.execute("SELECT path FROM log_archives ORDER BY year").fetchall():
+                archive = Path(row[0])
+                if archive.exists():
+                    archives.append((archive, sqlite3.connect(f"file:{archive}?mode=ro", uri=True)))
+                    _begin_read(archives[-1][1])
+        except BaseException:
+            for _, archive_connection in archives:
+                archive_connection.close()
+            raise
+        finally:
+            if lock is not None:
+                lock.rollback()
+                lock.close()
+        return archives
+
+    def _copy(self, connection, path, staging, name, progress):
+        target = staging / name
+        target.parent.mkdir(parents=True, exist_ok=True)
+        copied = {"pages": 0}
+
+        def step(status, remaining, total):
+            copied["pages"] = total - remaining
+            if progress is not None:
+                progress(name, total - remaining, total)
+            if remaining and self.pause:
+                time.sleep(self.pause)
+
+        wal = connection.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        # Pinning one read snapshot keeps commits from other connections from restarting the copy.
+        pinned = wal and not connection.in_transaction
+        destination = sqlite3.connect(target)
+        try:
+            if pinned:
+                connection.execute("BEGIN")
+                connection.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()
+            connection.backup(destination, pages=self.step_pages, progress=step)
+        finally:
+            if pinned:
+                connection.rollback()
+            destination.close()
+        return {
+            "name": name,
+            "source": str(path) if path else None,
+            "pages": copied["pages"],
+            "sha256": _sha256(target),
+        }
+
+    def _resolve(self, snapshot):
+        if snapshot is None:
+            snapshots = self.snapshots()
+            if not snapshots:
+                raise FileNotFoundError(f"No snapshots in {self.backup_dir}")
+            return snapshots[-1]
+        snapshot = Path(snapshot)
+        return snapshot if snapshot.is_absolute() or snapshot.exists() else self.backup_dir / snapshot
+
+
+def _main_file(connection: sqlite3.Connection) -> Path | None:
+    main = next((row[2] for row in connection.execute("PRAGMA database_list") if row[1] == "main"), "")
+    return Path(main) if main else None
+
+
+def _begin_read(connection: sqlite3.Connection) -> None:
+    if not connection.in_transaction:
+        connection.execute("BEGIN")
+        connection.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()
+
+
+def _sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for chunk in iter(lambda: handle.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "snapshot"
+    name = sys.argv[2] if len(sys.argv) > 2 else None
+    if command == "snapshot":
+        print(f"Wrote snapshot {BackupService().snapshot()}.")
+    elif command == "verify":
+        problems = BackupService().verify(name)
+        print("\n".join(problems) or "Snapshot is sound.")
+        sys.exit(1 if problems else 0)
+    elif command == "restore":
+        restored = BackupService().restore(name)
+        print(f"Restored {len(restored)} database files.")
+    else:
+        sys.exit("usage: python -m data.backup [snapshot | verify [name] | restore [name]]")
@@ -0,0 +1,143 @@
+from __future__ import annotations
+
+import sqlite3
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from data.database import transaction
+from data.instrumentation import run_query
+from data.models import day_from_number, day_number, from_epoch_seconds
+
+COMPACTION_DAYS = 90
+# SmartReminderEngine reads the last 14 days of raw events; never fold inside that window.
+MIN_COMPACTION_DAYS = 15
+COMPACTION_BATCH_SIZE = 1000
+
+# One group per (user, habit, day, status). Completed groups carry the hour and minute
+# BestHourCalculator reads, so they fold only when count, first and last reproduce them:
+# every event in one hour, and either exactly two events or all within one minute.
+COMPACTABLE_GROUPS_QUERY = """
+    SELECT user_id, habit_id, day, status,
+        SUM(event_count) AS events,
+        MIN(COALESCE(first_ts, created_ts)) AS first_ts,
+        MAX(created_ts) AS last_ts,
+        json_group_array(id) AS ids
+    FROM habit_logs
+    WHERE day < ? AND created_ts IS NOT NULL
+    GROUP BY user_id, habit_id, day, status
+    HAVING COUNT(*) > 1 AND (
+        status != 'completed' OR (
+            MIN(COALESCE(first_ts, created_ts)) / 3600 = MAX(created_ts) / 3600
+            AND (SUM(event_count) = 2 OR MIN(COALESCE(first_ts, created_ts)) / 60 = MAX(created_ts) / 60)
+        )
+    )
+"""
+
+SUMMARY_COLUMNS = (
+    "habit_id",
+    "user_id",
+    "status",
+    "date",
+    "created_at",
+    "created_ts",
+    "day",
+    "event_count",
+    "first_ts",
+)
+
+
+@dataclass(frozen=True)
+class CompactionResult:
+    groups: int
+    rows_removed: int
+    bytes_reclaimed: int
+
+
+def expand_summary(log: dict) -> list[dict]:
+    """Turn a log row back into one log per event it stands for, newest first."""
+    count = log.pop("event_count", None) or 1
+    first_ts = log.pop("first_ts", None)
+    if count == 1:
+        return [log]
+    first_ts = log["created_ts"] if first_ts is None else first_ts
+    return [_event(log, log["created_ts"]) for _ in range(count - 1)] + [_event(log, first_ts)]
+
+
+def compact_logs(
+    connection: sqlite3.Connection,
+    days: int = COMPACTION_DAYS,
+    now: datetime | None = None,
+    batch_size: int = COMPACTION_BATCH_SIZE,
+    vacuum: bool = False,
+) -> CompactionResult:
+    """Fold raw events older than ``days`` into per-day summary rows."""
+    if days < MIN_COMPACTION_DAYS:
+        raise ValueError(f"Compaction horizon must be at least {MIN_COMPACTION_DAYS} days.")
+    now = now or datetime.utcnow()
+    cutoff = day_number(now.date() - timedelta(days=days))
+    page_size = run_query(connection, "PRAGMA page_size", fetch="one")[0]
+    free_before = run_query(connection, "PRAGMA freelist_count", fetch="one")[0]
+    pages_before = run_query(connection, "PRAGMA page_count", fetch="one")[0]
+
+    columns = list(SUMMARY_COLUMNS)
+    if "timestamp" in {row[1] for row in run_query(connection, "PRAGMA table_info(habit_logs)", fetch="all")}:
+        columns.append("timestamp")
+    insert_query = (
+        f"INSERT INTO habit_logs ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})"
+    )
+
+    groups = run_query(connection, COMPACTABLE_GROUPS_QUERY, [cutoff], fetch="all")
+    removed = 0
+    for start in range(0, len(groups), batch_size):
+        with transaction(connection):
+            for user_id, habit_id, day, status, events, first_ts, last_ts, ids in groups[
+                start : start + batch_size
+            ]:
+                cursor = run_query(
+                    connection,
+                    "DELETE FROM habit_logs WHERE id IN (SELECT value FROM json_each(?))",
+                    [ids],
+                )
+                last_at = from_epoch_seconds(last_ts).isoformat()
+                values = [
+                    habit_id,
+                    user_id,
+                    status,
+                    day_from_number(day).isoformat(),
+                    last_at,
+                    last_ts,
+                    day,
+                    events,
+                    first_ts,
+                ]
+                run_query(connection, insert_query, values + [last_at] * (len(columns) - len(values)))
+                removed += cursor.rowcount - 1
+
+    if vacuum:
+        run_query(connection, "VACUUM")
+        pages_after = run_query(connection, "PRAGMA page_count", fetch="one")[0]
+        reclaimed = (pages_before - pages_after) * page_size
+    else:
+        free_after = run_query(connection, "PRAGMA freelist_count", fetch="one")[0]
+        reclaimed = (free_after - free_before) * page_size
+    return CompactionResult(groups=len(groups), rows_removed=removed, bytes_reclaimed=max(reclaimed, 0))
+
+
+def _event(log: dict, created_ts: int) -> dict:
+    event = dict(log, created_ts=created_ts)
+    moment = from_epoch_seconds(created_ts).isoformat()
+    for column in ("created_at", "timestamp"):
+        if column in event:
+            event[column] = moment
+    return event
+
+
+if __name__ == "__main__":
+    from data.database import init_db
+
+    conn = init_db()
+    result = compact_logs(conn)
+    print(
+        f"Folded {result.groups} groups, removed {result.rows_removed} rows, "
+        f"reclaimed {result.bytes_reclaimed} bytes."
+    )
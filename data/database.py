@@ -1,40 +1,494 @@
+import queue
 import sqlite3
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
 from pathlib import Path
 
-from data.migrate import ensure_schema
+from data.instrumentation import run_query
+from data.migrate import analyze_if_due, ensure_schema
+from data.streaks import USER_SCOPE
 
 DB_PATH = Path("miniwins.db")
+POOL_SIZE = 5
+BUSY_TIMEOUT_MS = 5000
+SYNCHRONOUS = "NORMAL"
+CHECKOUT_TIMEOUT = 30.0
+SHARD_COUNT = 4
+SHARD_STRATEGIES = ("hash", "directory")
+# Per-user tables copied by ShardRouter.move_user; habit ids are remapped on the way.
+SHARDED_TABLES = (
+    "habit_daily_stats",
+    "streak_state",
+    "minute_histograms",
+    "minute_histogram_anchors",
+    "habit_purges",
+    "settings",
+    "user_data_versions",
+)
+
+
+class Connection(sqlite3.Connection):
+    # Resolved lazily by data.repositories.schema_for and reset by ensure_schema.
+    schema_descriptor = None
 
 
 def get_connection():
-    connection = sqlite3.connect(DB_PATH)
+    connection = sqlite3.connect(DB_PATH, factory=Connection)
     connection.row_factory = sqlite3.Row
     return connection
 
 
+# Nesting depth of open transaction() blocks, keyed by id(connection). Entries
+# only live while a block is open, so ids of closed connections never linger.
+_TRANSACTION_DEPTH = {}
+
+
+@contextmanager
+def transaction(connection, savepoint=False):
+    key = id(connection)
+    depth = _TRANSACTION_DEPTH.get(key, 0)
+    name = f"miniwins_sp_{depth}"
+    if depth == 0:
+        if not connection.in_transaction:
+            connection.execute("BEGIN IMMEDIATE")
+    elif savepoint:
+        connection.execute(f"SAVEPOINT {name}")
+    _TRANSACTION_DEPTH[key] = depth + 1
+    try:
+        yield connection
+    except BaseException:
+        if depth == 0:
+            connection.rollback()
+        elif savepoint:
+            connection.execute(f"ROLLBACK TO {name}")
+            connection.execute(f"RELEASE {name}")
+        raise
+    else:
+        if depth == 0:
+            connection.commit()
+        elif savepoint:
+            connection.execute(f"RELEASE {name}")
+    finally:
+        if depth == 0:
+            _TRANSACTION_DEPTH.pop(key, None)
+        else:
+            _TRANSACTION_DEPTH[key] = depth
+
+
 def init_db():
     connection = get_connection()
     ensure_schema(connection)
+    analyze_if_due(connection)
     return connection
 
 
+class SingleConnection:
+    """Connection source wrapping one long-lived connection."""
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    @contextmanager
+    def connection(self, readonly=False):
+        yield self._connection
+
+    @contextmanager
+    def transaction(self, savepoint=False):
+        with transaction(self._connection, savepoint=savepoint) as connection:
+            yield connection
+
+
+class ConnectionPool:
+    """Connection source that checks connections out per thread.
+
+    A thread keeps the same connection for nested checkouts, so a transaction
+    opened by one repository call is joined by the calls made inside it. Reads
+    go to the read-only pool when one is configured and the thread is not
+    already holding a writer.
+    """
+
+    def __init__(
+        self,
+        db_path=None,
+        size=POOL_SIZE,
+        read_size=0,
+        readonly=False,
+        busy_timeout=BUSY_TIMEOUT_MS,
+        synchronous=SYNCHRONOUS,
+        checkout_timeout=CHECKOUT_TIMEOUT,
+    ):
+        self.db_path = Path(db_path or DB_PATH)
+        self.size = size
+        self.readonly = readonly
+        self.busy_timeout = busy_timeout
+        self.synchronous = synchronous
+        self.checkout_timeout = checkout_timeout
+        self._idle = queue.LifoQueue()
+        self._connections = []
+        # Slots claimed by checkouts that are still opening their connection.
+        self._reserved = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # Connection checked out by each thread, so interrupt() can reach it.
+        self._holders = {}
+        self.reader = None
+        if not readonly:
+            # Migrate before any reader opens the file in read-only mode.
+            self._idle.put(self._open())
+            if read_size:
+                self.reader = ConnectionPool(
+                    self.db_path,
+                    size=read_size,
+                    readonly=True,
+                    busy_timeout=busy_timeout,
+                    synchronous=synchronous,
+                    checkout_timeout=checkout_timeout,
+                )
+
+    @contextmanager
+    def connection(self, readonly=False):
+        held = getattr(self._local, "connection", None)
+        if held is not None:
+            yield held
+            return
+        if readonly and self.reader is not None:
+            with self.reader.connection() as connection:
+                yield connection
+            return
+
+        connection = self._checkout()
+        self._local.connection = connection
+        self._holders[threading.get_ident()] = connection
+        try:
+            yield connection
+        finally:
+            self._holders.pop(threading.get_ident(), None)
+            self._local.connection = None
+            if connection.in_transaction:
+                connection.rollback()
+            self._idle.put(connection)
+
+    @contextmanager
+    def transaction(self, savepoint=False):
+        with self.connection() as connection:
+            with transaction(connection, savepoint=savepoint):
+                yield connection
+
+    def interrupt(self, thread_id):
+        """Abort the statement running on the connection ``thread_id`` holds, if any."""
+        connection = self._holders.get(thread_id)
+        if connection is not None:
+            connection.interrupt()
+        if self.reader is not None:
+            self.reader.interrupt(thread_id)
+
+    def close(self):
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+        if self.reader is not None:
+            self.reader.close()
+
+    def _checkout(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            can_open = len(self._connections) + self._reserved < self.size
+            if can_open:
+                self._reserved += 1
+        if can_open:
+            try:
+                return self._open(reserved=True)
+            except BaseException:
+                with self._lock:
+                    self._reserved -= 1
+                raise
+        try:
+            return self._idle.get(timeout=self.checkout_timeout)
+        except queue.Empty:
+            raise TimeoutError(f"No database connection available after {self.checkout_timeout}s")
+
+    def _open(self, reserved=False):
+        if self.readonly:
+            connection = sqlite3.connect(
+                f"file:{self.db_path}?mode=ro",
+                uri=True,
+                factory=Connection,
+                check_same_thread=False,
+            )
+        else:
+            connection = sqlite3.connect(self.db_path, factory=Connection, check_same_thread=False)
+        connection.row_factory = sqlite3.Row
+        connection.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout)}")
+        connection.execute(f"PRAGMA synchronous = {self.synchronous}")
+        if self.readonly:
+            connection.execute("PRAGMA foreign_keys = ON")
+        else:
+            connection.execute("PRAGMA journal_mode = WAL")
+            ensure_schema(connection)
+            if not self._connections:
+                analyze_if_due(connection)
+        with self._lock:
+            self._connections.append(connection)
+            if reserved:
+                self._reserved -= 1
+        return connection
+
+
+def shard_path(index, db_path=None):
+    """Shard 0 is the main database file; the others sit next to it."""
+    base = Path(db_path or DB_PATH)
+    if index == 0:
+        return base
+    return base.with_name(f"{base.stem}.shard{index}{base.suffix}")
+
+
+class ShardRouter:
+    """Connection source that spreads users over several database files.
+
+    Each shard is its own ConnectionPool, so users on different shards never
+    wait on each other's write lock. Shard 0 doubles as the directory: it keeps
+    users, auth and the user_shards placement table, and serves every call made
+    without a user_id. With the "hash" strategy a user lives on
+    ``user_id % shard_count`` unless user_shards says otherwise; with
+    "directory" unplaced users stay on shard 0 (where pre-sharding data lives)
+    and new users are recorded on the least loaded shard.
+
+    Placements are cached per process; call forget() in other processes after
+    move_user.
+    """
+
+    def __init__(self, shard_count=SHARD_COUNT, db_path=None, strategy="hash", **pool_options):
+        if strategy not in SHARD_STRATEGIES:
+            raise ValueError(f"Unknown shard strategy: {strategy}")
+        self.strategy = strategy
+        self.shards = [
+            ConnectionPool(shard_path(index, db_path), **pool_options) for index in range(shard_count)
+        ]
+        self.directory = self.shards[0]
+        self._placements = {}
+        self._lock = threading.Lock()
+        # LogWriteQueues writing through this router; move_user holds their rows.
+        self.log_queues = weakref.WeakSet()
+
+    def shard_for(self, user_id):
+        with self._lock:
+            shard = self._placements.get(user_id)
+        if shard is None:
+            with self.directory.connection(readonly=True) as connection:
+                row = connection.execute(
+                    "SELECT shard FROM user_shards WHERE user_id = ?", [user_id]
+                ).fetchone()
+            if row is not None:
+                shard = row[0]
+            elif self.strategy == "hash":
+                shard = user_id % len(self.shards)
+            else:
+                shard = 0
+            with self._lock:
+                self._placements[user_id] = shard
+        return shard
+
+    def source_for(self, user_id):
+        return self.shards[self.shard_for(user_id)]
+
+    def forget(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self._placements.clear()
+            else:
+                self._placements.pop(user_id, None)
+
+    def connection(self, readonly=False):
+        return self.directory.connection(readonly=readonly)
+
+    def transaction(self, savepoint=False):
+        return self.directory.transaction(savepoint=savepoint)
+
+    def register_user(self, user_id):
+        """Place a user created in the directory and mirror its row onto its shard."""
+        if self.strategy == "directory":
+            with self.directory.transaction() as connection:
+                counts = dict(
+                    connection.execute("SELECT shard, COUNT(*) FROM user_shards GROUP BY shard")
+                )
+                shard = min(range(len(self.shards)), key=lambda index: counts.get(index, 0))
+                connection.execute(
+                    "INSERT OR REPLACE INTO user_shards (user_id, shard) VALUES (?, ?)",
+                    [user_id, shard],
+                )
+            self.forget(user_id)
+        shard = self.shard_for(user_id)
+        if shard != 0:
+            with self.directory.connection(readonly=True) as source:
+                with self.shards[shard].transaction() as target:
+                    _copy_user(source, target, user_id)
+        return shard
+
+    def move_user(self, user_id, shard):
+        """Copy a user's rows to another shard, switch the directory, then clean up.
+
+        The source shard's write lock is held throughout, so no log written
+        while moving can be lost. Habits get new ids on the target shard; rows
+        queued in a LogWriteQueue are flushed first, and rows put while moving
+        wait and are remapped to the new ids.
+        """
+        from data.archive import archive_groups, attach_archives, log_source
+
+        current = self.shard_for(user_id)
+        if shard == current:
+            return {}
+        source_pool, target_pool = self.shards[current], self.shards[shard]
+        with ExitStack() as held:
+            queues = [held.enter_context(log_queue.holding(user_id)) for log_queue in list(self.log_queues)]
+            source = held.enter_context(source_pool.connection())
+            with source_pool.transaction():
+                # Read under the write lock so the archiver cannot move rows mid-copy.
+                logs_source = log_source(source, attach_archives(source, user_id=user_id))
+                with target_pool.transaction() as target:
+                    _delete_user_rows(target, user_id, keep_user=shard == 0)
+                    if shard != 0:
+                        _copy_user(source, target, user_id)
+                    habit_ids = {}
+                    for habit in source.execute(
+                        "SELECT * FROM habits WHERE user_id = ? ORDER BY id", [user_id]
+                    ).fetchall():
+                        values = {key: habit[key] for key in habit.keys() if key != "id"}
+                        placeholders = ", ".join("?" for _ in values)
+                        cursor = target.execute(
+                            f"INSERT INTO habits ({', '.join(values)}) VALUES ({placeholders})",
+                            list(values.values()),
+                        )
+                        habit_ids[habit["id"]] = cursor.lastrowid
+                    habit_ids[USER_SCOPE] = USER_SCOPE
+                    _copy_rows(
+                        source,
+                        target,
+                        f"SELECT * FROM {logs_source} WHERE user_id = ? ORDER BY id",
+                        [user_id],
+                        "habit_logs",
+                        habit_ids=habit_ids,
+                        drop_id=True,
+                    )
+                    for table in SHARDED_TABLES:
+                        _copy_rows(
+                            source,
+                            target,
+                            f"SELECT * FROM {table} WHERE user_id = ?",
+                            [user_id],
+                            table,
+                            habit_ids=habit_ids,
+                        )
+                    # Cached habit lists are keyed on this version.
+                    target.execute(
+                        "UPDATE user_data_versions SET habits_version = habits_version + 1 WHERE user_id = ?",
+                        [user_id],
+                    )
+                with self.directory.transaction() as directory:
+                    directory.execute(
+                        "INSERT OR REPLACE INTO user_shards (user_id, shard) VALUES (?, ?)",
+                        [user_id, shard],
+                    )
+                _delete_user_rows(source, user_id, keep_user=current == 0)
+            # Archived rows are unreachable once the directory points elsewhere.
+            for schemas in archive_groups(source):
+                with source_pool.transaction():
+                    for schema in schemas:
+                        source.execute(f"DELETE FROM {schema}.habit_logs WHERE user_id = ?", [user_id])
+            self.forget(user_id)
+            moved = {old: new for old, new in habit_ids.items() if old != USER_SCOPE}
+            for log_queue in queues:
+                log_queue.remap(user_id, moved)
+        return moved
+
+    def fan_out(self, query, params=None):
+        """Run one read-only query on every shard in parallel and concatenate the rows."""
+
+        def run(shard):
+            with shard.connection(readonly=True) as connection:
+                return run_query(connection, query, params, fetch="all")
+
+        with ThreadPoolExecutor(max_workers=len(self.shards)) as executor:
+            return [row for rows in executor.map(run, self.shards) for row in rows]
+
+    def interrupt(self, thread_id):
+        for shard in self.shards:
+            shard.interrupt(thread_id)
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+
+def _copy_user(source, target, user_id):
+    _copy_rows(source, target, "SELECT * FROM users WHERE id = ?", [user_id], "users", "OR IGNORE")
+
+
+def _copy_rows(source, target, query, params, table, conflict="", habit_ids=None, drop_id=False):
+    rows = source.execute(query, params).fetchall()
+    if not rows:
+        return 0
+    columns = [column for column in rows[0].keys() if not (drop_id and column == "id")]
+    values = []
+    for row in rows:
+        record = {column: row[column] for column in columns}
+        if habit_ids is not None and "habit_id" in record:
+            if record["habit_id"] not in habit_ids:
+                # Rows left behind by habits that no longer exist stay behind.
+                continue
+            record["habit_id"] = habit_ids[record["habit_id"]]
+        values.append([record[column] for column in columns])
+    target.executemany(
+        f"INSERT {conflict} INTO {table} ({', '.join(columns)}) "
+        f"VALUES ({', '.join('?' for _ in columns)})",
+        values,
+    )
+    return len(values)
+
+
+def _delete_user_rows(connection, user_id, keep_user):
+    for table in ("habit_logs", *SHARDED_TABLES, "habits"):
+        connection.execute(f"DELETE FROM {table} WHERE user_id = ?", [user_id])
+    if not keep_user:
+        connection.execute("DELETE FROM users WHERE id = ?", [user_id])
+
+
+def connection_source(connection=None):
+    if connection is None:
+        return SingleConnection(init_db())
+    if isinstance(connection, (ConnectionPool, SingleConnection, ShardRouter)):
+        return connection
+    if isinstance(connection, Database):
+        return SingleConnection(connection.connection)
+    return SingleConnection(connection)
+
+
+def source_for(connections, user_id=None):
+    """The source holding a user's rows: their shard under a router, else ``connections``."""
+    if user_id is not None and isinstance(connections, ShardRouter):
+        return connections.source_for(user_id)
+    return connections
+
+
 class Database:
     def __init__(self):
         self.db_path = DB_PATH
         self.connection = init_db()
 
+    def transaction(self, savepoint=False):
+        return transaction(self.connection, savepoint=savepoint)
+
     def execute(self, query, params=None):
-        cursor = self.connection.cursor()
-        cursor.execute(query, params or [])
-        self.connection.commit()
-        return cursor
+        with self.transaction():
+            return run_query(self.connection, query, params)
 
     def fetchall(self, query, params=None):
-        cursor = self.connection.cursor()
-        cursor.execute(query, params or [])
-        return cursor.fetchall()
+        return run_query(self.connection, query, params, fetch="all")
 
     def fetchone(self, query, params=None):
-        cursor = self.connection.cursor()
-        cursor.execute(query, params or [])
-        return cursor.fetchone()
+        return run_query(self.connection, query, params, fetch="one")
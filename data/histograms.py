@@ -0,0 +1,211 @@
+from __future__ import annotations
+
+import sqlite3
+from collections import defaultdict
+from typing import Iterable
+
+from data.instrumentation import run_many, run_query
+from data.models import SECONDS_PER_DAY
+from data.streaks import USER_SCOPE
+from domain.logic import MinuteHistogram
+
+HALF_LIFE_DAYS = 7.0
+HALF_LIFE_SECONDS = HALF_LIFE_DAYS * SECONDS_PER_DAY
+# Forward decay: a completion at ts weighs 2 ** ((ts - anchor_ts) / half-life).
+# Every bucket shrinks by the same factor as time passes, so bucket rankings
+# never depend on "now"; anchors only move forward to keep weights finite.
+MAX_ANCHOR_HALF_LIVES = 64
+# Weights left over from subtracting a deleted habit are rounding noise.
+MIN_WEIGHT = 1e-9
+REBUILD_BATCH_SIZE = 5000
+
+UPSERT_MINUTE_QUERY = """
+    INSERT INTO minute_histograms (user_id, habit_id, minute, weight)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(user_id, habit_id, minute) DO UPDATE SET weight = weight + excluded.weight
+"""
+
+
+def create_minute_histogram_tables(connection: sqlite3.Connection) -> None:
+    run_query(
+        connection,
+        """
+        CREATE TABLE IF NOT EXISTS minute_histograms (
+            user_id INTEGER NOT NULL,
+            habit_id INTEGER NOT NULL,
+            minute INTEGER NOT NULL,
+            weight REAL NOT NULL,
+            PRIMARY KEY (user_id, habit_id, minute)
+        ) WITHOUT ROWID
+        """
+    )
+    run_query(
+        connection,
+        """
+        CREATE TABLE IF NOT EXISTS minute_histogram_anchors (
+            user_id INTEGER PRIMARY KEY,
+            anchor_ts INTEGER NOT NULL
+        )
+        """
+    )
+
+
+def completion_events(rows: Iterable[dict]) -> Iterable[tuple[int, int, int]]:
+    """(user_id, habit_id, ts) per completion; compacted rows yield event_count events."""
+    for row in rows:
+        if row["status"] != "completed" or row["created_ts"] is None:
+            continue
+        count = row.get("event_count") or 1
+        first_ts = row.get("first_ts")
+        for _ in range(count - 1 if first_ts is not None else count):
+            yield row["user_id"], row["habit_id"], row["created_ts"]
+        if first_ts is not None:
+            yield row["user_id"], row["habit_id"], first_ts
+
+
+def apply_minute_histograms(connection: sqlite3.Connection, rows: Iterable[dict]) -> None:
+    """Add new log rows to their habit's and user's histograms."""
+    by_user = defaultdict(list)
+    for user_id, habit_id, ts in completion_events(rows):
+        by_user[user_id].append((habit_id, ts))
+    deltas = defaultdict(float)
+    for user_id, events in by_user.items():
+        anchor = _anchor(connection, user_id, max(ts for _, ts in events))
+        for habit_id, ts in events:
+            weight = 2 ** ((ts - anchor) / HALF_LIFE_SECONDS)
+            minute = ts % SECONDS_PER_DAY // 60
+            deltas[(user_id, habit_id, minute)] += weight
+            deltas[(user_id, USER_SCOPE, minute)] += weight
+    if deltas:
+        run_many(connection, UPSERT_MINUTE_QUERY, [[*key, weight] for key, weight in deltas.items()])
+
+
+def remove_habit_histogram(connection: sqlite3.Connection, user_id: int, habit_id: int) -> None:
+    """Drop a habit's histogram and take its weight back out of the user's."""
+    run_query(
+        connection,
+        """
+        UPDATE minute_histograms SET weight = weight - (
+            SELECT habit.weight FROM minute_histograms AS habit
+            WHERE habit.user_id = minute_histograms.user_id
+              AND habit.habit_id = ? AND habit.minute = minute_histograms.minute
+        )
+        WHERE user_id = ? AND habit_id = ? AND minute IN (
+            SELECT minute FROM minute_histograms WHERE user_id = ? AND habit_id = ?
+        )
+        """,
+        [habit_id, user_id, USER_SCOPE, user_id, habit_id],
+    )
+    run_query(
+        connection,
+        "DELETE FROM minute_histograms WHERE user_id = ? AND (habit_id = ? OR weight < ?)",
+        [user_id, habit_id, MIN_WEIGHT],
+    )
+
+
+def load_minute_histogram(
+    connection: sqlite3.Connection,
+    user_id: int,
+    habit_id: int = USER_SCOPE,
+    pending: Iterable[dict] = (),
+) -> MinuteHistogram:
+    """Read a histogram, adding ``pending`` log rows not yet written; never writes."""
+    rows = run_query(
+        connection,
+        "SELECT minute, weight FROM minute_histograms WHERE user_id = ? AND habit_id = ?",
+        [user_id, habit_id],
+        fetch="all",
+    )
+    buckets = {minute: weight for minute, weight in rows}
+    events = [
+        ts
+        for event_user, event_habit, ts in completion_events(pending)
+        if event_user == user_id and habit_id in (USER_SCOPE, event_habit)
+    ]
+    if events:
+        row = run_query(
+            connection,
+            "SELECT anchor_ts FROM minute_histogram_anchors WHERE user_id = ?",
+            [user_id],
+            fetch="one",
+        )
+        anchor = max(events) if row is None else row[0]
+        if (max(events) - anchor) / HALF_LIFE_SECONDS > MAX_ANCHOR_HALF_LIVES:
+            # Same re-anchoring _anchor would store, applied to this copy only.
+            scale = 2 ** ((anchor - max(events)) / HALF_LIFE_SECONDS)
+            buckets = {minute: weight * scale for minute, weight in buckets.items()}
+            anchor = max(events)
+        for ts in events:
+            minute = ts % SECONDS_PER_DAY // 60
+            buckets[minute] = buckets.get(minute, 0.0) + 2 ** ((ts - anchor) / HALF_LIFE_SECONDS)
+    return MinuteHistogram(buckets)
+
+
+def rebuild_minute_histograms(
+    connection: sqlite3.Connection,
+    user_id: int | None = None,
+    source: str = "habit_logs",
+) -> int:
+    """Recompute histograms from raw logs; return the number of completions counted."""
+    scope = "" if user_id is None else "WHERE user_id = ?"
+    params = [] if user_id is None else [user_id]
+    run_query(connection, f"DELETE FROM minute_histograms {scope}", params)
+    # Anchoring at each user's latest completion keeps rebuilt weights at or below 1.
+    run_query(connection, f"DELETE FROM minute_histogram_anchors {scope}", params)
+    user_filter = "" if user_id is None else "AND user_id = ?"
+    run_query(
+        connection,
+        f"""
+        INSERT INTO minute_histogram_anchors (user_id, anchor_ts)
+        SELECT user_id, MAX(created_ts) FROM {source}
+        WHERE status = 'completed' AND created_ts IS NOT NULL {user_filter}
+        GROUP BY user_id
+        """,
+        params,
+    )
+    cursor = run_query(
+        connection,
+        f"""
+        SELECT user_id, habit_id, status, created_ts, event_count, first_ts FROM {source}
+        WHERE status = 'completed' AND created_ts IS NOT NULL {user_filter}
+        """,
+        params,
+    )
+    counted = 0
+    columns = [column[0] for column in cursor.description]
+    while True:
+        batch = [dict(zip(columns, row)) for row in cursor.fetchmany(REBUILD_BATCH_SIZE)]
+        if not batch:
+            return counted
+        apply_minute_histograms(connection, batch)
+        counted += sum(row["event_count"] or 1 for row in batch)
+
+
+def _anchor(connection: sqlite3.Connection, user_id: int, latest_ts: int) -> int:
+    row = run_query(
+        connection,
+        "SELECT anchor_ts FROM minute_histogram_anchors WHERE user_id = ?",
+        [user_id],
+        fetch="one",
+    )
+    if row is None:
+        run_query(
+            connection,
+            "INSERT INTO minute_histogram_anchors (user_id, anchor_ts) VALUES (?, ?)",
+            [user_id, latest_ts],
+        )
+        return latest_ts
+    anchor = row[0]
+    if (latest_ts - anchor) / HALF_LIFE_SECONDS > MAX_ANCHOR_HALF_LIVES:
+        run_query(
+            connection,
+            "UPDATE minute_histograms SET weight = weight * ? WHERE user_id = ?",
+            [2 ** ((anchor - latest_ts) / HALF_LIFE_SECONDS), user_id],
+        )
+        run_query(
+            connection,
+            "UPDATE minute_histogram_anchors SET anchor_ts = ? WHERE user_id = ?",
+            [latest_ts, user_id],
+        )
+        anchor = latest_ts
+    return anchor
@@ -0,0 +1,208 @@
+import re
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from datetime import datetime
+from functools import lru_cache
+
+SLOW_QUERY_MS = 100.0
+SLOW_LOG_SIZE = 200
+# Upper bounds (ms) of the latency histogram buckets; the last bucket is open-ended.
+LATENCY_BUCKETS_MS = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000)
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=1024)
+def fingerprint(query):
+    """Normalize a statement so calls differing only in literals group together."""
+    text = _STRING_LITERAL.sub("?", query)
+    text = _NUMBER_LITERAL.sub("?", text)
+    text = _WHITESPACE.sub(" ", text).strip()
+    return _PLACEHOLDER_LIST.sub("(?, ...)", text)
+
+
+@dataclass
+class QueryStats:
+    calls: int = 0
+    rows: int = 0
+    total_ms: float = 0.0
+    max_ms: float = 0.0
+    buckets: list = field(default_factory=lambda: [0] * (len(LATENCY_BUCKETS_MS) + 1))
+
+    def add(self, rows, elapsed_ms, calls=1):
+        # An executemany() batch counts each execution at the batch's mean latency.
+        per_call = elapsed_ms / calls if calls else 0.0
+        self.calls += calls
+        self.rows += rows
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, per_call)
+        self.buckets[bisect_left(LATENCY_BUCKETS_MS, per_call)] += calls
+
+    @property
+    def mean_ms(self):
+        return self.total_ms / self.calls if self.calls else 0.0
+
+    def histogram(self):
+        """Bucket label ("<=5ms", ">1000ms") to call count, empty buckets left out."""
+        labels = [f"<={bound}ms" for bound in LATENCY_BUCKETS_MS] + [f">{LATENCY_BUCKETS_MS[-1]}ms"]
+        return {label: count for label, count in zip(labels, self.buckets) if count}
+
+
+@dataclass(frozen=True)
+class SlowQuery:
+    fingerprint: str
+    elapsed_ms: float
+    rows: int
+    at: str
+
+
+class QueryReport:
+    """Statements recorded inside one QueryRecorder.capture() block."""
+
+    def __init__(self):
+        self.stats = {}
+
+    def add(self, key, rows, elapsed_ms, calls=1):
+        self.stats.setdefault(key, QueryStats()).add(rows, elapsed_ms, calls)
+
+    @property
+    def calls(self):
+        return sum(stats.calls for stats in self.stats.values())
+
+    @property
+    def total_ms(self):
+        return sum(stats.total_ms for stats in self.stats.values())
+
+    def rows(self):
+        """One dict per fingerprint, most expensive first."""
+        return [
+            {
+                "query": key,
+                "calls": stats.calls,
+                "rows": stats.rows,
+                "total_ms": round(stats.total_ms, 3),
+                "max_ms": round(stats.max_ms, 3),
+            }
+            for key, stats in sorted(self.stats.items(), key=lambda item: -item[1].total_ms)
+        ]
+
+    def format(self):
+        lines = [f"{self.calls} queries, {self.total_ms:.1f} ms"]
+        for row in self.rows():
+            lines.append(
+                f"{row['total_ms']:>9.2f} ms {row['calls']:>4}x {row['rows']:>6} rows  {row['query']}"
+            )
+        return "\n".join(lines)
+
+
+class QueryRecorder:
+    """Process-wide statement counters, latency histograms and a slow-query log.
+
+    Every repository query goes through run_query(), which records into
+    RECORDER. ``slow_threshold_ms`` may be changed at any time; statements at
+    or above it are kept in ``slow_queries`` (newest last) and, when
+    ``slow_log_path`` is set, appended to that file.
+    """
+
+    def __init__(self, slow_threshold_ms=SLOW_QUERY_MS, slow_log_size=SLOW_LOG_SIZE, slow_log_path=None):
+        self.slow_threshold_ms = slow_threshold_ms
+        self.slow_log_path = slow_log_path
+        self.slow_queries = deque(maxlen=slow_log_size)
+        self.stats = {}
+        self.enabled = True
+        self._reports = ContextVar(f"query_reports_{id(self)}", default=())
+        self._lock = threading.Lock()
+
+    def record(self, query, rows, elapsed_ms, calls=1):
+        key = fingerprint(query)
+        with self._lock:
+            self.stats.setdefault(key, QueryStats()).add(rows, elapsed_ms, calls)
+        for report in self._reports.get():
+            report.add(key, rows, elapsed_ms, calls)
+        if elapsed_ms >= self.slow_threshold_ms:
+            entry = SlowQuery(key, round(elapsed_ms, 3), rows, datetime.utcnow().isoformat())
+            self.slow_queries.append(entry)
+            if self.slow_log_path is not None:
+                with self._lock, open(self.slow_log_path, "a", encoding="utf-8") as handle:
+                    handle.write(f"{entry.at}\t{entry.elapsed_ms:.3f}ms\t{entry.rows}\t{entry.fingerprint}\n")
+
+    @contextmanager
+    def capture(self):
+        """Collect a QueryReport of the statements this thread or task runs in the block."""
+        report = QueryReport()
+        token = self._reports.set((*self._reports.get(), report))
+        try:
+            yield report
+        finally:
+            self._reports.reset(token)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                key: QueryStats(stats.calls, stats.rows, stats.total_ms, stats.max_ms, list(stats.buckets))
+                for key, stats in self.stats.items()
+            }
+
+    def reset(self):
+        with self._lock:
+            self.stats.clear()
+            self.slow_queries.clear()
+
+
+RECORDER = QueryRecorder()
+
+
+def run_query(connection, query, params=None, fetch=None, recorder=None, row_factory=None):
+    """Execute one statement and record it; the instrumented path for all repositories.
+
+    ``fetch`` is "all", "one" or None (return the cursor). Row counts are the
+    rows fetched, or the rows changed for writes. ``row_factory`` overrides the
+    connection's for this statement only.
+    """
+    recorder = recorder or RECORDER
+    started = time.perf_counter()
+    if row_factory is None:
+        cursor = connection.execute(query, params or [])
+    else:
+        cursor = connection.cursor()
+        cursor.row_factory = row_factory
+        cursor.execute(query, params or [])
+    if fetch == "all":
+        result = cursor.fetchall()
+        rows = len(result)
+    elif fetch == "one":
+        result = cursor.fetchone()
+        rows = 0 if result is None else 1
+    else:
+        result = cursor
+        rows = max(cursor.rowcount, 0)
+    if recorder.enabled:
+        recorder.record(query, rows, (time.perf_counter() - started) * 1000)
+    return result
+
+
+def run_many(connection, query, params_seq, recorder=None):
+    """executemany() counterpart of run_query; records one call per parameter set."""
+    recorder = recorder or RECORDER
+    executions = 0
+
+    def counted():
+        nonlocal executions
+        for params in params_seq:
+            executions += 1
+            yield params
+
+    started = time.perf_counter()
+    cursor = connection.executemany(query, counted())
+    if recorder.enabled and executions:
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        recorder.record(query, max(cursor.rowcount, 0), elapsed_ms, executions)
+    return cursor
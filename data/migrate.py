@@ -1,14 +1,130 @@
 from __future__ import annotations
 
+import re
 import sqlite3
-from datetime import datetime
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Callable
+
+from data.histograms import create_minute_histogram_tables, rebuild_minute_histograms
+from data.rollups import create_daily_stats_table, rebuild_daily_stats
+from data.seed import TEMPLATES
+from data.streaks import create_streak_table, recompute_streaks, verify_streaks
+from domain.logic import EVERY_DAY, WeekdaySchedule
+
+BACKFILL_BATCH_SIZE = 5000
+ANALYZE_INTERVAL = timedelta(days=7)
+# Before migration 10 every habit_logs row is a single event.
+UNCOMPACTED_LOGS = "(SELECT *, 1 AS event_count FROM habit_logs)"
+HABITS_REFERENCE = r"REFERENCES\s+\"?habits\"?\s*\(\s*id\s*\)"
+CASCADE_REFERENCE = HABITS_REFERENCE + r"\s+ON\s+DELETE\s+CASCADE"
+# Version each connection's running batched or no_transaction migration moves to; see _migration_batch.
+_BATCHED_TARGETS = {}
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    name: str
+    apply: Callable[[sqlite3.Connection], None]
+    # Batched migrations commit their own work in chunks instead of running in
+    # one transaction, so they must be safe to resume after an interruption.
+    batched: bool = False
+    # Run apply outside the migration transaction, for work that must happen
+    # between transactions (PRAGMA foreign_keys is a no-op inside one). Such
+    # migrations open their own with _migration_batch, like batched ones.
+    no_transaction: bool = False
 
 
 def ensure_schema(connection: sqlite3.Connection) -> None:
     connection.execute("PRAGMA foreign_keys = ON")
+    current = schema_version(connection)
+    pending = [migration for migration in MIGRATIONS if migration.version > current]
+    if not pending:
+        return
+    for migration in pending:
+        _apply_migration(connection, migration)
+    if hasattr(connection, "schema_descriptor"):
+        connection.schema_descriptor = None
+
+
+def schema_version(connection: sqlite3.Connection) -> int:
+    return connection.execute("PRAGMA user_version").fetchone()[0]
+
+
+def latest_version() -> int:
+    return MIGRATIONS[-1].version
+
+
+def analyze_if_due(
+    connection: sqlite3.Connection,
+    interval: timedelta = ANALYZE_INTERVAL,
+    now: datetime | None = None,
+) -> bool:
+    now = now or datetime.utcnow()
+    row = connection.execute(
+        "SELECT value FROM schema_meta WHERE key = 'last_analyze'"
+    ).fetchone()
+    if row and datetime.fromisoformat(row[0]) > now - interval:
+        return False
+    connection.execute("ANALYZE")
+    connection.execute(
+        "INSERT OR REPLACE INTO schema_meta (key, value) VALUES ('last_analyze', ?)",
+        [now.isoformat()],
+    )
+    connection.commit()
+    return True
+
+
+def _apply_migration(connection: sqlite3.Connection, migration: Migration) -> None:
+    if connection.in_transaction:
+        connection.commit()
+    outside = migration.batched or migration.no_transaction
+    if outside:
+        _BATCHED_TARGETS[id(connection)] = migration.version
+        try:
+            migration.apply(connection)
+        finally:
+            del _BATCHED_TARGETS[id(connection)]
+
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        # Another connection may have migrated while we waited for the lock.
+        if schema_version(connection) < migration.version:
+            if not outside:
+                migration.apply(connection)
+            _set_version(connection, migration.version)
+    except Exception:
+        connection.rollback()
+        raise
+    connection.commit()
+
+
+@contextmanager
+def _migration_batch(connection: sqlite3.Connection):
+    """Run one chunk of a batched or no_transaction migration under the write lock.
+
+    Yields False when another connection finished the migration in the
+    meantime, so the caller stops instead of redoing its work.
+    """
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        target = _BATCHED_TARGETS.get(id(connection))
+        yield target is None or schema_version(connection) < target
+    except Exception:
+        connection.rollback()
+        raise
+    connection.commit()
+
+
+def _set_version(connection: sqlite3.Connection, version: int) -> None:
+    connection.execute(f"PRAGMA user_version = {int(version)}")
+
+
+def _create_base_schema(connection: sqlite3.Connection) -> None:
     _create_tables(connection)
     _ensure_columns(connection)
-    connection.commit()
 
 
 def _create_tables(connection: sqlite3.Connection) -> None:
@@ -102,18 +218,293 @@ def _ensure_columns(connection: sqlite3.Connection) -> None:
     )
     _add_column_if_missing(connection, "settings", "user_id", "INTEGER NOT NULL DEFAULT 1")
 
+
+def _backfill_created_at(connection: sqlite3.Connection) -> None:
+    now = datetime.utcnow().isoformat()
+    _backfill_in_batches(connection, "users", "created_at", "?", [now])
+    _backfill_in_batches(connection, "habits", "created_at", "?", [now])
+
+    # Legacy log rows carry their real time in `timestamp` or `date`; only fall
+    # back to the migration time when neither is available.
+    sources = []
+    if _column_exists(connection, "habit_logs", "timestamp"):
+        sources.append("NULLIF(timestamp, '')")
+    if _column_exists(connection, "habit_logs", "date"):
+        sources.append("NULLIF(date, '') || 'T00:00:00'")
+    sources.append("?")
+    _backfill_in_batches(
+        connection,
+        "habit_logs",
+        "created_at",
+        f"COALESCE({', '.join(sources)})",
+        [now],
+    )
+
+
+def _backfill_in_batches(
+    connection: sqlite3.Connection,
+    table: str,
+    column: str,
+    expression: str,
+    params: list,
+    batch_size: int | None = None,
+) -> None:
+    batch_size = batch_size or BACKFILL_BATCH_SIZE
+    query = (
+        f"UPDATE {table} SET {column} = {expression} WHERE rowid IN ("
+        f"SELECT rowid FROM {table} WHERE {column} = '' LIMIT ?)"
+    )
+    while True:
+        with _migration_batch(connection) as pending:
+            if not pending:
+                return
+            cursor = connection.execute(query, [*params, batch_size])
+        if cursor.rowcount < batch_size:
+            return
+
+
+def _create_hot_path_indexes(connection: sqlite3.Connection) -> None:
     connection.execute(
-        "UPDATE users SET created_at = ? WHERE created_at = ''",
-        [datetime.utcnow().isoformat()],
+        """
+        CREATE TABLE IF NOT EXISTS schema_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+        """
+    )
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS idx_habit_logs_user_created "
+        "ON habit_logs(user_id, created_at)"
+    )
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS idx_habit_logs_habit_date ON habit_logs(habit_id, date)"
     )
     connection.execute(
-        "UPDATE habits SET created_at = ? WHERE created_at = ''",
-        [datetime.utcnow().isoformat()],
+        "CREATE INDEX IF NOT EXISTS idx_habits_user_active ON habits(user_id) WHERE active = 1"
     )
+
+
+def _add_log_epoch_columns(connection: sqlite3.Connection) -> None:
+    _add_column_if_missing(connection, "habit_logs", "created_ts", "INTEGER")
+    _add_column_if_missing(connection, "habit_logs", "day", "INTEGER")
+    # Keep the canonical columns filled for writers that only set created_at.
     connection.execute(
-        "UPDATE habit_logs SET created_at = ? WHERE created_at = ''",
-        [datetime.utcnow().isoformat()],
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trg_habit_logs_epoch
+        AFTER INSERT ON habit_logs
+        WHEN NEW.created_ts IS NULL
+        BEGIN
+            UPDATE habit_logs
+            SET created_ts = {_epoch_expression("NEW.created_at")},
+                day = {_epoch_expression("NEW.created_at")} / 86400
+            WHERE id = NEW.id;
+        END
+        """
     )
+    connection.execute("DROP INDEX IF EXISTS idx_habit_logs_user_created")
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS idx_habit_logs_user_ts ON habit_logs(user_id, created_ts)"
+    )
+
+
+def _backfill_log_epoch(connection: sqlite3.Connection) -> None:
+    # Walk id ranges rather than "WHERE created_ts IS NULL" so rows whose
+    # created_at cannot be parsed do not keep the loop spinning.
+    last_id = 0
+    while True:
+        with _migration_batch(connection) as pending:
+            if not pending:
+                return
+            upper = connection.execute(
+                "SELECT MAX(id) FROM (SELECT id FROM habit_logs WHERE id > ? ORDER BY id LIMIT ?)",
+                [last_id, BACKFILL_BATCH_SIZE],
+            ).fetchone()[0]
+            if upper is None:
+                return
+            connection.execute(
+                f"""
+                UPDATE habit_logs
+                SET created_ts = {_epoch_expression("created_at")},
+                    day = {_epoch_expression("created_at")} / 86400
+                WHERE id > ? AND id <= ? AND created_ts IS NULL
+                """,
+                [last_id, upper],
+            )
+        last_id = upper
+
+
+def _create_daily_stats(connection: sqlite3.Connection) -> None:
+    create_daily_stats_table(connection)
+    rebuild_daily_stats(connection, source=UNCOMPACTED_LOGS)
+
+
+def _create_streak_state(connection: sqlite3.Connection) -> None:
+    create_streak_table(connection)
+    verify_streaks(connection, repair=True, source=UNCOMPACTED_LOGS)
+
+
+def _create_data_versions(connection: sqlite3.Connection) -> None:
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS user_data_versions (
+            user_id INTEGER PRIMARY KEY,
+            habits_version INTEGER NOT NULL DEFAULT 0
+        )
+        """
+    )
+
+
+def _create_log_archive_catalog(connection: sqlite3.Connection) -> None:
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS log_archives (
+            year INTEGER PRIMARY KEY,
+            path TEXT NOT NULL,
+            min_ts INTEGER,
+            max_ts INTEGER,
+            row_count INTEGER NOT NULL DEFAULT 0
+        )
+        """
+    )
+
+
+def _add_log_summary_columns(connection: sqlite3.Connection) -> None:
+    # Compacted rows stand for event_count events between first_ts and created_ts.
+    _add_column_if_missing(connection, "habit_logs", "event_count", "INTEGER NOT NULL DEFAULT 1")
+    _add_column_if_missing(connection, "habit_logs", "first_ts", "INTEGER")
+
+
+def _add_habit_purges(connection: sqlite3.Connection) -> None:
+    # Runs outside a transaction: SQLite only lets foreign_keys change between
+    # transactions, and habit_logs has to be rebuilt to gain ON DELETE CASCADE.
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS habit_purges (
+            habit_id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            requested_at TEXT NOT NULL,
+            total_logs INTEGER,
+            purged_logs INTEGER NOT NULL DEFAULT 0,
+            finished_at TEXT
+        )
+        """
+    )
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS idx_habit_purges_pending ON habit_purges(habit_id) "
+        "WHERE finished_at IS NULL"
+    )
+    connection.commit()
+    connection.execute("PRAGMA foreign_keys = OFF")
+    try:
+        with _migration_batch(connection) as pending:
+            table_sql = connection.execute(
+                "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'habit_logs'"
+            ).fetchone()[0]
+            if pending and not re.search(CASCADE_REFERENCE, table_sql, re.I):
+                _rebuild_habit_logs(connection, _cascade_habit_logs_sql(table_sql))
+                # Constraints went unchecked while foreign_keys was off; keep the old table on orphans.
+                violations = connection.execute("PRAGMA foreign_key_check(habit_logs)").fetchall()
+                if violations:
+                    raise sqlite3.IntegrityError(
+                        f"{len(violations)} habit_logs rows reference missing habits; "
+                        "remove them before migrating."
+                    )
+    finally:
+        connection.execute("PRAGMA foreign_keys = ON")
+
+
+def _cascade_habit_logs_sql(table_sql: str) -> str:
+    table_sql = re.sub(
+        r"^CREATE\s+TABLE\s+(IF\s+NOT\s+EXISTS\s+)?\"?habit_logs\"?",
+        "CREATE TABLE habit_logs_rebuild",
+        table_sql,
+        flags=re.I,
+    )
+    if re.search(HABITS_REFERENCE, table_sql, re.I):
+        return re.sub(
+            HABITS_REFERENCE, "REFERENCES habits(id) ON DELETE CASCADE", table_sql, flags=re.I
+        )
+    body = table_sql.rstrip().rstrip(")")
+    return f"{body}, FOREIGN KEY(habit_id) REFERENCES habits(id) ON DELETE CASCADE)"
+
+
+def _rebuild_habit_logs(connection: sqlite3.Connection, table_sql: str) -> None:
+    dependents = [
+        row[0]
+        for row in connection.execute(
+            "SELECT sql FROM sqlite_master "
+            "WHERE tbl_name = 'habit_logs' AND type IN ('index', 'trigger') AND sql IS NOT NULL"
+        )
+    ]
+    sequence = None
+    if _table_exists(connection, "sqlite_sequence"):
+        sequence = connection.execute(
+            "SELECT seq FROM sqlite_sequence WHERE name = 'habit_logs'"
+        ).fetchone()
+    columns = ", ".join(row[1] for row in connection.execute("PRAGMA table_info(habit_logs)"))
+
+    connection.execute(table_sql)
+    connection.execute(f"INSERT INTO habit_logs_rebuild ({columns}) SELECT {columns} FROM habit_logs")
+    connection.execute("DROP TABLE habit_logs")
+    connection.execute("ALTER TABLE habit_logs_rebuild RENAME TO habit_logs")
+    for statement in dependents:
+        connection.execute(statement)
+    if sequence is not None:
+        connection.execute("DELETE FROM sqlite_sequence WHERE name = 'habit_logs'")
+        connection.execute(
+            "INSERT INTO sqlite_sequence (name, seq) VALUES ('habit_logs', ?)", [sequence[0]]
+        )
+
+
+def _create_user_shards(connection: sqlite3.Connection) -> None:
+    # Only read on the directory shard (shard 0); see data.database.ShardRouter.
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS user_shards (
+            user_id INTEGER PRIMARY KEY,
+            shard INTEGER NOT NULL
+        )
+        """
+    )
+
+
+def _create_minute_histograms(connection: sqlite3.Connection) -> None:
+    create_minute_histogram_tables(connection)
+    rebuild_minute_histograms(connection)
+
+
+def _add_habit_schedules(connection: sqlite3.Connection) -> None:
+    # Bit 0 of days_mask is Monday, like date.weekday(); see WeekdaySchedule.
+    _add_column_if_missing(connection, "habits", "days", "TEXT")
+    _add_column_if_missing(connection, "habits", "days_mask", f"INTEGER NOT NULL DEFAULT {EVERY_DAY}")
+    # add_habit used to drop "days", so template habits get theirs back by name.
+    template_days = {
+        habit["name"]: habit["days"]
+        for habits in TEMPLATES.values()
+        for habit in habits
+        if habit.get("days")
+    }
+    scheduled = []
+    for habit_id, user_id, name, days in connection.execute(
+        "SELECT id, user_id, name, days FROM habits WHERE frequency = 'weekly'"
+    ).fetchall():
+        try:
+            schedule = WeekdaySchedule.parse("weekly", days or template_days.get(name))
+        except ValueError:
+            continue
+        if schedule.mask == EVERY_DAY:
+            continue
+        connection.execute(
+            "UPDATE habits SET days = ?, days_mask = ? WHERE id = ?",
+            [schedule.days, schedule.mask, habit_id],
+        )
+        scheduled.append((user_id, habit_id))
+    for user_id, habit_id in scheduled:
+        recompute_streaks(connection, user_id, [habit_id])
+
+
+def _epoch_expression(column: str) -> str:
+    return f"CAST(strftime('%s', {column}) AS INTEGER)"
 
 
 def _add_column_if_missing(
@@ -142,9 +533,28 @@ def _column_exists(connection: sqlite3.Connection, table: str, column: str) -> b
     return any(row[1] == column for row in cursor.fetchall())
 
 
+MIGRATIONS = [
+    Migration(1, "base_schema", _create_base_schema),
+    Migration(2, "backfill_created_at", _backfill_created_at, batched=True),
+    Migration(3, "hot_path_indexes", _create_hot_path_indexes),
+    Migration(4, "log_epoch_columns", _add_log_epoch_columns),
+    Migration(5, "backfill_log_epoch", _backfill_log_epoch, batched=True),
+    Migration(6, "habit_daily_stats", _create_daily_stats),
+    Migration(7, "streak_state", _create_streak_state),
+    Migration(8, "user_data_versions", _create_data_versions),
+    Migration(9, "log_archive_catalog", _create_log_archive_catalog),
+    Migration(10, "log_summary_columns", _add_log_summary_columns),
+    Migration(11, "habit_purges", _add_habit_purges, no_transaction=True),
+    Migration(12, "user_shards", _create_user_shards),
+    Migration(13, "minute_histograms", _create_minute_histograms),
+    Migration(14, "habit_schedules", _add_habit_schedules),
+]
+
+
 if __name__ == "__main__":
     from data.database import get_connection
 
     conn = get_connection()
     ensure_schema(conn)
-    print("Migration completed.")
+    analyze_if_due(conn, interval=timedelta(0))
+    print(f"Migration completed (schema version {schema_version(conn)}).")
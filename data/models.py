@@ -1,6 +1,30 @@
 from dataclasses import dataclass
+from datetime import date, datetime, timedelta
 from typing import Optional
 
+# Log times are naive UTC throughout the app; day numbers count whole days
+# since this epoch on the same clock.
+EPOCH = datetime(1970, 1, 1)
+SECONDS_PER_DAY = 86400
+
+
+def epoch_seconds(moment: datetime) -> int:
+    return int((moment - EPOCH).total_seconds())
+
+
+def from_epoch_seconds(seconds: int) -> datetime:
+    return EPOCH + timedelta(seconds=seconds)
+
+
+def day_number(value) -> int:
+    if isinstance(value, datetime):
+        value = value.date()
+    return (value - EPOCH.date()).days
+
+
+def day_from_number(number: int) -> date:
+    return EPOCH.date() + timedelta(days=number)
+
 
 @dataclass
 class Habit:
@@ -10,16 +34,63 @@ class Habit:
     emoji: str
     frequency: str
     days: Optional[str]
+    days_mask: int
     target_count: Optional[int]
     suggested_time: Optional[str]
     reminders_enabled: int
     calendar_sync: int
 
 
-@dataclass
+# Status codes are positions in LOG_STATUSES.
+LOG_STATUSES = ("completed", "skipped", "postponed")
+COMPLETED, SKIPPED, POSTPONED = range(len(LOG_STATUSES))
+STATUS_CODES = {status: code for code, status in enumerate(LOG_STATUSES)}
+# Column order habit_log_factory unpacks; summary columns let it expand compacted rows.
+LOG_RECORD_COLUMNS = ("id", "habit_id", "status", "created_ts", "note", "event_count", "first_ts")
+
+
+@dataclass(frozen=True, slots=True)
 class HabitLog:
-    id: int
-    habit_id: int
-    timestamp: str
-    status: str
-    note: Optional[str]
+    """One log event with its status coded and its time already parsed.
+
+    Supports ``log["timestamp"]`` and ``log["status"]`` so domain code written
+    against dict logs takes records unchanged.
+    """
+
+    id: Optional[int]
+    habit_id: Optional[int]
+    status_code: int
+    timestamp: datetime
+    note: Optional[str] = None
+
+    @property
+    def status(self) -> str:
+        return LOG_STATUSES[self.status_code]
+
+    @property
+    def created_ts(self) -> int:
+        return epoch_seconds(self.timestamp)
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    @classmethod
+    def from_log(cls, log, timestamp: datetime) -> "HabitLog":
+        code = STATUS_CODES[log["status"]]
+        return cls(log.get("id"), log.get("habit_id"), code, timestamp, log.get("note"))
+
+
+def habit_log_factory(cursor, row):
+    """Row factory for queries selecting LOG_RECORD_COLUMNS.
+
+    Returns a HabitLog, or a tuple of them (newest first) for a compacted
+    summary row standing for several events.
+    """
+    log_id, habit_id, status, created_ts, note, event_count, first_ts = row
+    code = STATUS_CODES[status]
+    if not event_count or event_count == 1:
+        return HabitLog(log_id, habit_id, code, EPOCH + timedelta(seconds=created_ts), note)
+    latest = HabitLog(log_id, habit_id, code, EPOCH + timedelta(seconds=created_ts), note)
+    first_ts = created_ts if first_ts is None else first_ts
+    first = HabitLog(log_id, habit_id, code, EPOCH + timedelta(seconds=first_ts), note)
+    return (latest,) * (event_count - 1) + (first,)
@@ -0,0 +1,226 @@
+from __future__ import annotations
+
+import logging
+import sqlite3
+import threading
+from datetime import datetime
+
+from data.archive import archive_groups
+from data.database import connection_source
+from data.instrumentation import run_query
+
+PURGE_CHUNK_SIZE = 500
+# Pause between chunks so queued writers get the lock in between.
+PURGE_PAUSE = 0.05
+PURGE_POLL_INTERVAL = 2.0
+# Longest wait after repeated failures; each failure in a row doubles the poll interval.
+PURGE_MAX_BACKOFF = 60.0
+
+PURGE_LOGS_CHUNK_QUERY = (
+    "DELETE FROM {table} WHERE id IN (SELECT id FROM {table} WHERE habit_id = ? LIMIT ?)"
+)
+PENDING_PURGES_QUERY = (
+    "SELECT habit_id FROM habit_purges WHERE finished_at IS NULL ORDER BY requested_at, habit_id"
+)
+
+logger = logging.getLogger(__name__)
+
+
+class HabitPurger:
+    """Removes the logs of soft-deleted habits in small transactions.
+
+    HabitRepository.delete_habit only flips ``active`` and queues a row in
+    habit_purges. The purger deletes at most ``chunk_size`` logs per transaction,
+    then drops the habit row itself; ON DELETE CASCADE catches anything logged
+    after the purge started.
+    """
+
+    def __init__(
+        self,
+        connection=None,
+        chunk_size=PURGE_CHUNK_SIZE,
+        pause=PURGE_PAUSE,
+        poll_interval=PURGE_POLL_INTERVAL,
+        max_backoff=PURGE_MAX_BACKOFF,
+    ):
+        self.connections = connection_source(connection)
+        self.chunk_size = chunk_size
+        self.pause = pause
+        self.poll_interval = poll_interval
+        self.max_backoff = max_backoff
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.last_error = None
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="habit-purger", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def wake(self):
+        self._wake.set()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def run_pending(self, max_chunks=None):
+        """Purge queued habits until done or ``max_chunks`` chunks ran; return chunks run."""
+        chunks = 0
+        for habit_id in self._pending():
+            done = False
+            while not done:
+                if self._stop.is_set() or (max_chunks is not None and chunks >= max_chunks):
+                    return chunks
+                done = self.purge_chunk(habit_id)
+                chunks += 1
+                if not done and self.pause:
+                    self._stop.wait(self.pause)
+        return chunks
+
+    def purge_chunk(self, habit_id):
+        """Delete one chunk of a queued habit's logs; return True once it is gone."""
+        with self.connections.connection() as connection:
+            purge = run_query(
+                connection,
+                "SELECT user_id, total_logs, finished_at FROM habit_purges WHERE habit_id = ?",
+                [habit_id],
+                fetch="one",
+            )
+            if purge is None or purge[2] is not None:
+                return True
+            user_id, total = purge[0], purge[1]
+            if total is None:
+                total = sum(
+                    self._count(connection, table, habit_id) for table in self._log_tables(connection)
+                )
+                with self.connections.transaction():
+                    run_query(
+                        connection,
+                        "UPDATE habit_purges SET total_logs = ? WHERE habit_id = ?",
+                        [total, habit_id],
+                    )
+
+            deleted = 0
+            # Archives are attached a group at a time, so delete table by table.
+            for table in self._log_tables(connection):
+                with self.connections.transaction():
+                    cursor = run_query(
+                        connection,
+                        PURGE_LOGS_CHUNK_QUERY.format(table=table),
+                        [habit_id, self.chunk_size - deleted],
+                    )
+                    run_query(
+                        connection,
+                        "UPDATE habit_purges SET purged_logs = MIN(purged_logs + ?, COALESCE(total_logs, 0)) "
+                        "WHERE habit_id = ?",
+                        [cursor.rowcount, habit_id],
+                    )
+                deleted += cursor.rowcount
+                if deleted >= self.chunk_size:
+                    return False
+
+            with self.connections.transaction():
+                # Logs written after the purge began go with the habit row.
+                run_query(connection, "DELETE FROM habits WHERE id = ?", [habit_id])
+                run_query(
+                    connection,
+                    "DELETE FROM habit_daily_stats WHERE user_id = ? AND habit_id = ?",
+                    [user_id, habit_id],
+                )
+                run_query(
+                    connection,
+                    "DELETE FROM streak_state WHERE user_id = ? AND habit_id = ?",
+                    [user_id, habit_id],
+                )
+                run_query(
+                    connection,
+                    "DELETE FROM minute_histograms WHERE user_id = ? AND habit_id = ?",
+                    [user_id, habit_id],
+                )
+                run_query(
+                    connection,
+                    "UPDATE habit_purges SET finished_at = ? WHERE habit_id = ?",
+                    [datetime.utcnow().isoformat(), habit_id],
+                )
+            return True
+
+    def _log_tables(self, connection):
+        yield "main.habit_logs"
+        for schemas in archive_groups(connection):
+            yield from (f"{schema}.habit_logs" for schema in schemas)
+
+    def _count(self, connection, table, habit_id):
+        query = f"SELECT COUNT(*) FROM {table} WHERE habit_id = ?"
+        return run_query(connection, query, [habit_id], fetch="one")[0]
+
+    def progress(self, habit_id):
+        """Return status ('pending', 'purging' or 'done') and log counts for one habit."""
+        with self.connections.connection(readonly=True) as connection:
+            row = run_query(
+                connection,
+                "SELECT total_logs, purged_logs, finished_at FROM habit_purges WHERE habit_id = ?",
+                [habit_id],
+                fetch="one",
+            )
+        if row is None:
+            return None
+        total, purged, finished_at = row[0], row[1], row[2]
+        if finished_at is not None:
+            status = "done"
+        elif total is None:
+            status = "pending"
+        else:
+            status = "purging"
+        fraction = 1.0 if status == "done" else (purged / total if total else 0.0)
+        return {
+            "habit_id": habit_id,
+            "status": status,
+            "total_logs": total,
+            "purged_logs": purged,
+            "fraction": fraction,
+            "finished_at": finished_at,
+        }
+
+    def _pending(self):
+        with self.connections.connection(readonly=True) as connection:
+            return [row[0] for row in run_query(connection, PENDING_PURGES_QUERY, fetch="all")]
+
+    def _run(self):
+        failures = 0
+        while not self._stop.is_set():
+            try:
+                self.run_pending()
+                self.last_error = None
+                failures = 0
+            except sqlite3.OperationalError as error:
+                # Usually a busy database; the next poll picks the purge back up.
+                self.last_error = error
+                failures += 1
+            except Exception as error:
+                # Keep the purger alive whatever happens; the purge stays queued.
+                logger.exception("Habit purge failed")
+                self.last_error = error
+                failures += 1
+            if failures:
+                # Back off so a purge that keeps failing doesn't spin against the database.
+                self._stop.wait(min(self.poll_interval * 2 ** (failures - 1), self.max_backoff))
+            else:
+                self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+
+if __name__ == "__main__":
+    purger = HabitPurger()
+    chunks = purger.run_pending()
+    print(f"Ran {chunks} purge chunks.")
@@ -1,135 +1,602 @@
-from datetime import date, datetime
-
-from data.database import init_db
+import json
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+
+from data.archive import attach_archives, log_source
+from data.compaction import expand_summary
+from data.database import ShardRouter, connection_source, source_for
+from data.histograms import apply_minute_histograms, load_minute_histogram, remove_habit_histogram
+from data.instrumentation import run_many, run_query
+from data.models import (
+    LOG_RECORD_COLUMNS,
+    LOG_STATUSES,
+    HabitLog,
+    day_number,
+    epoch_seconds,
+    from_epoch_seconds,
+    habit_log_factory,
+)
+from data.purge import PURGE_LOGS_CHUNK_QUERY
+from data.rollups import apply_daily_stats, merge_daily_stats, rebuild_daily_stats
+from data.streaks import (
+    USER_SCOPE,
+    apply_streaks,
+    pending_streak_states,
+    recompute_streaks,
+    verify_streaks,
+    week_start,
+)
 from data.seed import TEMPLATES
+from domain.logic import EVERY_DAY, WeekdaySchedule
 
 LEGACY_USER_EMAIL = "legacy@miniwins.local"
 
+HABIT_INSERT_COLUMNS = (
+    "user_id",
+    "name",
+    "category",
+    "emoji",
+    "frequency",
+    "days",
+    "days_mask",
+    "active",
+    "suggested_time",
+    "created_at",
+)
+LOG_INSERT_COLUMNS = (
+    "habit_id",
+    "user_id",
+    "status",
+    "date",
+    "created_at",
+    "timestamp",
+    "created_ts",
+    "day",
+)
+USER_INSERT_COLUMNS = ("email", "password_hash", "created_at")
+REQUIRED_INSERT_COLUMNS = {"habits": ("user_id", "name"), "users": ("email", "password_hash")}
+
+USER_CACHE_SIZE = 256
+LOG_PAGE_SIZE = 500
+LOG_KEY_COLUMNS = ("id", "created_ts", "day")
+LOG_SUMMARY_COLUMNS = ("event_count", "first_ts")
+
+LOG_INSERTED = "inserted"
+LOG_INVALID = "invalid"
+LOG_UNKNOWN_HABIT = "unknown_habit"
+LOG_FORBIDDEN = "forbidden"
+
+LIST_HABITS_QUERY = "SELECT * FROM habits WHERE user_id = ? AND active = 1 ORDER BY id DESC"
+LIST_DUE_HABITS_QUERY = (
+    "SELECT * FROM habits WHERE user_id = ? AND active = 1 AND days_mask & ? != 0 ORDER BY id DESC"
+)
+STREAK_STATE_QUERY = (
+    f"SELECT streak_state.*, COALESCE(habits.days_mask, {EVERY_DAY}) AS days_mask FROM streak_state "
+    "LEFT JOIN habits ON habits.id = streak_state.habit_id AND habits.user_id = streak_state.user_id "
+)
+LOGGABLE_HABITS_QUERY = (
+    "SELECT id, user_id FROM habits WHERE id IN (SELECT value FROM json_each(?)) "
+    "AND id NOT IN (SELECT habit_id FROM habit_purges)"
+)
+# Log reads name their table as {source} so they can span attached archives.
+# Logs of habits still waiting for the purger are hidden from every read.
+LIVE_LOGS_SOURCE = (
+    "(SELECT * FROM {source} WHERE habit_id NOT IN "
+    "(SELECT habit_id FROM habit_purges WHERE finished_at IS NULL))"
+)
+LIST_LOGS_QUERY = "SELECT * FROM {source} WHERE user_id = ? ORDER BY created_ts DESC, id DESC"
+LIST_LOGS_SINCE_QUERY = (
+    "SELECT * FROM {source} WHERE user_id = ? AND created_ts >= ? "
+    "ORDER BY created_ts DESC, id DESC"
+)
+
+# Hot queries and the index each one is expected to search; see check_index_usage.
+HOT_PATH_INDEXES = {
+    "list_habits": (LIST_HABITS_QUERY, [0], "idx_habits_user_active"),
+    "list_today_habits": (LIST_DUE_HABITS_QUERY, [0, 1], "idx_habits_user_active"),
+    "purge_habit_logs": (
+        PURGE_LOGS_CHUNK_QUERY.format(table="habit_logs"),
+        [0, 0],
+        "idx_habit_logs_habit_date",
+    ),
+    "list_all_logs": (LIST_LOGS_QUERY, [0], "idx_habit_logs_user_ts"),
+    "list_logs_since": (LIST_LOGS_SINCE_QUERY, [0, 0], "idx_habit_logs_user_ts"),
+}
+
+
+class SchemaDescriptor:
+    def __init__(self, tables):
+        self.tables = {table: frozenset(columns) for table, columns in tables.items()}
+        self._inserts = {}
+
+    @classmethod
+    def load(cls, connection):
+        names = [
+            row[0]
+            for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        ]
+        tables = {}
+        for name in names:
+            tables[name] = [row[1] for row in connection.execute(f"PRAGMA table_info({name})")]
+        return cls(tables)
+
+    def has_column(self, table, column):
+        return column in self.tables.get(table, ())
+
+    def insert_statement(self, table, candidates):
+        key = (table, candidates)
+        statement = self._inserts.get(key)
+        if statement is None:
+            required = REQUIRED_INSERT_COLUMNS.get(table, ())
+            columns = tuple(
+                column
+                for column in candidates
+                if column in required or self.has_column(table, column)
+            )
+            placeholders = ", ".join(["?"] * len(columns))
+            sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})"
+            statement = (columns, sql)
+            self._inserts[key] = statement
+        return statement
+
+
+def schema_for(connection):
+    descriptor = getattr(connection, "schema_descriptor", None)
+    if descriptor is None:
+        descriptor = SchemaDescriptor.load(connection)
+        if hasattr(connection, "schema_descriptor"):
+            connection.schema_descriptor = descriptor
+    return descriptor
+
+
+class UserCache:
+    """Per-user values, bounded by least recent use."""
+
+    def __init__(self, maxsize=USER_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            values = self._users.get(user_id)
+            if values is not None:
+                self._users.move_to_end(user_id)
+            return values
+
+    def put(self, user_id, values):
+        with self._lock:
+            self._users[user_id] = values
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.maxsize:
+                self._users.popitem(last=False)
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self._users.clear()
+            else:
+                self._users.pop(user_id, None)
+
+
+class SettingsCache(UserCache):
+    def update(self, user_id, values):
+        with self._lock:
+            cached = self._users.get(user_id)
+            if cached is not None:
+                self._users[user_id] = {**cached, **values}
+
+
+class HabitListCache(UserCache):
+    """Habit list snapshots stored alongside the data version they were read at."""
+
+    def snapshot(self, user_id, version):
+        cached = self.get(user_id)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        return None
+
 
 class HabitRepository:
-    def __init__(self, connection=None):
-        self.connection = self._resolve_connection(connection)
+    def __init__(self, connection=None, habit_cache=None, log_queue=None):
+        self.connections = self._resolve_connection(connection)
+        self.schema = None
+        self.habit_cache = habit_cache if habit_cache is not None else HabitListCache()
+        # Optional data.write_behind.LogWriteQueue taking over log_action writes.
+        self.log_queue = log_queue
 
     def seed_template(self, user_id, template_key):
-        for habit in TEMPLATES.get(template_key, []):
-            self.add_habit(user_id, habit)
+        with self.transaction(user_id=user_id):
+            for habit in TEMPLATES.get(template_key, []):
+                self.add_habit(user_id, habit)
 
     def add_habit(self, user_id, habit):
-        columns = ["user_id", "name"]
-        values = [user_id, habit["name"]]
-
-        if self._column_exists("habits", "category"):
-            columns.append("category")
-            values.append(habit.get("category"))
-        if self._column_exists("habits", "emoji"):
-            columns.append("emoji")
-            values.append(habit.get("emoji") or "✨")
-        if self._column_exists("habits", "frequency"):
-            columns.append("frequency")
-            values.append(habit.get("frequency", "daily"))
-        if self._column_exists("habits", "active"):
-            columns.append("active")
-            values.append(int(habit.get("active", True)))
-        if self._column_exists("habits", "suggested_time"):
-            columns.append("suggested_time")
-            values.append(habit.get("suggested_time"))
-        if self._column_exists("habits", "created_at"):
-            columns.append("created_at")
-            values.append(datetime.utcnow().isoformat())
-
-        placeholders = ", ".join(["?"] * len(columns))
-        self._execute(
-            f"INSERT INTO habits ({', '.join(columns)}) VALUES ({placeholders})",
-            values,
-        )
-
-    def list_today_habits(self, user_id):
-        return self.list_habits(user_id)
+        frequency = habit.get("frequency", "daily")
+        schedule = WeekdaySchedule.parse(frequency, habit.get("days"))
+        row = {
+            "user_id": user_id,
+            "name": habit["name"],
+            "category": habit.get("category"),
+            "emoji": habit.get("emoji") or "✨",
+            "frequency": frequency,
+            "days": schedule.days if schedule.mask != EVERY_DAY else None,
+            "days_mask": schedule.mask,
+            "active": int(habit.get("active", True)),
+            "suggested_time": habit.get("suggested_time"),
+            "created_at": datetime.utcnow().isoformat(),
+        }
+        columns, query = self._schema().insert_statement("habits", HABIT_INSERT_COLUMNS)
+        with self.transaction(user_id=user_id):
+            self._execute(query, [row[column] for column in columns], user_id=user_id)
+            self._bump_habits_version(user_id)
+
+    def list_today_habits(self, user_id, today=None):
+        """Active habits due today, in one query on idx_habits_user_active."""
+        weekday = (today or datetime.utcnow().date()).weekday()
+        rows = self._fetchall(LIST_DUE_HABITS_QUERY, [user_id, 1 << weekday], user_id=user_id)
+        return [dict(row) for row in rows]
 
     def list_habits(self, user_id):
-        return [
-            dict(row)
-            for row in self._fetchall(
-                "SELECT * FROM habits WHERE user_id = ? ORDER BY id DESC",
-                [user_id],
+        version = self.habits_version(user_id)
+        snapshot = self.habit_cache.snapshot(user_id, version)
+        if snapshot is None:
+            snapshot = tuple(
+                dict(row) for row in self._fetchall(LIST_HABITS_QUERY, [user_id], user_id=user_id)
             )
-        ]
+            self.habit_cache.put(user_id, (version, snapshot))
+        return [dict(habit) for habit in snapshot]
+
+    def habits_version(self, user_id):
+        row = self._fetchone(
+            "SELECT habits_version FROM user_data_versions WHERE user_id = ?",
+            [user_id],
+            user_id=user_id,
+        )
+        return row["habits_version"] if row else 0
 
     def delete_habit(self, habit_id, user_id=None):
-        self._execute("DELETE FROM habit_logs WHERE habit_id = ?", [habit_id])
-        self._execute("DELETE FROM habits WHERE id = ?", [habit_id])
+        """Hide a habit at once and queue its logs for the HabitPurger."""
+        self._require_user_under_router(user_id)
+        with self.transaction(user_id=user_id) as connection:
+            habit = run_query(connection, "SELECT user_id FROM habits WHERE id = ?", [habit_id], fetch="one")
+            if habit is None:
+                return
+            if user_id is None:
+                user_id = habit["user_id"]
+            run_query(connection, "UPDATE habits SET active = 0 WHERE id = ?", [habit_id])
+            run_query(
+                connection,
+                "INSERT OR IGNORE INTO habit_purges (habit_id, user_id, requested_at) VALUES (?, ?, ?)",
+                [habit_id, user_id, datetime.utcnow().isoformat()],
+            )
+            run_query(
+                connection,
+                "DELETE FROM habit_daily_stats WHERE user_id = ? AND habit_id = ?",
+                [user_id, habit_id],
+            )
+            run_query(
+                connection, "DELETE FROM streak_state WHERE user_id = ? AND habit_id = ?", [user_id, habit_id]
+            )
+            remove_habit_histogram(connection, user_id, habit_id)
+            recompute_streaks(connection, user_id, [USER_SCOPE])
+            self._bump_habits_version(user_id)
 
     def log_action(self, habit_id, status, note=None, user_id=None):
+        self._require_user_under_router(user_id)
+        if status not in LOG_STATUSES:
+            raise ValueError(f"Unknown log status: {status}")
         if user_id is None:
             habit = self._fetchone("SELECT user_id FROM habits WHERE id = ?", [habit_id])
             if not habit:
                 return
             user_id = habit["user_id"]
 
-        action_time = datetime.utcnow()
-        date_value = action_time.date().isoformat()
-        created_at_value = action_time.isoformat()
-
-        columns = []
-        values = []
-        if self._column_exists("habit_logs", "habit_id"):
-            columns.append("habit_id")
-            values.append(habit_id)
-        if self._column_exists("habit_logs", "user_id"):
-            columns.append("user_id")
-            values.append(user_id)
-        if self._column_exists("habit_logs", "status"):
-            columns.append("status")
-            values.append(status)
-        if self._column_exists("habit_logs", "date"):
-            columns.append("date")
-            values.append(date_value)
-        if self._column_exists("habit_logs", "created_at"):
-            columns.append("created_at")
-            values.append(created_at_value)
-        if self._column_exists("habit_logs", "timestamp"):
-            columns.append("timestamp")
-            values.append(created_at_value)
-        if note is not None and self._column_exists("habit_logs", "note"):
-            columns.append("note")
-            values.append(note)
-
-        placeholders = ", ".join(["?"] * len(columns))
-        self._execute(
-            f"INSERT INTO habit_logs ({', '.join(columns)}) VALUES ({placeholders})",
-            values,
+        row = self._log_row(habit_id, user_id, status, datetime.utcnow(), note)
+        if self.log_queue is not None:
+            self.log_queue.put(row)
+            return
+        candidates = LOG_INSERT_COLUMNS if note is None else LOG_INSERT_COLUMNS + ("note",)
+        columns, query = self._schema().insert_statement("habit_logs", candidates)
+        with self.transaction(user_id=user_id) as connection:
+            run_query(connection, query, [row[column] for column in columns])
+            apply_daily_stats(connection, [row])
+            apply_streaks(connection, [row])
+            apply_minute_histograms(connection, [row])
+
+    def log_actions_bulk(self, records, user_id=None):
+        self._require_user_under_router(user_id)
+        records = list(records)
+        habit_ids = sorted({record[0] for record in records})
+        owners = {
+            row["id"]: row["user_id"]
+            for row in self._fetchall(
+                LOGGABLE_HABITS_QUERY,
+                [json.dumps(habit_ids)],
+                user_id=user_id,
+            )
+        }
+
+        outcomes = []
+        rows = []
+        for habit_id, status, timestamp, note in records:
+            owner = owners.get(habit_id)
+            action_time = self._parse_action_time(timestamp)
+            if status not in LOG_STATUSES or action_time is None:
+                outcomes.append(LOG_INVALID)
+            elif owner is None:
+                outcomes.append(LOG_UNKNOWN_HABIT)
+            elif user_id is not None and owner != user_id:
+                outcomes.append(LOG_FORBIDDEN)
+            else:
+                outcomes.append(LOG_INSERTED)
+                rows.append(self._log_row(habit_id, owner, status, action_time, note))
+
+        if rows:
+            columns, query = self._schema().insert_statement(
+                "habit_logs", LOG_INSERT_COLUMNS + ("note",)
+            )
+            with self.transaction(user_id=user_id) as connection:
+                run_many(connection, query, ([row[column] for column in columns] for row in rows))
+                apply_daily_stats(connection, rows)
+                apply_streaks(connection, rows)
+                apply_minute_histograms(connection, rows)
+        return outcomes
+
+    def write_log_rows(self, rows, skip_existing=False):
+        """Insert rows built by _log_row in one transaction per shard; return rows written.
+
+        Rows of habits that were deleted meanwhile, or that the row's user does
+        not own, are dropped; a row with an unknown status fails the call.
+        ``skip_existing`` also drops rows already stored, for replaying a
+        write-behind journal.
+        """
+        batches = {}
+        for row in rows:
+            if row["status"] not in LOG_STATUSES:
+                raise ValueError(f"Unknown log status: {row['status']}")
+            source = self._source(row["user_id"])
+            batches.setdefault(id(source), (source, []))[1].append(row)
+        columns, query = self._schema().insert_statement("habit_logs", LOG_INSERT_COLUMNS + ("note",))
+        written = 0
+        for source, batch in batches.values():
+            with source.transaction() as connection:
+                habit_ids = json.dumps(sorted({row["habit_id"] for row in batch}))
+                # Like log_action, a row only lands on a live habit its user owns.
+                loggable = {
+                    (habit["id"], habit["user_id"])
+                    for habit in run_query(connection, LOGGABLE_HABITS_QUERY, [habit_ids], fetch="all")
+                }
+                batch = [row for row in batch if (row["habit_id"], row["user_id"]) in loggable]
+                if skip_existing:
+                    batch = [
+                        row
+                        for row in batch
+                        if run_query(
+                            connection,
+                            "SELECT 1 FROM habit_logs WHERE habit_id = ? AND created_at = ? AND status = ?",
+                            [row["habit_id"], row["created_at"], row["status"]],
+                            fetch="one",
+                        )
+                        is None
+                    ]
+                if not batch:
+                    continue
+                run_many(connection, query, ([row[column] for column in columns] for row in batch))
+                apply_daily_stats(connection, batch)
+                apply_streaks(connection, batch)
+                apply_minute_histograms(connection, batch)
+                written += len(batch)
+        return written
+
+    def get_streak(self, user_id, habit_id=USER_SCOPE, today=None):
+        def read(pending):
+            row = self._fetchone(
+                f"{STREAK_STATE_QUERY} WHERE streak_state.user_id = ? AND streak_state.habit_id = ?",
+                [user_id, habit_id],
+                user_id=user_id,
+            )
+            state = self._pending_streak_states(user_id, pending).get(habit_id)
+            return row if state is None else {**(dict(row) if row else {}), **state}
+
+        return self._streak_view(self._read_consistent(user_id, read), today)
+
+    def list_habit_streaks(self, user_id, today=None):
+        def read(pending):
+            rows = {
+                row["habit_id"]: row
+                for row in self._fetchall(
+                    f"{STREAK_STATE_QUERY} WHERE streak_state.user_id = ? AND streak_state.habit_id != ?",
+                    [user_id, USER_SCOPE],
+                    user_id=user_id,
+                )
+            }
+            for scope, state in self._pending_streak_states(user_id, pending).items():
+                if scope != USER_SCOPE:
+                    rows[scope] = {**(dict(rows[scope]) if scope in rows else {}), **state}
+            return rows
+
+        rows = self._read_consistent(user_id, read)
+        return {habit_id: self._streak_view(row, today) for habit_id, row in rows.items()}
+
+    def has_wildcard(self, user_id, today=None):
+        def read(pending):
+            row = self._fetchone(
+                "SELECT wildcard_week, wildcards_used FROM streak_state WHERE user_id = ? AND habit_id = ?",
+                [user_id, USER_SCOPE],
+                user_id=user_id,
+            )
+            return self._pending_streak_states(user_id, pending).get(USER_SCOPE, row)
+
+        row = self._read_consistent(user_id, read)
+        if row is None or row["wildcard_week"] is None:
+            return True
+        this_week = week_start(day_number(today or datetime.utcnow().date()))
+        return row["wildcard_week"] < this_week or row["wildcards_used"] < 1
+
+    def minute_histogram(self, user_id, habit_id=USER_SCOPE):
+        """Recency-weighted completions by minute of day; see data.histograms."""
+
+        def read(pending):
+            with self._source(user_id).connection(readonly=True) as connection:
+                return load_minute_histogram(connection, user_id, habit_id, pending)
+
+        return self._read_consistent(user_id, read)
+
+    def verify_streaks(self, user_id=None, repair=False):
+        mismatches = []
+        for connections in self._sources(user_id):
+            with connections.connection() as connection:
+                source = self._live_log_source(connection, user_id=user_id)
+                with connections.transaction():
+                    mismatches += verify_streaks(connection, user_id, repair=repair, source=source)
+        return sorted(mismatches)
+
+    def list_daily_stats(self, user_id, since=None):
+        query = "SELECT * FROM habit_daily_stats WHERE user_id = ?"
+        params = [user_id]
+        if since is not None:
+            since_datetime = self._normalize_since_datetime(since)
+            if since_datetime is None:
+                return []
+            query += " AND day >= ?"
+            params.append(day_number(since_datetime))
+        rows, pending = self._read_with_pending(
+            user_id, lambda: self._fetchall(f"{query} ORDER BY day", params, user_id=user_id)
         )
+        if not pending:
+            return [dict(row) for row in rows]
+        return merge_daily_stats(rows, pending, params[1] if since is not None else None)
+
+    def rebuild_daily_stats(self, user_id=None):
+        rebuilt = 0
+        for connections in self._sources(user_id):
+            with connections.connection() as connection:
+                source = self._live_log_source(connection, user_id=user_id)
+                with connections.transaction():
+                    rebuilt += rebuild_daily_stats(connection, user_id, source=source)
+        return rebuilt
 
     def list_all_logs(self, user_id):
         order_column = self._log_order_column()
+        if order_column == "created_ts":
+            rows, pending = self._read_with_pending(
+                user_id, lambda: self._fetchall_logs(LIST_LOGS_QUERY, [user_id], user_id=user_id)
+            )
+            return self._pending_logs(pending) + self._expand_logs(rows)
         query = f"SELECT * FROM habit_logs WHERE user_id = ? ORDER BY {order_column} DESC"
-        return [
-            self._normalize_log(dict(row))
-            for row in self._fetchall(query, [user_id])
-        ]
+        return self._expand_logs(self._fetchall(query, [user_id], user_id=user_id))
+
+    def iter_logs(self, user_id, since=None, until=None, page_size=LOG_PAGE_SIZE, columns=None):
+        projection = self._log_projection(columns)
+        yield from self._iter_log_pages(user_id, since, until, page_size, projection, columns)
+
+    def iter_log_records(self, user_id, since=None, until=None, page_size=LOG_PAGE_SIZE):
+        """Like iter_logs, but yields immutable HabitLog records built by the cursor."""
+        schema = self._schema()
+        # habit_log_factory unpacks by position, so optional columns are selected as NULL.
+        projection = ", ".join(
+            column if schema.has_column("habit_logs", column) else f"NULL AS {column}"
+            for column in LOG_RECORD_COLUMNS
+        )
+        yield from self._iter_log_pages(user_id, since, until, page_size, projection, records=True)
+
+    def _iter_log_pages(self, user_id, since, until, page_size, projection, columns=None, records=False):
+        conditions = ["user_id = ?"]
+        params = [user_id]
+        if records:
+            # HabitLog needs a known status and a time; legacy rows lacking either are left out.
+            placeholders = ", ".join("?" for _ in LOG_STATUSES)
+            conditions.append(f"status IN ({placeholders}) AND created_ts IS NOT NULL")
+            params.extend(LOG_STATUSES)
+        since_ts = until_ts = None
+        if since is not None:
+            since_datetime = self._normalize_since_datetime(since)
+            if since_datetime is None:
+                return
+            since_ts = epoch_seconds(since_datetime)
+            conditions.append("created_ts >= ?")
+            params.append(since_ts)
+        if until is not None:
+            until_datetime = self._normalize_since_datetime(until)
+            if until_datetime is None:
+                return
+            until_ts = epoch_seconds(until_datetime)
+            conditions.append("created_ts < ?")
+            params.append(until_ts)
+
+        base_query = f"SELECT {projection} FROM {{source}} WHERE {' AND '.join(conditions)}"
+        first_page = f"{base_query} ORDER BY created_ts DESC, id DESC LIMIT ?"
+        next_page = (
+            f"{base_query} AND (created_ts < ? OR (created_ts = ? AND id < ?)) "
+            "ORDER BY created_ts DESC, id DESC LIMIT ?"
+        )
+        row_factory = habit_log_factory if records else None
+        rows, pending = self._read_with_pending(
+            user_id,
+            lambda: self._fetchall_logs(
+                first_page,
+                [*params, page_size],
+                since_ts,
+                until_ts,
+                user_id=user_id,
+                row_factory=row_factory,
+            ),
+        )
+        # Queued events are stamped when logged, so they sort ahead of stored ones.
+        if records:
+            yield from self._pending_records(pending, since_ts, until_ts)
+        else:
+            yield from self._pending_logs(pending, since_ts, until_ts, columns)
+        while rows:
+            if records:
+                yield from self._expand_records(rows)
+                # A summary tuple starts with its newest event, which carries the row's key.
+                last = rows[-1] if type(rows[-1]) is HabitLog else rows[-1][0]
+                key = [last.created_ts, last.created_ts, last.id]
+            else:
+                yield from self._expand_logs(rows)
+                last = rows[-1]
+                key = [last["created_ts"], last["created_ts"], last["id"]]
+            if len(rows) < page_size:
+                return
+            rows = self._fetchall_logs(
+                next_page,
+                [*params, *key, page_size],
+                since_ts,
+                until_ts,
+                user_id=user_id,
+                row_factory=row_factory,
+            )
+
+    def list_log_window(self, user_id, days, today=None, columns=None):
+        today = today or datetime.utcnow().date()
+        since = today - timedelta(days=days - 1)
+        return list(self.iter_logs(user_id, since=since, columns=columns))
 
     def list_logs_since(self, user_id, since_dt):
         since_datetime = self._normalize_since_datetime(since_dt)
         if since_datetime is None:
             return []
 
-        has_created_at = self._column_exists("habit_logs", "created_at")
-        has_timestamp = self._column_exists("habit_logs", "timestamp")
-        has_date = self._column_exists("habit_logs", "date")
+        schema = self._schema()
+        has_created_ts = schema.has_column("habit_logs", "created_ts")
+        has_timestamp = schema.has_column("habit_logs", "timestamp")
+        has_date = schema.has_column("habit_logs", "date")
         since_iso = since_datetime.isoformat()
         since_date = since_datetime.date().isoformat()
 
-        if has_created_at and has_timestamp:
-            query = (
-                "SELECT * FROM habit_logs WHERE user_id = ? AND "
-                "((created_at != '' AND created_at >= ?) OR (created_at == '' AND timestamp >= ?)) "
-                "ORDER BY COALESCE(NULLIF(created_at, ''), timestamp) DESC"
+        if has_created_ts:
+            since_ts = epoch_seconds(since_datetime)
+            rows, pending = self._read_with_pending(
+                user_id,
+                lambda: self._fetchall_logs(
+                    LIST_LOGS_SINCE_QUERY, [user_id, since_ts], since_ts, user_id=user_id
+                ),
             )
-            params = [user_id, since_iso, since_iso]
-        elif has_created_at:
-            query = "SELECT * FROM habit_logs WHERE user_id = ? AND created_at >= ? ORDER BY created_at DESC"
-            params = [user_id, since_iso]
-        elif has_timestamp:
+            return self._pending_logs(pending, since_ts) + self._expand_logs(rows)
+        if has_timestamp:
             query = "SELECT * FROM habit_logs WHERE user_id = ? AND timestamp >= ? ORDER BY timestamp DESC"
             params = [user_id, since_iso]
         elif has_date:
@@ -138,37 +605,74 @@ class HabitRepository:
         else:
             return []
 
-        return [self._normalize_log(dict(row)) for row in self._fetchall(query, params)]
+        rows = self._fetchall(query, params, user_id=user_id)
+        return [self._normalize_log(dict(row)) for row in rows]
+
+    @contextmanager
+    def transaction(self, savepoint=False, user_id=None):
+        try:
+            with self._source(user_id).transaction(savepoint=savepoint) as connection:
+                yield connection
+        except BaseException:
+            # A habit list read inside the block may be cached under a version that was rolled back.
+            self.habit_cache.invalidate(user_id)
+            raise
+
+    def _execute(self, query, params=None, user_id=None):
+        with self._source(user_id).transaction() as connection:
+            return run_query(connection, query, params)
+
+    def _fetchall(self, query, params=None, user_id=None):
+        with self._source(user_id).connection(readonly=True) as connection:
+            return run_query(connection, query, params, fetch="all")
+
+    def _fetchall_logs(self, query, params, since_ts=None, until_ts=None, user_id=None, row_factory=None):
+        # Archives are only attached when [since_ts, until_ts) reaches into them.
+        with self._source(user_id).connection(readonly=True) as connection:
+            source = self._live_log_source(connection, since_ts, until_ts, user_id)
+            return run_query(
+                connection, query.format(source=source), params, fetch="all", row_factory=row_factory
+            )
 
-    def _execute(self, query, params=None):
-        cursor = self.connection.cursor()
-        cursor.execute(query, params or [])
-        self.connection.commit()
-        return cursor
+    def _live_log_source(self, connection, since_ts=None, until_ts=None, user_id=None):
+        archives = attach_archives(connection, since_ts, until_ts, user_id)
+        return LIVE_LOGS_SOURCE.format(source=log_source(connection, archives))
 
-    def _fetchall(self, query, params=None):
-        cursor = self.connection.cursor()
-        cursor.execute(query, params or [])
-        return cursor.fetchall()
+    def _fetchone(self, query, params=None, user_id=None):
+        with self._source(user_id).connection(readonly=True) as connection:
+            return run_query(connection, query, params, fetch="one")
 
-    def _fetchone(self, query, params=None):
-        cursor = self.connection.cursor()
-        cursor.execute(query, params or [])
-        return cursor.fetchone()
+    def _schema(self):
+        with self.connections.connection() as connection:
+            if self.schema is None or hasattr(connection, "schema_descriptor"):
+                self.schema = schema_for(connection)
+        return self.schema
+
+    def _source(self, user_id=None):
+        return source_for(self.connections, user_id)
+
+    def _sources(self, user_id=None):
+        if user_id is None:
+            return getattr(self.connections, "shards", [self.connections])
+        return [self._source(user_id)]
 
-    def _column_exists(self, table, column):
-        cursor = self.connection.cursor()
-        cursor.execute(f"PRAGMA table_info({table})")
-        return any(row[1] == column for row in cursor.fetchall())
+    def check_index_usage(self):
+        usage = {}
+        for name, (query, params, index) in HOT_PATH_INDEXES.items():
+            plan = self._fetchall(f"EXPLAIN QUERY PLAN {query.format(source='habit_logs')}", params)
+            usage[name] = any(index in row["detail"] for row in plan)
+        return usage
 
     def _log_order_column(self):
-        if self._column_exists("habit_logs", "created_at"):
-            if self._column_exists("habit_logs", "timestamp"):
-                return "COALESCE(NULLIF(created_at, ''), timestamp)"
+        # Migrations backfill created_ts from created_at and legacy timestamps.
+        schema = self._schema()
+        if schema.has_column("habit_logs", "created_ts"):
+            return "created_ts"
+        if schema.has_column("habit_logs", "created_at"):
             return "created_at"
-        if self._column_exists("habit_logs", "timestamp"):
+        if schema.has_column("habit_logs", "timestamp"):
             return "timestamp"
-        if self._column_exists("habit_logs", "date"):
+        if schema.has_column("habit_logs", "date"):
             return "date"
         return "id"
 
@@ -183,6 +687,129 @@ class HabitRepository:
             log["date"] = log["created_at"][:10]
         return log
 
+    def _expand_logs(self, rows):
+        # Compacted summary rows come back as one log per event they stand for.
+        return [
+            event for row in rows for event in expand_summary(self._normalize_log(dict(row)))
+        ]
+
+    @staticmethod
+    def _expand_records(rows):
+        for row in rows:
+            if type(row) is HabitLog:
+                yield row
+            else:
+                yield from row
+
+    def _pending_records(self, rows, since_ts=None, until_ts=None):
+        for log in self._pending_logs(rows, since_ts, until_ts, columns=LOG_RECORD_COLUMNS):
+            yield HabitLog.from_log(log, from_epoch_seconds(log["created_ts"]))
+
+    def _read_with_pending(self, user_id, read):
+        """Run ``read`` and return its result with the user's queued log rows.
+
+        Retries when a write-behind flush ran in between, so a row is never
+        both returned by ``read`` and queued, nor missing from both.
+        """
+        return self._read_consistent(user_id, lambda pending: (read(), pending))
+
+    def _read_consistent(self, user_id, read):
+        """Return ``read(pending)`` for the user's queued log rows, retried like _read_with_pending.
+
+        Reads merge the queued rows over committed values in Python; nothing
+        is written, so they keep to read-only connections.
+        """
+        if self.log_queue is None:
+            return read([])
+        while True:
+            sequence, pending = self.log_queue.snapshot(user_id)
+            result = read(pending)
+            if not self.log_queue.changed(sequence):
+                return result
+
+    def _pending_streak_states(self, user_id, pending):
+        if not pending:
+            return {}
+        with self._source(user_id).connection(readonly=True) as connection:
+            return pending_streak_states(connection, user_id, pending)
+
+    def _pending_logs(self, rows, since_ts=None, until_ts=None, columns=None):
+        selected = None
+        if columns is not None:
+            selected = tuple(dict.fromkeys(LOG_KEY_COLUMNS + LOG_SUMMARY_COLUMNS + tuple(columns)))
+        logs = []
+        # Newest first, like the stored logs; later puts win ties.
+        for row in sorted(reversed(rows), key=lambda row: row["created_ts"], reverse=True):
+            if since_ts is not None and row["created_ts"] < since_ts:
+                continue
+            if until_ts is not None and row["created_ts"] >= until_ts:
+                continue
+            log = {"id": None, **row, "event_count": 1, "first_ts": None}
+            if selected is not None:
+                log = {column: log.get(column) for column in selected}
+            logs.append(log)
+        return self._expand_logs(logs)
+
+    def _bump_habits_version(self, user_id):
+        self._execute(
+            "INSERT INTO user_data_versions (user_id, habits_version) VALUES (?, 1) "
+            "ON CONFLICT(user_id) DO UPDATE SET habits_version = habits_version + 1",
+            [user_id],
+            user_id=user_id,
+        )
+
+    def _streak_view(self, row, today):
+        if row is None:
+            return {"current": 0, "longest": 0, "last_completed_day": None}
+        today_day = day_number(today or datetime.utcnow().date())
+        # Stored runs end on their last completed due day; only one reaching the
+        # latest due day (today, for daily habits) is current.
+        last_due = WeekdaySchedule(row["days_mask"]).latest_due(today_day)
+        last_completed = row["last_completed_day"]
+        live = last_completed is not None and last_due <= last_completed <= today_day
+        current = row["current_streak"] if live else 0
+        return {
+            "current": current,
+            "longest": row["longest_streak"],
+            "last_completed_day": row["last_completed_day"],
+        }
+
+    def _log_projection(self, columns):
+        if columns is None:
+            return "*"
+        selected = tuple(dict.fromkeys(LOG_KEY_COLUMNS + LOG_SUMMARY_COLUMNS + tuple(columns)))
+        schema = self._schema()
+        unknown = [column for column in selected if not schema.has_column("habit_logs", column)]
+        if unknown:
+            raise ValueError(f"Unknown habit_logs columns: {', '.join(unknown)}")
+        return ", ".join(selected)
+
+    def _log_row(self, habit_id, user_id, status, action_time, note):
+        created_at_value = action_time.isoformat()
+        return {
+            "habit_id": habit_id,
+            "user_id": user_id,
+            "status": status,
+            "date": action_time.date().isoformat(),
+            "created_at": created_at_value,
+            "timestamp": created_at_value,
+            "created_ts": epoch_seconds(action_time),
+            "day": day_number(action_time),
+            "note": note,
+        }
+
+    def _parse_action_time(self, timestamp):
+        if timestamp is None:
+            return datetime.utcnow()
+        if isinstance(timestamp, datetime):
+            return timestamp
+        if isinstance(timestamp, str):
+            try:
+                return datetime.fromisoformat(timestamp)
+            except ValueError:
+                return None
+        return None
+
     def _normalize_since_datetime(self, since_dt):
         if isinstance(since_dt, datetime):
             return since_dt
@@ -195,92 +822,123 @@ class HabitRepository:
                 return None
         return None
 
+    def _require_user_under_router(self, user_id):
+        # Without a user_id the habit would be looked up on the directory shard,
+        # which does not hold most users' habits.
+        if user_id is None and isinstance(self.connections, ShardRouter):
+            raise ValueError("user_id is required when the database is sharded")
+
     def _resolve_connection(self, connection):
-        if connection is None:
-            return init_db()
-        return connection.connection if hasattr(connection, "connection") else connection
+        return connection_source(connection)
 
 
 class SettingsRepository:
-    def __init__(self, connection=None):
-        self.connection = self._resolve_connection(connection)
+    def __init__(self, connection=None, cache=None):
+        self.connections = self._resolve_connection(connection)
+        self.cache = cache if cache is not None else SettingsCache()
 
     def get(self, user_id, key, default=None):
-        row = self._fetchone(
-            "SELECT value FROM settings WHERE user_id = ? AND key = ?",
-            [user_id, key],
-        )
-        return row["value"] if row else default
-
-    def set(self, user_id, key, value):
-        self._execute(
-            "INSERT OR REPLACE INTO settings (user_id, key, value) VALUES (?, ?, ?)",
-            [user_id, key, value],
-        )
+        return self._load(user_id).get(key, default)
 
-    def _execute(self, query, params=None):
-        cursor = self.connection.cursor()
-        cursor.execute(query, params or [])
-        self.connection.commit()
-        return cursor
+    def get_many(self, user_id, defaults):
+        values = self._load(user_id)
+        return {key: values.get(key, default) for key, default in defaults.items()}
 
-    def _fetchone(self, query, params=None):
-        cursor = self.connection.cursor()
-        cursor.execute(query, params or [])
-        return cursor.fetchone()
+    def set(self, user_id, key, value):
+        self.set_many(user_id, {key: value})
+
+    def set_many(self, user_id, values):
+        try:
+            with source_for(self.connections, user_id).transaction() as connection:
+                run_many(
+                    connection,
+                    "INSERT OR REPLACE INTO settings (user_id, key, value) VALUES (?, ?, ?)",
+                    [[user_id, key, value] for key, value in values.items()],
+                )
+        except BaseException:
+            self.cache.invalidate(user_id)
+            raise
+        self.cache.update(user_id, values)
+
+    @contextmanager
+    def transaction(self, savepoint=False, user_id=None):
+        try:
+            with source_for(self.connections, user_id).transaction(savepoint=savepoint) as connection:
+                yield connection
+        except BaseException:
+            # Write-through updates made inside the block were rolled back.
+            self.cache.invalidate()
+            raise
+
+    def _load(self, user_id):
+        if user_id is None:
+            return {}
+        values = self.cache.get(user_id)
+        if values is None:
+            values = {
+                row["key"]: row["value"]
+                for row in self._fetchall(
+                    "SELECT key, value FROM settings WHERE user_id = ?",
+                    [user_id],
+                    user_id=user_id,
+                )
+            }
+            self.cache.put(user_id, values)
+        return values
+
+    def _fetchall(self, query, params=None, user_id=None):
+        with source_for(self.connections, user_id).connection(readonly=True) as connection:
+            return run_query(connection, query, params, fetch="all")
 
     def _resolve_connection(self, connection):
-        if connection is None:
-            return init_db()
-        return connection.connection if hasattr(connection, "connection") else connection
+        return connection_source(connection)
 
 
 class UserRepository:
     def __init__(self, connection=None):
-        self.connection = self._resolve_connection(connection)
+        self.connections = self._resolve_connection(connection)
+        self.schema = None
 
     def get_by_email(self, email):
         row = self._fetchone("SELECT * FROM users WHERE email = ?", [email])
         return dict(row) if row else None
 
     def create_user(self, email, password_hash):
-        columns = ["email", "password_hash"]
-        values = [email, password_hash]
-        if self._column_exists("users", "created_at"):
-            columns.append("created_at")
-            values.append(datetime.utcnow().isoformat())
-        placeholders = ", ".join(["?"] * len(columns))
-        cursor = self._execute(
-            f"INSERT INTO users ({', '.join(columns)}) VALUES ({placeholders})",
-            values,
-        )
-        return cursor.lastrowid
+        row = {
+            "email": email,
+            "password_hash": password_hash,
+            "created_at": datetime.utcnow().isoformat(),
+        }
+        columns, query = self._schema().insert_statement("users", USER_INSERT_COLUMNS)
+        user_id = self._execute(query, [row[column] for column in columns]).lastrowid
+        if hasattr(self.connections, "register_user"):
+            self.connections.register_user(user_id)
+        return user_id
+
+    def transaction(self, savepoint=False):
+        return self.connections.transaction(savepoint=savepoint)
 
     def _execute(self, query, params=None):
-        cursor = self.connection.cursor()
-        cursor.execute(query, params or [])
-        self.connection.commit()
-        return cursor
+        with self.connections.transaction() as connection:
+            return run_query(connection, query, params)
 
     def _fetchone(self, query, params=None):
-        cursor = self.connection.cursor()
-        cursor.execute(query, params or [])
-        return cursor.fetchone()
+        with self.connections.connection(readonly=True) as connection:
+            return run_query(connection, query, params, fetch="one")
 
-    def _column_exists(self, table, column):
-        cursor = self.connection.cursor()
-        cursor.execute(f"PRAGMA table_info({table})")
-        return any(row[1] == column for row in cursor.fetchall())
+    def _schema(self):
+        with self.connections.connection() as connection:
+            if self.schema is None or hasattr(connection, "schema_descriptor"):
+                self.schema = schema_for(connection)
+        return self.schema
 
     def _resolve_connection(self, connection):
-        if connection is None:
-            return init_db()
-        return connection.connection if hasattr(connection, "connection") else connection
+        return connection_source(connection)
 
 
 class AuthRepository:
     def __init__(self, connection=None):
-        self.connection = self._resolve_connection(connection)
+        self.connections = self._resolve_connection(connection)
 
     @property
     def is_authenticated(self):
@@ -293,18 +951,16 @@ class AuthRepository:
     def sign_out(self):
         self._execute("DELETE FROM auth WHERE key = 'authenticated'")
 
+    def transaction(self, savepoint=False):
+        return self.connections.transaction(savepoint=savepoint)
+
     def _execute(self, query, params=None):
-        cursor = self.connection.cursor()
-        cursor.execute(query, params or [])
-        self.connection.commit()
-        return cursor
+        with self.connections.transaction() as connection:
+            return run_query(connection, query, params)
 
     def _fetchone(self, query, params=None):
-        cursor = self.connection.cursor()
-        cursor.execute(query, params or [])
-        return cursor.fetchone()
+        with self.connections.connection(readonly=True) as connection:
+            return run_query(connection, query, params, fetch="one")
 
     def _resolve_connection(self, connection):
-        if connection is None:
-            return init_db()
-        return connection.connection if hasattr(connection, "connection") else connection
+        return connection_source(connection)
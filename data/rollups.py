@@ -0,0 +1,105 @@
+from __future__ import annotations
+
+import sqlite3
+from collections import defaultdict
+from typing import Iterable
+
+from data.instrumentation import run_many, run_query
+
+ROLLUP_STATUSES = ("completed", "skipped", "postponed")
+
+UPSERT_DAILY_STATS_QUERY = """
+    INSERT INTO habit_daily_stats (user_id, habit_id, day, completed, skipped, postponed)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(user_id, habit_id, day) DO UPDATE SET
+        completed = completed + excluded.completed,
+        skipped = skipped + excluded.skipped,
+        postponed = postponed + excluded.postponed
+"""
+
+
+def create_daily_stats_table(connection: sqlite3.Connection) -> None:
+    run_query(
+        connection,
+        """
+        CREATE TABLE IF NOT EXISTS habit_daily_stats (
+            user_id INTEGER NOT NULL,
+            habit_id INTEGER NOT NULL,
+            day INTEGER NOT NULL,
+            completed INTEGER NOT NULL DEFAULT 0,
+            skipped INTEGER NOT NULL DEFAULT 0,
+            postponed INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, habit_id, day)
+        ) WITHOUT ROWID
+        """
+    )
+
+
+def daily_stats_deltas(rows: Iterable[dict]) -> list[list[int]]:
+    """Fold log rows into one upsert parameter list per (user, habit, day)."""
+    totals = defaultdict(lambda: [0, 0, 0])
+    for row in rows:
+        status = row["status"]
+        if status not in ROLLUP_STATUSES:
+            continue
+        key = (row["user_id"], row["habit_id"], row["day"])
+        totals[key][ROLLUP_STATUSES.index(status)] += 1
+    return [[*key, *counts] for key, counts in totals.items()]
+
+
+def merge_daily_stats(
+    stats: Iterable[dict], rows: Iterable[dict], since_day: int | None = None
+) -> list[dict]:
+    """Stored habit_daily_stats rows with log rows not yet written folded in, by day."""
+    merged = {(stat["user_id"], stat["habit_id"], stat["day"]): dict(stat) for stat in stats}
+    for user_id, habit_id, day, *counts in daily_stats_deltas(rows):
+        if since_day is not None and day < since_day:
+            continue
+        stat = merged.setdefault(
+            (user_id, habit_id, day),
+            {"user_id": user_id, "habit_id": habit_id, "day": day, **dict.fromkeys(ROLLUP_STATUSES, 0)},
+        )
+        for status, count in zip(ROLLUP_STATUSES, counts):
+            stat[status] += count
+    return sorted(merged.values(), key=lambda stat: stat["day"])
+
+
+def apply_daily_stats(connection: sqlite3.Connection, rows: Iterable[dict]) -> None:
+    deltas = daily_stats_deltas(rows)
+    if deltas:
+        run_many(connection, UPSERT_DAILY_STATS_QUERY, deltas)
+
+
+def rebuild_daily_stats(
+    connection: sqlite3.Connection,
+    user_id: int | None = None,
+    source: str = "habit_logs",
+) -> int:
+    scope = "" if user_id is None else "WHERE user_id = ?"
+    log_filter = "WHERE day IS NOT NULL" if user_id is None else "WHERE user_id = ? AND day IS NOT NULL"
+    params = [] if user_id is None else [user_id]
+    run_query(connection, f"DELETE FROM habit_daily_stats {scope}", params)
+    cursor = run_query(
+        connection,
+        f"""
+        INSERT INTO habit_daily_stats (user_id, habit_id, day, completed, skipped, postponed)
+        SELECT user_id, habit_id, day,
+            SUM(CASE WHEN status = 'completed' THEN event_count ELSE 0 END),
+            SUM(CASE WHEN status = 'skipped' THEN event_count ELSE 0 END),
+            SUM(CASE WHEN status = 'postponed' THEN event_count ELSE 0 END)
+        FROM {source}
+        {log_filter}
+        GROUP BY user_id, habit_id, day
+        """,
+        params,
+    )
+    return cursor.rowcount
+
+
+if __name__ == "__main__":
+    from data.database import init_db, transaction
+
+    conn = init_db()
+    with transaction(conn):
+        count = rebuild_daily_stats(conn)
+    print(f"Rebuilt {count} daily stats rows.")
@@ -23,8 +23,9 @@ TEMPLATES = {
 
 
 def seed_templates(user_id, template_key, habit_repository):
-    for habit in TEMPLATES.get(template_key, []):
-        habit_repository.add_habit(user_id, habit)
+    with habit_repository.transaction(user_id=user_id):
+        for habit in TEMPLATES.get(template_key, []):
+            habit_repository.add_habit(user_id, habit)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,315 @@
+from __future__ import annotations
+
+import sqlite3
+from collections import defaultdict
+from typing import Iterable
+
+from data.instrumentation import run_query
+from data.rollups import daily_stats_deltas
+from domain.logic import EVERY_DAY, WeekdaySchedule
+
+# habit_id used for the per-user row, which streaks over every habit at once.
+USER_SCOPE = 0
+
+STREAK_COLUMNS = (
+    "current_streak",
+    "longest_streak",
+    "last_completed_day",
+    "wildcard_week",
+    "wildcards_used",
+)
+
+RECORD_COMPLETION_QUERY = """
+    INSERT INTO streak_state (user_id, habit_id, current_streak, longest_streak, last_completed_day)
+    VALUES (:user_id, :habit_id, 1, 1, :day)
+    ON CONFLICT(user_id, habit_id) DO UPDATE SET
+        current_streak = CASE
+            WHEN last_completed_day IS NULL THEN 1
+            WHEN excluded.last_completed_day = last_completed_day THEN current_streak
+            WHEN last_completed_day >= :previous_due THEN current_streak + 1
+            ELSE 1
+        END,
+        longest_streak = MAX(longest_streak, CASE
+            WHEN last_completed_day IS NULL THEN 1
+            WHEN excluded.last_completed_day = last_completed_day THEN current_streak
+            WHEN last_completed_day >= :previous_due THEN current_streak + 1
+            ELSE 1
+        END),
+        last_completed_day = excluded.last_completed_day
+    WHERE last_completed_day IS NULL OR excluded.last_completed_day >= last_completed_day
+"""
+
+RECORD_SKIP_QUERY = """
+    INSERT INTO streak_state (user_id, habit_id, wildcard_week, wildcards_used)
+    VALUES (?, ?, ?, 1)
+    ON CONFLICT(user_id, habit_id) DO UPDATE SET
+        wildcards_used = CASE
+            WHEN wildcard_week = excluded.wildcard_week THEN wildcards_used + 1
+            ELSE 1
+        END,
+        wildcard_week = excluded.wildcard_week
+    WHERE wildcard_week IS NULL OR excluded.wildcard_week >= wildcard_week
+"""
+
+REPLACE_STATE_QUERY = f"""
+    INSERT OR REPLACE INTO streak_state (user_id, habit_id, {", ".join(STREAK_COLUMNS)})
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+def create_streak_table(connection: sqlite3.Connection) -> None:
+    run_query(
+        connection,
+        """
+        CREATE TABLE IF NOT EXISTS streak_state (
+            user_id INTEGER NOT NULL,
+            habit_id INTEGER NOT NULL,
+            current_streak INTEGER NOT NULL DEFAULT 0,
+            longest_streak INTEGER NOT NULL DEFAULT 0,
+            last_completed_day INTEGER,
+            wildcard_week INTEGER,
+            wildcards_used INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, habit_id)
+        ) WITHOUT ROWID
+        """
+    )
+
+
+def week_start(day: int) -> int:
+    # Day 0 (1970-01-01) was a Thursday; weeks start on Monday like date.weekday().
+    return day - (day + 3) % 7
+
+
+def habit_schedules(
+    connection: sqlite3.Connection, user_id: int | None = None
+) -> dict[tuple[int, int], WeekdaySchedule]:
+    """Schedules of the habits that are not due every day, keyed by (user_id, habit_id)."""
+    user_filter = "" if user_id is None else "AND user_id = ?"
+    try:
+        rows = run_query(
+            connection,
+            f"SELECT user_id, id, days_mask FROM habits WHERE days_mask != ? {user_filter}",
+            [EVERY_DAY] if user_id is None else [EVERY_DAY, user_id],
+            fetch="all",
+        )
+    except sqlite3.OperationalError:
+        # Before migration 14 every habit is daily; any other failure is a real error.
+        columns = run_query(connection, "PRAGMA table_info(habits)", fetch="all")
+        if "days_mask" in {row[1] for row in columns}:
+            raise
+        return {}
+    return {(row[0], row[1]): WeekdaySchedule(row[2]) for row in rows}
+
+
+def state_from_days(
+    completed_days: Iterable[int],
+    skipped_days: Iterable[int],
+    schedule: WeekdaySchedule | None = None,
+) -> dict:
+    schedule = schedule or WeekdaySchedule()
+    # Completions on days off the schedule neither extend nor break a run.
+    due_days = [day for day in set(completed_days) if schedule.is_due(day)]
+    current = longest = 0
+    last = max(due_days) if due_days else None
+    if due_days:
+        current, longest = schedule.streaks(due_days, last)
+
+    wildcard_week = None
+    wildcards_used = 0
+    for day in skipped_days:
+        week = week_start(day)
+        if wildcard_week is None or week > wildcard_week:
+            wildcard_week, wildcards_used = week, 1
+        elif week == wildcard_week:
+            wildcards_used += 1
+
+    return {
+        "current_streak": current,
+        "longest_streak": longest,
+        "last_completed_day": last,
+        "wildcard_week": wildcard_week,
+        "wildcards_used": wildcards_used,
+    }
+
+
+def apply_streaks(connection: sqlite3.Connection, rows: list[dict]) -> None:
+    """Fold new log rows into streak_state, after the daily rollup saw them."""
+    if len(rows) == 1:
+        row = rows[0]
+        schedules = habit_schedules(connection, row["user_id"])
+        for scope in (row["habit_id"], USER_SCOPE):
+            schedule = schedules.get((row["user_id"], scope))
+            _record(connection, row["user_id"], scope, row["status"], row["day"], schedule)
+        return
+
+    scopes = defaultdict(set)
+    for row in rows:
+        scopes[row["user_id"]].add(row["habit_id"])
+    for user_id, habit_ids in scopes.items():
+        recompute_streaks(connection, user_id, [*habit_ids, USER_SCOPE])
+
+
+def recompute_streaks(connection: sqlite3.Connection, user_id: int, scopes: Iterable[int]) -> None:
+    """Rebuild the given scopes of one user from the habit_daily_stats rollup."""
+    schedules = habit_schedules(connection, user_id)
+    for scope in scopes:
+        habit_filter = "" if scope == USER_SCOPE else "AND habit_id = ?"
+        params = [user_id] if scope == USER_SCOPE else [user_id, scope]
+        completed_days = [
+            row[0]
+            for row in run_query(
+                connection,
+                "SELECT DISTINCT day FROM habit_daily_stats "
+                f"WHERE user_id = ? {habit_filter} AND completed > 0",
+                params,
+                fetch="all",
+            )
+        ]
+        skipped_days = []
+        for day, skipped in run_query(
+            connection,
+            f"SELECT day, skipped FROM habit_daily_stats WHERE user_id = ? {habit_filter} AND skipped > 0",
+            params,
+            fetch="all",
+        ):
+            skipped_days.extend([day] * skipped)
+        if not completed_days and not skipped_days:
+            # Only postponed days, or none left: such scopes have no state row, as in verify_streaks.
+            run_query(
+                connection, "DELETE FROM streak_state WHERE user_id = ? AND habit_id = ?", [user_id, scope]
+            )
+            continue
+        state = state_from_days(completed_days, skipped_days, schedules.get((user_id, scope)))
+        _write_state(connection, user_id, scope, state)
+
+
+def pending_streak_states(
+    connection: sqlite3.Connection, user_id: int, rows: list[dict]
+) -> dict[int, dict]:
+    """States of the scopes ``rows`` touch, as if the rows were stored. Read-only.
+
+    Recomputes each scope from the habit_daily_stats rollup plus the rows,
+    like recompute_streaks, and adds the habit's days_mask.
+    """
+    deltas = [delta for delta in daily_stats_deltas(rows) if delta[0] == user_id]
+    if not deltas:
+        return {}
+    scopes = {delta[1] for delta in deltas} | {USER_SCOPE}
+    stored = run_query(
+        connection,
+        "SELECT user_id, habit_id, day, completed, skipped, postponed FROM habit_daily_stats "
+        "WHERE user_id = ?",
+        [user_id],
+        fetch="all",
+    )
+    completed = defaultdict(set)
+    skipped = defaultdict(list)
+    for _, habit_id, day, done, skips, _ in [*map(tuple, stored), *deltas]:
+        for scope in (habit_id, USER_SCOPE):
+            if scope not in scopes:
+                continue
+            if done:
+                completed[scope].add(day)
+            skipped[scope].extend([day] * skips)
+    schedules = habit_schedules(connection, user_id)
+    states = {}
+    for scope in scopes:
+        schedule = schedules.get((user_id, scope))
+        state = state_from_days(completed[scope], skipped[scope], schedule)
+        states[scope] = {**state, "days_mask": schedule.mask if schedule else EVERY_DAY}
+    return states
+
+
+def verify_streaks(
+    connection: sqlite3.Connection,
+    user_id: int | None = None,
+    repair: bool = False,
+    source: str = "habit_logs",
+) -> list[tuple[int, int]]:
+    """Recompute streak_state from raw logs and return the scopes that differ."""
+    user_filter = "" if user_id is None else "AND user_id = ?"
+    state_filter = "" if user_id is None else "WHERE user_id = ?"
+    params = [] if user_id is None else [user_id]
+    completed = defaultdict(set)
+    skipped = defaultdict(list)
+    for log_user, habit_id, day, status, event_count in run_query(
+        connection,
+        f"SELECT user_id, habit_id, day, status, event_count FROM {source} "
+        f"WHERE status IN ('completed', 'skipped') AND day IS NOT NULL {user_filter}",
+        params,
+        fetch="all",
+    ):
+        target = completed if status == "completed" else skipped
+        for scope in (habit_id, USER_SCOPE):
+            if status == "completed":
+                target[(log_user, scope)].add(day)
+            else:
+                target[(log_user, scope)].extend([day] * event_count)
+
+    schedules = habit_schedules(connection, user_id)
+    expected = {
+        key: state_from_days(completed.get(key, ()), skipped.get(key, ()), schedules.get(key))
+        for key in set(completed) | set(skipped)
+    }
+    stored = {
+        (row[0], row[1]): dict(zip(STREAK_COLUMNS, row[2:]))
+        for row in run_query(
+            connection,
+            f"SELECT user_id, habit_id, {', '.join(STREAK_COLUMNS)} FROM streak_state {state_filter}",
+            params,
+            fetch="all",
+        )
+    }
+
+    mismatches = sorted(
+        key for key in set(expected) | set(stored) if expected.get(key) != stored.get(key)
+    )
+    if repair:
+        for key in mismatches:
+            if key in expected:
+                _write_state(connection, *key, expected[key])
+            else:
+                run_query(
+                    connection, "DELETE FROM streak_state WHERE user_id = ? AND habit_id = ?", list(key)
+                )
+    return mismatches
+
+
+def _record(connection, user_id, scope, status, day, schedule=None):
+    if status == "completed":
+        schedule = schedule or WeekdaySchedule()
+        if not schedule.is_due(day):
+            # Off-schedule completions leave the run alone but still give the habit a state row.
+            run_query(
+                connection,
+                "INSERT OR IGNORE INTO streak_state (user_id, habit_id) VALUES (?, ?)",
+                [user_id, scope],
+            )
+            return
+        cursor = run_query(
+            connection,
+            RECORD_COMPLETION_QUERY,
+            {"user_id": user_id, "habit_id": scope, "day": day, "previous_due": schedule.previous_due(day)},
+        )
+        if cursor.rowcount == 0:
+            # Backdated completion: the run lengths behind it may have changed.
+            recompute_streaks(connection, user_id, [scope])
+    elif status == "skipped":
+        run_query(connection, RECORD_SKIP_QUERY, [user_id, scope, week_start(day)])
+
+
+def _write_state(connection, user_id, scope, state):
+    run_query(
+        connection,
+        REPLACE_STATE_QUERY,
+        [user_id, scope, *(state[column] for column in STREAK_COLUMNS)],
+    )
+
+
+if __name__ == "__main__":
+    from data.database import init_db, transaction
+
+    conn = init_db()
+    with transaction(conn):
+        repaired = verify_streaks(conn, repair=True)
+    print(f"Repaired {len(repaired)} streak states.")
@@ -0,0 +1,251 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+from data.database import DB_PATH
+from data.repositories import HabitRepository
+
+IMMEDIATE = "immediate"
+BATCHED = "batched"
+JOURNALED = "journaled"
+DURABILITY_LEVELS = (IMMEDIATE, BATCHED, JOURNALED)
+
+FLUSH_BATCH_SIZE = 100
+FLUSH_INTERVAL = 0.5
+JOURNAL_PATH = DB_PATH.with_name(f"{DB_PATH.stem}.log-journal")
+
+logger = logging.getLogger(__name__)
+
+
+class LogWriteQueue:
+    """Write-behind queue for HabitRepository.log_action.
+
+    Durability levels:
+
+    - ``immediate``: every event is inserted and committed before put() returns.
+    - ``batched``: events wait in memory and are group-committed once
+      ``batch_size`` are queued or every ``interval`` seconds; a crash loses
+      whatever was still queued.
+    - ``journaled``: as batched, but each event is first appended and fsynced
+      to an append-only journal, which is replayed when the queue is created.
+
+    The background flusher needs a thread-safe source (ConnectionPool or
+    ShardRouter); without start(), batches flush when full or on flush().
+    Reads pair pending() with a database read through snapshot()/changed().
+    Rows the flusher cannot write for reasons other than a busy database are
+    moved to ``parked`` (and to a ``.parked`` file next to the journal).
+
+    Queues on a ShardRouter register with it, so ShardRouter.move_user can
+    flush a user's rows, hold new ones and remap their habit ids.
+    """
+
+    def __init__(
+        self,
+        connection=None,
+        durability=BATCHED,
+        batch_size=FLUSH_BATCH_SIZE,
+        interval=FLUSH_INTERVAL,
+        journal_path=None,
+    ):
+        if durability not in DURABILITY_LEVELS:
+            raise ValueError(f"Unknown durability level: {durability}")
+        self.writer = HabitRepository(connection)
+        self.durability = durability
+        self.batch_size = batch_size
+        self.interval = interval
+        self.journal_path = Path(journal_path or JOURNAL_PATH) if durability == JOURNALED else None
+        self.last_error = None
+        self.parked = []
+        self._pending = []
+        # Replayed journal rows may already be in the database; they are checked on flush.
+        self._replayed = 0
+        # user_id -> {old habit id: new habit id} for users whose writes are held; see holding().
+        self._held = {}
+        # Even while idle, odd while a flush is writing; see snapshot().
+        self._sequence = 0
+        self._lock = threading.Lock()
+        self._settled = threading.Condition(self._lock)
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        if self.journal_path is not None:
+            self._recover()
+        log_queues = getattr(self.writer.connections, "log_queues", None)
+        if log_queues is not None:
+            log_queues.add(self)
+
+    def put(self, row):
+        with self._settled:
+            habit_ids = self._held.get(row["user_id"])
+            while row["user_id"] in self._held:
+                self._settled.wait()
+        if habit_ids and row["habit_id"] in habit_ids:
+            # Queued against the user's old shard; point it at the moved habit.
+            row = {**row, "habit_id": habit_ids[row["habit_id"]]}
+        if self.durability == IMMEDIATE:
+            self.writer.write_log_rows([row])
+            return
+        with self._lock:
+            if self.journal_path is not None:
+                with open(self.journal_path, "a", encoding="utf-8") as journal:
+                    journal.write(json.dumps(row) + "\n")
+                    journal.flush()
+                    os.fsync(journal.fileno())
+            self._pending.append(row)
+            full = len(self._pending) >= self.batch_size
+        if full:
+            if self.running:
+                self._wake.set()
+            else:
+                self.flush()
+
+    def pending(self, user_id=None):
+        with self._lock:
+            return [dict(row) for row in self._pending if user_id is None or row["user_id"] == user_id]
+
+    def snapshot(self, user_id):
+        """Return (sequence, pending rows) once no flush is writing.
+
+        A read made after this call is consistent with the rows returned
+        unless changed(sequence) says a flush started in between.
+        """
+        with self._settled:
+            while self._sequence % 2:
+                self._settled.wait()
+            return self._sequence, [dict(row) for row in self._pending if row["user_id"] == user_id]
+
+    def changed(self, sequence):
+        with self._lock:
+            return self._sequence != sequence
+
+    @contextmanager
+    def holding(self, user_id):
+        """Flush a user's queued rows, then make put() wait for them until the block exits."""
+        with self._lock:
+            self._held[user_id] = {}
+        try:
+            self.flush()
+            yield self
+        finally:
+            with self._settled:
+                del self._held[user_id]
+                self._settled.notify_all()
+
+    def remap(self, user_id, habit_ids):
+        """Give the rows put() is holding for ``user_id`` their new habit ids."""
+        with self._lock:
+            self._held[user_id].update(habit_ids)
+
+    def flush(self):
+        """Group-commit everything queued so far; return the number of rows written."""
+        return self._flush()
+
+    def _flush(self, park=False):
+        with self._flush_lock:
+            with self._lock:
+                batch = list(self._pending)
+                replayed = self._replayed
+                if not batch:
+                    return 0
+                self._sequence += 1
+            try:
+                try:
+                    written = self.writer.write_log_rows(batch, skip_existing=replayed > 0)
+                except sqlite3.OperationalError:
+                    raise
+                except Exception:
+                    if not park:
+                        raise
+                    # Retrying would fail the same way; write row by row and set the bad ones aside.
+                    logger.exception("Write-behind flush of %d log rows failed", len(batch))
+                    written = self._write_separately(batch, replayed > 0)
+            finally:
+                with self._settled:
+                    self._sequence += 1
+                    self._settled.notify_all()
+            with self._lock:
+                del self._pending[: len(batch)]
+                self._replayed = 0
+                if self.journal_path is not None:
+                    self._rewrite_journal()
+            return written
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="log-write-behind", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.flush()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                parked = len(self.parked)
+                self._flush(park=True)
+                if len(self.parked) == parked:
+                    self.last_error = None
+            except sqlite3.OperationalError as error:
+                # Usually a busy database; the rows stay queued for the next try.
+                self.last_error = error
+            except Exception as error:
+                # Keep the flusher alive whatever happens; the rows stay queued.
+                logger.exception("Write-behind flush failed")
+                self.last_error = error
+
+    def _write_separately(self, batch, skip_existing):
+        written = 0
+        rejected = []
+        for row in batch:
+            try:
+                written += self.writer.write_log_rows([row], skip_existing=skip_existing)
+            except sqlite3.OperationalError:
+                raise
+            except Exception as error:
+                logger.warning("Parking log row %r: %s", row, error)
+                self.last_error = error
+                rejected.append(row)
+        with self._lock:
+            self.parked.extend(rejected)
+        if rejected and self.journal_path is not None:
+            parked_path = self.journal_path.with_name(f"{self.journal_path.name}.parked")
+            with open(parked_path, "a", encoding="utf-8") as parked:
+                parked.writelines(json.dumps(row) + "\n" for row in rejected)
+        return written
+
+    def _recover(self):
+        if not self.journal_path.exists():
+            return
+        for line in self.journal_path.read_text(encoding="utf-8").splitlines():
+            try:
+                self._pending.append(json.loads(line))
+            except json.JSONDecodeError:
+                # A torn final line from a crash mid-append was never acknowledged.
+                continue
+        self._replayed = len(self._pending)
+
+    def _rewrite_journal(self):
+        staging = self.journal_path.with_name(f"{self.journal_path.name}.tmp")
+        with open(staging, "w", encoding="utf-8") as journal:
+            journal.writelines(json.dumps(row) + "\n" for row in self._pending)
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.replace(staging, self.journal_path)
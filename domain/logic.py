@@ -1,10 +1,119 @@
 from collections import Counter
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+
+WEEKDAYS = ("MON", "TUE", "WED", "THU", "FRI", "SAT", "SUN")
+EVERY_DAY = (1 << len(WEEKDAYS)) - 1
+# Day numbers count from 1970-01-01, which was a Thursday.
+DAY_ZERO = date(1970, 1, 1)
+DAY_ZERO_WEEKDAY = 3
+
+
+class WeekdaySchedule:
+    """The weekdays a habit is due, as a 7-bit mask with bit 0 for Monday.
+
+    Daily habits are due every day; weekly ones on their ``days``. Streaks
+    count consecutive due days completed, so days off the schedule neither
+    extend nor break a run. Histories are Python int bitsets (bit i is day
+    ``first + i``), so a streak costs a few word-wide operations per missed
+    day rather than a loop over every day.
+    """
+
+    def __init__(self, mask=EVERY_DAY):
+        if not 0 < mask <= EVERY_DAY:
+            raise ValueError(f"Weekday mask must be between 1 and {EVERY_DAY}.")
+        self.mask = mask
+
+    @classmethod
+    def parse(cls, frequency="daily", days=None):
+        """Schedule for a habit's ``frequency`` and ``days`` such as "MON,WED,FRI"."""
+        if frequency != "weekly" or not days:
+            return cls()
+        mask = 0
+        for code in days.split(","):
+            code = code.strip().upper()
+            if code not in WEEKDAYS:
+                raise ValueError(f"Unknown weekday: {code}")
+            mask |= 1 << WEEKDAYS.index(code)
+        return cls(mask)
+
+    @property
+    def days(self):
+        return ",".join(code for bit, code in enumerate(WEEKDAYS) if self.mask >> bit & 1)
+
+    def is_due(self, day):
+        return bool(self.mask >> self._weekday(self._day(day)) & 1)
+
+    def latest_due(self, day):
+        """Day number of the last due day on or before ``day``."""
+        day = self._day(day)
+        while not self.mask >> self._weekday(day) & 1:
+            day -= 1
+        return day
+
+    def previous_due(self, day):
+        return self.latest_due(self._day(day) - 1)
+
+    def due_bits(self, first, last):
+        """Bitset of the due days in [first, last]; bit i is day ``first + i``."""
+        length = last - first + 1
+        if length <= 0:
+            return 0
+        shift = self._weekday(first)
+        week = (self.mask | self.mask << 7) >> shift & EVERY_DAY
+        weeks = -(-length // 7)
+        # Multiplying by 1 + 2**7 + 2**14 + ... repeats the week without carries.
+        return week * (((1 << 7 * weeks) - 1) // EVERY_DAY) & ((1 << length) - 1)
+
+    def streaks(self, completed_days, today):
+        """Return ``(current, longest)`` runs of completed due days.
+
+        ``current`` is the run holding the latest due day on or before
+        ``today``; it is 0 when that day has no completion.
+        """
+        today = self._day(today)
+        days = {self._day(day) for day in completed_days}
+        if not days:
+            return 0, 0
+        first = min(days)
+        last = max(max(days), today)
+        bitmap = bytearray((last - first) // 8 + 1)
+        for day in days:
+            offset = day - first
+            bitmap[offset >> 3] |= 1 << (offset & 7)
+        due = self.due_bits(first, last)
+        missed = due & ~int.from_bytes(bitmap, "little")
+
+        current = 0
+        if today >= first:
+            until_today = (1 << (today - first + 1)) - 1
+            current = ((due & until_today) >> (missed & until_today).bit_length()).bit_count()
+        longest = 0
+        while missed:
+            gap = (missed & -missed).bit_length()
+            longest = max(longest, (due & ((1 << (gap - 1)) - 1)).bit_count())
+            due >>= gap
+            missed >>= gap
+        return current, max(longest, due.bit_count())
+
+    @staticmethod
+    def _day(value):
+        if isinstance(value, datetime):
+            value = value.date()
+        if isinstance(value, date):
+            return (value - DAY_ZERO).days
+        return value
+
+    @staticmethod
+    def _weekday(day):
+        return (day + DAY_ZERO_WEEKDAY) % 7
 
 
 class StreakCalculator:
-    def calculate(self, logs, today=None):
+    def calculate(self, logs, today=None, schedule=None):
         today = today or datetime.utcnow().date()
+        if schedule is not None:
+            completed = [log["timestamp"] for log in logs if log["status"] == "completed"]
+            return schedule.streaks(completed, today)[0]
         completed = {log["timestamp"].date() for log in logs if log["status"] == "completed"}
         streak = 0
         cursor = today
@@ -38,6 +147,49 @@ class BestHourCalculator:
         return best_hour, median_minute
 
 
+class MinuteHistogram:
+    """Completions bucketed by minute of day, with running totals per hour.
+
+    Buckets hold weights, so callers can decay old completions; best_hour
+    reads 24 hour totals and at most 60 minute buckets whatever the history
+    length. It matches BestHourCalculator except on tied hours, where the
+    earliest hour wins instead of the first one logged.
+    """
+
+    MINUTES = 24 * 60
+
+    def __init__(self, buckets=None):
+        self.buckets = [0.0] * self.MINUTES
+        self.hours = [0.0] * 24
+        for minute, weight in (buckets or {}).items():
+            self.add(minute, weight)
+
+    @classmethod
+    def from_logs(cls, logs):
+        histogram = cls()
+        for log in logs:
+            if log["status"] == "completed":
+                histogram.add(log["timestamp"].hour * 60 + log["timestamp"].minute)
+        return histogram
+
+    def add(self, minute, weight=1.0):
+        self.buckets[minute] += weight
+        self.hours[minute // 60] += weight
+
+    def best_hour(self):
+        best = max(range(24), key=lambda hour: (self.hours[hour], -hour))
+        total = self.hours[best]
+        if total <= 0:
+            return None
+        # Weighted form of BestHourCalculator's sorted(minutes)[len // 2].
+        seen = 0.0
+        for minute in range(60):
+            seen += self.buckets[best * 60 + minute]
+            if seen > total / 2:
+                return best, minute
+        return best, 59
+
+
 class WildcardRule:
     def has_wildcard(self, logs, today=None):
         today = today or datetime.utcnow().date()
@@ -53,12 +205,22 @@ class SmartReminderEngine:
     def __init__(self, best_hour_calculator=None):
         self.best_hour_calculator = best_hour_calculator or BestHourCalculator()
 
-    def analyze(self, logs, dnd_start=22, dnd_end=7):
-        cutoff = datetime.utcnow() - timedelta(days=14)
+    RECENT_DAYS = 14
+    SOFT_AFTER_POSTPONED = 3
+
+    def analyze(self, logs, dnd_start=22, dnd_end=7, histogram=None, now=None):
+        cutoff = (now or datetime.utcnow()) - timedelta(days=self.RECENT_DAYS)
         recent_logs = [log for log in logs if log["timestamp"] >= cutoff]
-        best_hour = self.best_hour_calculator.best_hour(recent_logs)
+        # A MinuteHistogram replaces the 14-day best-hour pass with its decayed buckets.
+        if histogram is not None:
+            best_hour = histogram.best_hour()
+        else:
+            best_hour = self.best_hour_calculator.best_hour(recent_logs)
         ignored = len([log for log in recent_logs if log["status"] == "postponed"])
-        intensity = "soft" if ignored >= 3 else "normal"
+        return self.recommend(best_hour, ignored, dnd_start, dnd_end)
+
+    def recommend(self, best_hour, ignored, dnd_start=22, dnd_end=7):
+        intensity = "soft" if ignored >= self.SOFT_AFTER_POSTPONED else "normal"
         suggested = None
         if best_hour:
             hour, minute = best_hour
@@ -71,3 +233,96 @@ class SmartReminderEngine:
         if start <= end:
             return start <= hour <= end
         return hour >= start or hour <= end
+
+
+class LogAnalyzer:
+    """Streak, XP, wildcard, best hour and reminder from one pass over the logs.
+
+    ``logs`` may be any iterable, including a generator that parses rows as
+    they stream in; each log is looked at once. Results are the same as
+    running StreakCalculator (with the same ``schedule``), XpCalculator,
+    WildcardRule and SmartReminderEngine separately, including
+    BestHourCalculator's first-logged winner on tied hours. Callers that only
+    want the reminder use recommend(), which skips the streak bookkeeping.
+    """
+
+    def __init__(self, xp_calculator=None, reminder_engine=None):
+        self.xp_calculator = xp_calculator or XpCalculator()
+        self.reminder_engine = reminder_engine or SmartReminderEngine()
+
+    def analyze(self, logs, now=None, total_xp=0, dnd_start=22, dnd_end=7, histogram=None, schedule=None):
+        now = now or datetime.utcnow()
+        today = now.date()
+        start_of_week = today - timedelta(days=today.weekday())
+        cutoff = now - timedelta(days=self.reminder_engine.RECENT_DAYS)
+        completed_days = set()
+        skipped_this_week = 0
+        hours = Counter()
+        minutes = {}
+        ignored = 0
+        for log in logs:
+            timestamp = log["timestamp"]
+            status = log["status"]
+            if status == "completed":
+                completed_days.add(timestamp.date())
+                if timestamp >= cutoff:
+                    hours[timestamp.hour] += 1
+                    minutes.setdefault(timestamp.hour, [0] * 60)[timestamp.minute] += 1
+            elif status == "skipped":
+                if timestamp.date() >= start_of_week:
+                    skipped_this_week += 1
+            elif status == "postponed" and timestamp >= cutoff:
+                ignored += 1
+
+        if schedule is not None:
+            streak = schedule.streaks(completed_days, today)[0]
+        else:
+            streak = 0
+            cursor = today
+            while cursor in completed_days:
+                streak += 1
+                cursor -= timedelta(days=1)
+        if histogram is not None:
+            best_hour = histogram.best_hour()
+        else:
+            best_hour = self._best_hour(hours, minutes)
+        return {
+            "streak": streak,
+            "xp": self.xp_calculator.calculate(total_xp, streak),
+            "wildcard": skipped_this_week < 1,
+            "best_hour": best_hour,
+            "reminder": self.reminder_engine.recommend(best_hour, ignored, dnd_start, dnd_end),
+        }
+
+    def recommend(self, logs, now=None, dnd_start=22, dnd_end=7, histogram=None):
+        """The reminder analyze() would return, looking only at the recent logs it needs."""
+        now = now or datetime.utcnow()
+        cutoff = now - timedelta(days=self.reminder_engine.RECENT_DAYS)
+        hours = Counter()
+        minutes = {}
+        ignored = 0
+        for log in logs:
+            timestamp = log["timestamp"]
+            if timestamp < cutoff:
+                continue
+            status = log["status"]
+            if status == "completed" and histogram is None:
+                hours[timestamp.hour] += 1
+                minutes.setdefault(timestamp.hour, [0] * 60)[timestamp.minute] += 1
+            elif status == "postponed":
+                ignored += 1
+        best_hour = histogram.best_hour() if histogram is not None else self._best_hour(hours, minutes)
+        return self.reminder_engine.recommend(best_hour, ignored, dnd_start, dnd_end)
+
+    @staticmethod
+    def _best_hour(hours, minutes):
+        if not hours:
+            return None
+        best_hour = hours.most_common(1)[0][0]
+        # Same pick as sorted(minutes)[len // 2], read off the per-minute counts.
+        middle = hours[best_hour] // 2
+        seen = 0
+        for minute, count in enumerate(minutes[best_hour]):
+            seen += count
+            if seen > middle:
+                return best_hour, minute
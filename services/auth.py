@@ -30,3 +30,22 @@ class AuthService:
         password_hash = bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
         user_id = self.user_repo.create_user(email, password_hash)
         return self.user_repo.get_by_email(email) if user_id else None
+
+
+class AsyncAuthService:
+    """AuthService for async front ends; bcrypt and queries run on a DatabaseExecutor."""
+
+    def __init__(self, executor, auth_service):
+        self.executor = executor
+        self.sync = auth_service
+
+    @classmethod
+    async def create(cls, executor):
+        auth_service = await executor.run(AuthService, UserRepository(executor.connections))
+        return cls(executor, auth_service)
+
+    async def authenticate(self, email: str, password: str, timeout=None):
+        return await self.executor.run(self.sync.authenticate, email, password, timeout=timeout)
+
+    async def register(self, email: str, password: str, timeout=None):
+        return await self.executor.run(self.sync.register, email, password, timeout=timeout)
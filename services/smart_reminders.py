@@ -1,20 +1,46 @@
 from datetime import datetime
 
-from domain.logic import SmartReminderEngine
+from data.models import HabitLog, from_epoch_seconds
+from domain.logic import LogAnalyzer, SmartReminderEngine
 
 
 class SmartReminderService:
     def __init__(self):
         self.engine = SmartReminderEngine()
+        self.analyzer = LogAnalyzer(reminder_engine=self.engine)
 
-    def build_recommendation(self, logs, dnd_start, dnd_end):
-        parsed_logs = []
+    def analyze(self, logs, dnd_start, dnd_end, histogram=None, total_xp=0, now=None, schedule=None):
+        """Streak, XP, wildcard, best hour and reminder from one pass over raw log rows.
+
+        Pass the habit's WeekdaySchedule for per-habit logs; without one the
+        streak counts consecutive days, like the per-user streak_state row.
+        """
+        return self.analyzer.analyze(
+            self._parse(logs),
+            now=now,
+            total_xp=total_xp,
+            dnd_start=dnd_start,
+            dnd_end=dnd_end,
+            histogram=histogram,
+            schedule=schedule,
+        )
+
+    def build_recommendation(self, logs, dnd_start, dnd_end, histogram=None, now=None):
+        return self.analyzer.recommend(
+            self._parse(logs), now=now, dnd_start=dnd_start, dnd_end=dnd_end, histogram=histogram
+        )
+
+    @staticmethod
+    def _parse(logs):
         for log in logs:
-            timestamp = log.get("timestamp") or log.get("created_at")
-            if not timestamp:
+            if type(log) is HabitLog:
+                yield log
                 continue
-            parsed_logs.append({
-                "timestamp": datetime.fromisoformat(timestamp),
-                "status": log["status"],
-            })
-        return self.engine.analyze(parsed_logs, dnd_start=dnd_start, dnd_end=dnd_end)
+            if log.get("created_ts") is not None:
+                timestamp = from_epoch_seconds(log["created_ts"])
+            else:
+                raw_value = log.get("timestamp") or log.get("created_at")
+                if not raw_value:
+                    continue
+                timestamp = datetime.fromisoformat(raw_value)
+            yield {"timestamp": timestamp, "status": log["status"]}
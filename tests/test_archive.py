@@ -0,0 +1,108 @@
+from datetime import datetime
+import sqlite3
+
+from data.archive import LogArchiver
+from data.migrate import ensure_schema
+from data.repositories import HabitRepository, UserRepository
+
+
+def _attached(connection):
+    return {row[1] for row in connection.execute("PRAGMA database_list")} - {"main", "temp"}
+
+
+def _seed(connection):
+    user_id = UserRepository(connection).create_user("archive@example.com", "hash")
+    habit_repo = HabitRepository(connection)
+    habit_repo.add_habit(user_id, {"name": "Leer", "frequency": "daily"})
+    habit_id = habit_repo.list_habits(user_id)[0]["id"]
+    for moment in (
+        datetime(2022, 3, 1, 8, 0),
+        datetime(2023, 2, 1, 9, 0),
+        datetime(2023, 11, 5, 10, 0),
+        datetime(2024, 5, 20, 7, 30),
+    ):
+        connection.execute(
+            "INSERT INTO habit_logs (user_id, habit_id, date, status, created_at) VALUES (?, ?, ?, ?, ?)",
+            [user_id, habit_id, moment.date().isoformat(), "completed", moment.isoformat()],
+        )
+    connection.commit()
+    return habit_repo, user_id, habit_id
+
+
+def test_archived_logs_stay_readable(tmp_path):
+    connection = sqlite3.connect(":memory:")
+    connection.row_factory = sqlite3.Row
+    ensure_schema(connection)
+    habit_repo, user_id, habit_id = _seed(connection)
+    expected = [log["created_at"] for log in habit_repo.list_all_logs(user_id)]
+
+    archiver = LogArchiver(tmp_path, retention_days=30)
+    moved = archiver.run(connection, now=datetime(2024, 6, 1))
+
+    assert moved == {2022: 1, 2023: 2}
+    assert archiver.path_for(2022).exists() and archiver.path_for(2023).exists()
+    assert connection.execute("SELECT COUNT(*) FROM habit_logs").fetchone()[0] == 1
+
+    for schema in _attached(connection):
+        connection.execute(f"DETACH DATABASE {schema}")
+    recent = habit_repo.list_logs_since(user_id, datetime(2024, 1, 1))
+    assert len(recent) == 1
+    assert _attached(connection) == set()
+
+    assert len(habit_repo.list_logs_since(user_id, datetime(2023, 6, 1))) == 2
+    assert _attached(connection) == {"archive_2023"}
+
+    assert [log["created_at"] for log in habit_repo.list_all_logs(user_id)] == expected
+    paged = habit_repo.iter_logs(user_id, page_size=1, columns=("status",))
+    assert [log["created_ts"] for log in paged] == [
+        log["created_ts"] for log in habit_repo.list_all_logs(user_id)
+    ]
+    assert habit_repo.rebuild_daily_stats(user_id) == 4
+
+    habit_repo.delete_habit(habit_id, user_id)
+    assert habit_repo.list_all_logs(user_id) == []
+
+
+def test_history_beyond_attach_limit_stays_readable_and_purgeable(tmp_path):
+    import pytest
+
+    from data.archive import MAX_ATTACHED_ARCHIVES
+    from data.purge import HabitPurger
+
+    connection = sqlite3.connect(tmp_path / "live.db")
+    connection.row_factory = sqlite3.Row
+    ensure_schema(connection)
+    habit_repo, user_id, habit_id = _seed(connection)
+    for year in range(2012, 2022):
+        connection.execute(
+            "INSERT INTO habit_logs (user_id, habit_id, date, status, created_at) VALUES (?, ?, ?, ?, ?)",
+            [user_id, habit_id, f"{year}-04-01", "completed", f"{year}-04-01T08:00:00"],
+        )
+    connection.commit()
+    expected = [log["created_ts"] for log in habit_repo.list_all_logs(user_id)]
+
+    archiver = LogArchiver(tmp_path / "archive", retention_days=30)
+    connection.execute("BEGIN")
+    with pytest.raises(RuntimeError):
+        archiver.run(connection, now=datetime(2024, 6, 1))
+    connection.rollback()
+    moved = archiver.run(connection, now=datetime(2024, 6, 1))
+    assert len(moved) == 12 > MAX_ATTACHED_ARCHIVES
+
+    assert [log["created_ts"] for log in habit_repo.list_all_logs(user_id)] == expected
+    paged = habit_repo.iter_logs(user_id, page_size=5, columns=("status",))
+    assert [log["created_ts"] for log in paged] == expected
+    with habit_repo.transaction(user_id=user_id):
+        # Nothing can be attached mid-transaction; the archives are read without it.
+        assert len(habit_repo.list_all_logs(user_id)) == len(expected)
+    assert not connection.in_transaction
+
+    habit_repo.delete_habit(habit_id, user_id)
+    purger = HabitPurger(connection, chunk_size=3, pause=0)
+    purger.run_pending()
+    assert purger.progress(habit_id)["status"] == "done"
+    assert purger.progress(habit_id)["purged_logs"] == len(expected)
+    for year in moved:
+        archived = sqlite3.connect(archiver.path_for(year))
+        assert archived.execute("SELECT COUNT(*) FROM habit_logs").fetchone()[0] == 0
+        archived.close()
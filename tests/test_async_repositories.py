@@ -0,0 +1,73 @@
+import asyncio
+import time
+
+import pytest
+
+from data.async_repositories import (
+    AsyncHabitRepository,
+    AsyncSettingsRepository,
+    AsyncUserRepository,
+    DatabaseExecutor,
+)
+
+SLOW_QUERY = (
+    "WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM n WHERE x < 100000000) "
+    "SELECT COUNT(*) FROM n"
+)
+
+
+def test_async_repositories_serve_concurrent_clients(tmp_path):
+    async def scenario():
+        async with DatabaseExecutor(db_path=tmp_path / "async.db", workers=4) as executor:
+            users = AsyncUserRepository(executor)
+            habits = AsyncHabitRepository(executor)
+            settings = AsyncSettingsRepository(executor)
+
+            user_id = await users.create_user("async@example.com", "hash")
+            await habits.add_habit(user_id, {"name": "Leer", "frequency": "daily"})
+            habit_id = (await habits.list_habits(user_id))[0]["id"]
+            await asyncio.gather(
+                *(habits.log_action(habit_id, "completed", user_id=user_id) for _ in range(40))
+            )
+
+            def onboard(repository, user_id):
+                repository.add_habit(user_id, {"name": "Correr", "frequency": "daily"})
+                repository.log_action(habit_id, "skipped", user_id=user_id)
+
+            await habits.atomic(onboard, user_id, user_id=user_id)
+            await settings.set_many(user_id, {"theme": "nord"})
+
+            logs = [log async for log in habits.iter_logs(user_id, page_size=7, columns=("status",))]
+            assert len(logs) == 41
+            assert len(await habits.list_habits(user_id)) == 2
+            assert await settings.get(user_id, "theme") == "nord"
+            assert (await users.get_by_email("async@example.com"))["id"] == user_id
+
+    asyncio.run(scenario())
+
+
+def test_timeout_interrupts_running_query(tmp_path):
+    async def scenario():
+        async with DatabaseExecutor(db_path=tmp_path / "slow.db", workers=1) as executor:
+
+            def slow():
+                with executor.connections.connection() as connection:
+                    return connection.execute(SLOW_QUERY).fetchone()[0]
+
+            started = time.monotonic()
+            with pytest.raises(asyncio.TimeoutError):
+                await executor.run(slow, timeout=0.1)
+
+            # The lone worker is free again once the interrupted statement unwinds.
+            habits = AsyncHabitRepository(executor)
+            assert await habits.list_habits(1, timeout=5) == []
+            assert time.monotonic() - started < 5
+
+            task = asyncio.ensure_future(executor.run(slow))
+            await asyncio.sleep(0.1)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            assert await habits.habits_version(1, timeout=5) == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,124 @@
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+from data.archive import LogArchiver
+from data.backup import BackupService
+from data.database import ConnectionPool
+from data.repositories import HabitRepository, UserRepository
+
+
+def _setup(pool, log_count=300):
+    user_id = UserRepository(pool).create_user("backup@example.com", "hash")
+    habit_repo = HabitRepository(pool)
+    habit_repo.add_habit(user_id, {"name": "Leer", "frequency": "daily"})
+    habit_id = habit_repo.list_habits(user_id)[0]["id"]
+    start = datetime(2022, 1, 1, 8, 0)
+    habit_repo.log_actions_bulk(
+        [(habit_id, "completed", start + timedelta(days=day), "x" * 200) for day in range(log_count)],
+        user_id=user_id,
+    )
+    return habit_repo, user_id, habit_id
+
+
+def test_snapshot_copies_live_database_with_archives(tmp_path):
+    pool = ConnectionPool(tmp_path / "live.db", size=3, read_size=2)
+    try:
+        habit_repo, user_id, habit_id = _setup(pool)
+        with pool.connection() as connection:
+            LogArchiver().run(connection, now=datetime(2023, 6, 1))
+        expected = len(habit_repo.list_all_logs(user_id))
+
+        stop = threading.Event()
+
+        def keep_writing():
+            while not stop.is_set():
+                habit_repo.log_action(habit_id, "skipped", user_id=user_id)
+
+        writer = threading.Thread(target=keep_writing)
+        writer.start()
+        steps = []
+        service = BackupService(pool, tmp_path / "backups", step_pages=2, pause=0.001, keep=2)
+        try:
+            snapshot = service.snapshot(progress=lambda name, copied, total: steps.append(name))
+        finally:
+            stop.set()
+            writer.join()
+
+        assert service.verify(snapshot) == []
+        assert {"live.db", "archive/live/habit_logs_2022.db"} <= set(steps)
+        copy = sqlite3.connect(snapshot / "live.db")
+        archived = sqlite3.connect(snapshot / "archive/live/habit_logs_2022.db")
+        stored = copy.execute("SELECT COUNT(*) FROM habit_logs WHERE status = 'completed'").fetchone()[0]
+        assert stored + archived.execute("SELECT COUNT(*) FROM habit_logs").fetchone()[0] == expected
+
+        for _ in range(2):
+            service.snapshot()
+        assert len(service.snapshots()) == 2 and snapshot not in service.snapshots()
+    finally:
+        pool.close()
+
+
+def test_restore_verifies_and_rolls_back_live_data(tmp_path):
+    pool = ConnectionPool(tmp_path / "live.db", size=2)
+    try:
+        habit_repo, user_id, _ = _setup(pool, log_count=20)
+        service = BackupService(pool, tmp_path / "backups")
+        good = service.snapshot()
+        with pool.transaction() as connection:
+            connection.execute("DELETE FROM habit_logs")
+        assert habit_repo.list_all_logs(user_id) == []
+
+        restored = service.restore(good.name)
+        assert restored == [tmp_path / "live.db"]
+        assert len(habit_repo.list_all_logs(user_id)) == 20
+
+        broken = service.snapshot()
+        with open(broken / "live.db", "r+b") as handle:
+            handle.seek(200)
+            handle.write(b"\xff" * 64)
+        assert service.verify(broken) == ["live.db: checksum mismatch"]
+        with pytest.raises(ValueError):
+            service.restore()
+        assert [path.name for path in service.restore(good, target_dir=tmp_path / "inspect")] == ["live.db"]
+    finally:
+        pool.close()
+
+
+def test_snapshot_neither_doubles_nor_drops_logs_archived_mid_copy(tmp_path):
+    pool = ConnectionPool(tmp_path / "live.db", size=3, read_size=2)
+    try:
+        habit_repo, user_id, _ = _setup(pool, log_count=600)
+        with pool.connection() as connection:
+            LogArchiver(tmp_path / "archive").run(connection, now=datetime(2023, 6, 1))
+        expected = len(habit_repo.list_all_logs(user_id))
+
+        def archive_more():
+            with pool.connection() as connection:
+                LogArchiver(tmp_path / "archive").run(connection, now=datetime(2024, 6, 1))
+
+        archiver = threading.Thread(target=archive_more)
+
+        def progress(name, copied, total):
+            if name == "live.db" and not archiver.is_alive() and archiver.ident is None:
+                archiver.start()
+                archiver.join(0.3)
+
+        service = BackupService(pool, tmp_path / "backups", step_pages=1, pause=0)
+        snapshot = service.snapshot(progress=progress)
+        archiver.join()
+
+        copy = sqlite3.connect(snapshot / "live.db")
+        total = copy.execute("SELECT COUNT(*) FROM habit_logs").fetchone()[0]
+        for path in (snapshot / "archive").rglob("*.db"):
+            archived = sqlite3.connect(path)
+            total += archived.execute("SELECT COUNT(*) FROM habit_logs").fetchone()[0]
+            archived.close()
+        copy.close()
+        assert total == expected
+        # Archive copies are named after their shard file; 2023 was catalogued after the pin.
+        assert [path.name for path in (snapshot / "archive" / "live").iterdir()] == ["habit_logs_2022.db"]
+    finally:
+        pool.close()
@@ -0,0 +1,75 @@
+import random
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import parse_logs
+from data.compaction import compact_logs
+from data.migrate import ensure_schema
+from data.repositories import HabitRepository, UserRepository
+from domain.logic import BestHourCalculator, StreakCalculator, WildcardRule
+
+
+def _setup():
+    connection = sqlite3.connect(":memory:")
+    connection.row_factory = sqlite3.Row
+    ensure_schema(connection)
+    user_id = UserRepository(connection).create_user("compact@example.com", "hash")
+    habit_repo = HabitRepository(connection)
+    for name in ("Leer", "Correr"):
+        habit_repo.add_habit(user_id, {"name": name, "frequency": "daily"})
+    habit_ids = [habit["id"] for habit in habit_repo.list_habits(user_id)]
+    return connection, habit_repo, user_id, habit_ids
+
+
+def _results(habit_repo, user_id, days):
+    logs = parse_logs(habit_repo.list_all_logs(user_id))
+    return (
+        [StreakCalculator().calculate(logs, today=day) for day in days],
+        [WildcardRule().has_wildcard(logs, today=day) for day in days],
+        BestHourCalculator().best_hour(logs),
+        sorted(log["timestamp"].date() for log in logs),
+    )
+
+
+def test_compaction_keeps_domain_results_identical():
+    connection, habit_repo, user_id, habit_ids = _setup()
+    now = datetime(2024, 6, 1, 12, 0)
+    rng = random.Random(11)
+    records = []
+    for offset in range(30, 80):
+        day = now - timedelta(days=offset)
+        for habit_id in habit_ids:
+            for _ in range(rng.randint(0, 4)):
+                status = rng.choice(["completed", "completed", "skipped", "postponed"])
+                moment = day.replace(
+                    hour=rng.choice([7, 8, 20]), minute=rng.choice([0, 15]), second=rng.randint(0, 59)
+                )
+                records.append((habit_id, status, moment, None))
+    habit_repo.log_actions_bulk(records, user_id=user_id)
+    days = [(now - timedelta(days=offset)).date() for offset in range(28, 82, 3)]
+    before = _results(habit_repo, user_id, days)
+    stats_before = habit_repo.list_daily_stats(user_id)
+    raw_rows = connection.execute("SELECT COUNT(*) FROM habit_logs").fetchone()[0]
+
+    result = compact_logs(connection, days=45, now=now)
+
+    remaining = connection.execute("SELECT COUNT(*) FROM habit_logs").fetchone()[0]
+    assert result.rows_removed == raw_rows - remaining > 0
+    assert result.bytes_reclaimed >= 0
+    assert _results(habit_repo, user_id, days) == before
+    # Records expand summary rows in the cursor's row factory, across page boundaries too.
+    records = list(habit_repo.iter_log_records(user_id, page_size=7))
+    assert records == parse_logs(habit_repo.list_all_logs(user_id))
+    assert habit_repo.rebuild_daily_stats(user_id) == len(stats_before)
+    assert habit_repo.list_daily_stats(user_id) == stats_before
+    assert habit_repo.verify_streaks(user_id) == []
+
+    assert compact_logs(connection, days=45, now=now).rows_removed == 0
+
+
+def test_compaction_refuses_horizon_inside_reminder_window():
+    connection, _, _, _ = _setup()
+    with pytest.raises(ValueError):
+        compact_logs(connection, days=7)
@@ -0,0 +1,246 @@
+import sqlite3
+
+import pytest
+
+from data.database import transaction
+from data.migrate import ensure_schema
+from data.repositories import HabitRepository, SettingsRepository, UserRepository
+
+
+def _connection():
+    connection = sqlite3.connect(":memory:")
+    connection.row_factory = sqlite3.Row
+    ensure_schema(connection)
+    return connection
+
+
+def test_nested_operations_commit_once():
+    connection = _connection()
+    user_id = UserRepository(connection).create_user("tx@example.com", "hash")
+    habit_repo = HabitRepository(connection)
+    settings_repo = SettingsRepository(connection)
+    statements = []
+    connection.set_trace_callback(statements.append)
+
+    with transaction(connection):
+        habit_repo.seed_template(user_id, "study")
+        settings_repo.set(user_id, "onboarded", "1")
+
+    assert [statement for statement in statements if statement == "COMMIT"] == ["COMMIT"]
+    assert len(habit_repo.list_habits(user_id)) == 3
+
+
+def test_failed_transaction_rolls_back_everything():
+    connection = _connection()
+    user_id = UserRepository(connection).create_user("rollback@example.com", "hash")
+    settings_repo = SettingsRepository(connection)
+
+    with pytest.raises(RuntimeError):
+        with settings_repo.transaction():
+            settings_repo.set(user_id, "language", "en")
+            raise RuntimeError("boom")
+
+    assert settings_repo.get(user_id, "language") is None
+
+
+def test_savepoint_rolls_back_only_inner_block():
+    connection = _connection()
+    user_id = UserRepository(connection).create_user("savepoint@example.com", "hash")
+    settings_repo = SettingsRepository(connection)
+
+    with settings_repo.transaction():
+        settings_repo.set(user_id, "language", "en")
+        with pytest.raises(RuntimeError):
+            with settings_repo.transaction(savepoint=True):
+                settings_repo.set(user_id, "theme", "nord")
+                raise RuntimeError("boom")
+
+    assert settings_repo.get(user_id, "language") == "en"
+    assert settings_repo.get(user_id, "theme") is None
+
+
+def test_connection_pool_serves_concurrent_writers(tmp_path):
+    import threading
+
+    from data.database import ConnectionPool
+
+    pool = ConnectionPool(tmp_path / "pool.db", size=4, read_size=2)
+    user_id = UserRepository(pool).create_user("pool@example.com", "hash")
+    habit_repo = HabitRepository(pool)
+    habit_repo.add_habit(user_id, {"name": "Leer", "frequency": "daily"})
+    habit_id = habit_repo.list_habits(user_id)[0]["id"]
+
+    def click():
+        for _ in range(25):
+            habit_repo.log_action(habit_id, "completed", user_id=user_id)
+
+    threads = [threading.Thread(target=click) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(habit_repo.list_all_logs(user_id)) == 100
+    with pool.connection() as connection:
+        assert connection.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    with pool.reader.connection() as connection:
+        with pytest.raises(sqlite3.OperationalError):
+            connection.execute("DELETE FROM habit_logs")
+    pool.close()
+
+
+def test_pool_reads_inside_transaction_see_pending_writes(tmp_path):
+    from data.database import ConnectionPool
+
+    pool = ConnectionPool(tmp_path / "pool.db", size=2, read_size=2)
+    user_id = UserRepository(pool).create_user("pending@example.com", "hash")
+    settings_repo = SettingsRepository(pool)
+
+    with settings_repo.transaction():
+        settings_repo.set(user_id, "theme", "nord")
+        assert settings_repo.get(user_id, "theme") == "nord"
+    assert settings_repo.get(user_id, "theme") == "nord"
+    pool.close()
+
+
+
+def test_pool_never_opens_more_than_size_under_concurrent_checkouts(tmp_path, monkeypatch):
+    import threading
+    import time
+
+    from data import database
+    from data.database import ConnectionPool
+
+    pool = ConnectionPool(tmp_path / "pool.db", size=2)
+    ensure_schema = database.ensure_schema
+
+    def slow_ensure_schema(connection):
+        # Widen the gap between deciding to open and registering the connection.
+        time.sleep(0.05)
+        ensure_schema(connection)
+
+    monkeypatch.setattr(database, "ensure_schema", slow_ensure_schema)
+    start = threading.Barrier(6)
+
+    def use_pool():
+        start.wait()
+        with pool.connection() as connection:
+            connection.execute("SELECT 1").fetchone()
+            time.sleep(0.02)
+
+    threads = [threading.Thread(target=use_pool) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    try:
+        assert len(pool._connections) == 2
+    finally:
+        pool.close()
+
+def test_shard_router_routes_users_and_moves_them(tmp_path):
+    from datetime import datetime
+
+    from data.database import ShardRouter, shard_path
+
+    router = ShardRouter(shard_count=3, db_path=tmp_path / "miniwins.db", size=2)
+    user_repo = UserRepository(router)
+    habit_repo = HabitRepository(router)
+    settings_repo = SettingsRepository(router)
+    try:
+        users = [user_repo.create_user(f"shard{index}@example.com", "hash") for index in range(3)]
+        for user_id in users:
+            habit_repo.add_habit(user_id, {"name": f"Habit {user_id}", "frequency": "daily"})
+            habit_id = habit_repo.list_habits(user_id)[0]["id"]
+            habit_repo.log_actions_bulk(
+                [(habit_id, "completed", datetime(2024, 1, day, 8), None) for day in (1, 2)],
+                user_id=user_id,
+            )
+            settings_repo.set(user_id, "theme", f"theme-{user_id}")
+        # Every user sits on its own file, so habit ids repeat across shards.
+        assert {router.shard_for(user_id) for user_id in users} == {0, 1, 2}
+        assert {habit_repo.list_habits(user_id)[0]["id"] for user_id in users} == {1}
+        assert len(router.fan_out("SELECT id FROM habit_logs")) == 6
+
+        mover = users[1]
+        before = habit_repo.list_all_logs(mover)
+        target = (router.shard_for(mover) + 1) % 3
+        remapped = router.move_user(mover, target)
+
+        assert router.shard_for(mover) == target
+        assert list(remapped) == [1] and remapped[1] == 2
+        assert [habit["name"] for habit in habit_repo.list_habits(mover)] == [f"Habit {mover}"]
+        after = habit_repo.list_all_logs(mover)
+        assert [log["created_ts"] for log in after] == [log["created_ts"] for log in before]
+        assert {log["habit_id"] for log in after} == {2}
+        assert habit_repo.get_streak(mover, 2, today=datetime(2024, 1, 2))["current"] == 2
+        assert SettingsRepository(router).get(mover, "theme") == f"theme-{mover}"
+        assert habit_repo.verify_streaks() == []
+        assert shard_path(1, tmp_path / "miniwins.db").name == "miniwins.shard1.db"
+
+        old_shard = sqlite3.connect(shard_path(mover % 3, tmp_path / "miniwins.db"))
+        assert old_shard.execute("SELECT COUNT(*) FROM habit_logs WHERE user_id = ?", [mover]).fetchone()[0] == 0
+        old_shard.close()
+    finally:
+        router.close()
+
+
+def test_directory_strategy_fills_least_loaded_shard(tmp_path):
+    from data.database import ShardRouter
+
+    router = ShardRouter(shard_count=2, db_path=tmp_path / "miniwins.db", strategy="directory", size=1)
+    try:
+        assert router.shard_for(99) == 0
+        user_repo = UserRepository(router)
+        placed = [
+            router.shard_for(user_repo.create_user(f"dir{index}@example.com", "hash")) for index in range(4)
+        ]
+        assert sorted(placed) == [0, 0, 1, 1]
+    finally:
+        router.close()
+
+
+
+def test_move_user_flushes_and_remaps_queued_logs(tmp_path, monkeypatch):
+    import threading
+
+    from data import database
+    from data.database import ShardRouter
+    from data.write_behind import LogWriteQueue
+
+    router = ShardRouter(shard_count=2, db_path=tmp_path / "miniwins.db", size=2)
+    log_queue = LogWriteQueue(router, batch_size=100)
+    habit_repo = HabitRepository(router, log_queue=log_queue)
+    try:
+        user_id = UserRepository(router).create_user("queued@example.com", "hash")
+        habit_repo.add_habit(user_id, {"name": "Leer", "frequency": "daily"})
+        habit_id = habit_repo.list_habits(user_id)[0]["id"]
+        with pytest.raises(ValueError):
+            habit_repo.log_action(habit_id, "completed")
+        habit_repo.log_action(habit_id, "completed", user_id=user_id)
+
+        # Log again while the move is copying rows; that put waits for the new habit id.
+        late = threading.Thread(
+            target=habit_repo.log_action, args=(habit_id, "skipped"), kwargs={"user_id": user_id}
+        )
+        delete_user_rows = database._delete_user_rows
+
+        def log_while_moving(*args, **kwargs):
+            if late.ident is None:
+                late.start()
+                late.join(0.2)
+                assert late.is_alive()
+            return delete_user_rows(*args, **kwargs)
+
+        monkeypatch.setattr(database, "_delete_user_rows", log_while_moving)
+        remapped = router.move_user(user_id, 1 - router.shard_for(user_id))
+        late.join()
+        assert log_queue.pending(user_id)[0]["habit_id"] == remapped[habit_id]
+        log_queue.flush()
+
+        logs = habit_repo.list_all_logs(user_id)
+        assert sorted(log["status"] for log in logs) == ["completed", "skipped"]
+        assert {log["habit_id"] for log in logs} == {remapped[habit_id]}
+        assert log_queue.parked == []
+    finally:
+        router.close()
@@ -0,0 +1,65 @@
+import random
+import sqlite3
+from datetime import datetime, timedelta
+
+from data.histograms import rebuild_minute_histograms
+from data.migrate import ensure_schema
+from data.repositories import HabitRepository, UserRepository
+from domain.logic import BestHourCalculator, MinuteHistogram
+
+
+def _setup():
+    connection = sqlite3.connect(":memory:")
+    connection.row_factory = sqlite3.Row
+    ensure_schema(connection)
+    user_id = UserRepository(connection).create_user("hist@example.com", "hash")
+    habit_repo = HabitRepository(connection)
+    for name in ("Leer", "Correr"):
+        habit_repo.add_habit(user_id, {"name": name, "frequency": "daily"})
+    return connection, habit_repo, user_id, [habit["id"] for habit in habit_repo.list_habits(user_id)]
+
+
+def _normalized(histogram):
+    total = sum(histogram.buckets)
+    return [round(weight / total, 9) for weight in histogram.buckets]
+
+
+def test_histogram_matches_reference_calculator():
+    rng = random.Random(5)
+    for _ in range(200):
+        logs = [
+            {
+                "timestamp": datetime(2024, 1, 1, rng.choice([7, 8, 19]), rng.randint(0, 59)),
+                "status": rng.choice(["completed", "completed", "skipped"]),
+            }
+            for _ in range(rng.randint(0, 15))
+        ]
+        hours = [log["timestamp"].hour for log in logs if log["status"] == "completed"]
+        counts = sorted((hours.count(hour) for hour in set(hours)), reverse=True)
+        if len(counts) > 1 and counts[0] == counts[1]:
+            continue  # Ties resolve differently by design.
+        assert MinuteHistogram.from_logs(logs).best_hour() == BestHourCalculator().best_hour(logs)
+
+
+def test_persistent_histograms_decay_and_follow_deletes():
+    connection, habit_repo, user_id, (first, second) = _setup()
+    now = datetime(2024, 6, 1, 12, 0)
+    records = [(first, "completed", now - timedelta(days=60, minutes=offset), None) for offset in (0, 5, 10)]
+    records = [(habit_id, status, moment.replace(hour=8), note) for habit_id, status, moment, note in records]
+    records += [(second, "completed", now.replace(hour=20, minute=minute), None) for minute in (15, 45)]
+    records.append((second, "skipped", now.replace(hour=6), None))
+    habit_repo.log_actions_bulk(records, user_id=user_id)
+
+    # Three old completions at 08:xx lose to two recent ones at 20:xx.
+    logs = [{"timestamp": record[2], "status": record[1]} for record in records]
+    assert BestHourCalculator().best_hour(logs)[0] == 8
+    assert habit_repo.minute_histogram(user_id).best_hour() == (20, 45)
+    assert habit_repo.minute_histogram(user_id, first).best_hour() == (8, 50)
+
+    incremental = _normalized(habit_repo.minute_histogram(user_id))
+    rebuild_minute_histograms(connection, user_id)
+    assert _normalized(habit_repo.minute_histogram(user_id)) == incremental
+
+    habit_repo.delete_habit(second, user_id=user_id)
+    assert habit_repo.minute_histogram(user_id).best_hour() == (8, 50)
+    assert habit_repo.minute_histogram(user_id, second).best_hour() is None
@@ -0,0 +1,85 @@
+import sqlite3
+
+from data.instrumentation import RECORDER, QueryRecorder, fingerprint, run_query
+from data.migrate import ensure_schema
+from data.repositories import LIST_HABITS_QUERY, HabitRepository, UserRepository
+
+
+def test_fingerprint_groups_literals_and_placeholder_lists():
+    assert fingerprint("SELECT *  FROM habits\n WHERE id = 7 AND name = 'it''s'") == (
+        "SELECT * FROM habits WHERE id = ? AND name = ?"
+    )
+    assert fingerprint("DELETE FROM t WHERE id IN (?, ?,?)") == fingerprint("DELETE FROM t WHERE id IN (?,?)")
+    assert fingerprint("SELECT * FROM archive_2023.habit_logs") == "SELECT * FROM archive_2023.habit_logs"
+
+
+def test_repository_queries_are_recorded_per_capture():
+    connection = sqlite3.connect(":memory:")
+    connection.row_factory = sqlite3.Row
+    ensure_schema(connection)
+    user_id = UserRepository(connection).create_user("stats@example.com", "hash")
+    habit_repo = HabitRepository(connection)
+    for name in ("Leer", "Correr"):
+        habit_repo.add_habit(user_id, {"name": name, "frequency": "daily"})
+
+    with RECORDER.capture() as report:
+        habit_repo.list_habits(user_id)
+        habit_repo.list_habits(user_id)
+        habit_repo.habits_version(user_id)
+    # The second list_habits call is served from the habit cache after a version check.
+    stats = report.stats[fingerprint(LIST_HABITS_QUERY)]
+    assert (stats.calls, stats.rows) == (1, 2)
+    assert sum(stats.histogram().values()) == 1
+    assert report.calls == 4
+    assert report.rows()[0]["total_ms"] >= report.rows()[-1]["total_ms"]
+    assert RECORDER.snapshot()[fingerprint(LIST_HABITS_QUERY)].calls >= 1
+
+
+def test_write_path_records_every_statement_it_runs():
+    connection = sqlite3.connect(":memory:")
+    connection.row_factory = sqlite3.Row
+    ensure_schema(connection)
+    user_id = UserRepository(connection).create_user("trace@example.com", "hash")
+    habit_repo = HabitRepository(connection)
+    habit_repo.add_habit(user_id, {"name": "Leer", "frequency": "daily"})
+    habit_id = habit_repo.list_habits(user_id)[0]["id"]
+    # Warm up so statements re-prepared after ANALYZE are not traced twice.
+    habit_repo.log_action(habit_id, "skipped", user_id=user_id)
+
+    traced = []
+    connection.set_trace_callback(traced.append)
+    with RECORDER.capture() as report:
+        habit_repo.log_action(habit_id, "completed", user_id=user_id)
+        habit_repo.get_streak(user_id)
+        habit_repo.list_daily_stats(user_id)
+        habit_repo.minute_histogram(user_id, habit_id)
+    connection.set_trace_callback(None)
+    control = ("BEGIN", "COMMIT", "ROLLBACK", "SAVEPOINT", "RELEASE")
+    # A trigger program is traced again with the text of the statement that fired it.
+    statements = [
+        sql
+        for index, sql in enumerate(traced)
+        if not sql.lstrip().upper().startswith(control) and (index == 0 or sql != traced[index - 1])
+    ]
+    assert report.calls == len(statements)
+    for table in ("habit_daily_stats", "streak_state", "minute_histograms"):
+        assert any(f"INSERT INTO {table} " in query for query in report.stats)
+
+
+def test_slow_query_log_honours_threshold(tmp_path):
+    connection = sqlite3.connect(":memory:")
+    recorder = QueryRecorder(slow_threshold_ms=10_000, slow_log_path=tmp_path / "slow.log")
+    run_query(connection, "SELECT 1", fetch="one", recorder=recorder)
+    assert not recorder.slow_queries
+
+    recorder.slow_threshold_ms = 0
+    connection.execute("CREATE TABLE t (x)")
+    cursor = run_query(connection, "INSERT INTO t VALUES (1), (2)", recorder=recorder)
+    assert cursor.rowcount == 2
+    assert [(entry.fingerprint, entry.rows) for entry in recorder.slow_queries] == [
+        ("INSERT INTO t VALUES (?), (?)", 2)
+    ]
+    assert "INSERT INTO t VALUES" in (tmp_path / "slow.log").read_text(encoding="utf-8")
+
+    recorder.reset()
+    assert not recorder.stats and not recorder.slow_queries
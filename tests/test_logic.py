@@ -3,9 +3,18 @@ import unittest
 from pathlib import Path
 
 sys.path.append(str(Path(__file__).resolve().parents[1]))
+import random
 from datetime import datetime, timedelta
 
-from domain.logic import StreakCalculator, XpCalculator, BestHourCalculator, SmartReminderEngine, WildcardRule
+from domain.logic import (
+    StreakCalculator,
+    XpCalculator,
+    BestHourCalculator,
+    LogAnalyzer,
+    SmartReminderEngine,
+    WeekdaySchedule,
+    WildcardRule,
+)
 
 
 class LogicTests(unittest.TestCase):
@@ -51,6 +60,63 @@ class LogicTests(unittest.TestCase):
         result = SmartReminderEngine().analyze(logs)
         self.assertEqual("soft", result["intensity"])
 
+    def test_log_analyzer_matches_individual_passes(self):
+        rng = random.Random(11)
+        now = datetime(2024, 3, 14, 12, 0)
+        for _ in range(300):
+            logs = [
+                {
+                    "timestamp": now - timedelta(days=rng.randint(0, 20), hours=rng.choice([0, 1, 5])),
+                    "status": rng.choice(["completed", "completed", "skipped", "postponed"]),
+                }
+                for _ in range(rng.randint(0, 25))
+            ]
+            dnd_start, dnd_end = rng.choice([(22, 7), (10, 11), (1, 23)])
+            schedule = rng.choice([None, WeekdaySchedule(rng.randint(1, 127))])
+            streak = StreakCalculator().calculate(logs, now.date(), schedule=schedule)
+            recent = [log for log in logs if log["timestamp"] >= now - timedelta(days=14)]
+            result = LogAnalyzer().analyze(
+                iter(logs), now=now, total_xp=40, dnd_start=dnd_start, dnd_end=dnd_end, schedule=schedule
+            )
+            self.assertEqual(streak, result["streak"])
+            self.assertEqual(XpCalculator().calculate(40, streak), result["xp"])
+            self.assertEqual(WildcardRule().has_wildcard(logs, now.date()), result["wildcard"])
+            self.assertEqual(BestHourCalculator().best_hour(recent), result["best_hour"])
+            self.assertEqual(
+                SmartReminderEngine().analyze(logs, dnd_start, dnd_end, now=now), result["reminder"]
+            )
+            self.assertEqual(
+                LogAnalyzer().recommend(iter(logs), now=now, dnd_start=dnd_start, dnd_end=dnd_end),
+                result["reminder"],
+            )
+
+    def test_weekday_schedule_streaks_match_day_by_day_walk(self):
+        rng = random.Random(3)
+        for _ in range(300):
+            schedule = WeekdaySchedule(rng.randint(1, 127))
+            today = datetime(2024, 3, 10).date() + timedelta(days=rng.randint(0, 6))
+            done = {today - timedelta(days=rng.randint(-3, 40)) for _ in range(rng.randint(1, 30))}
+            span = (max(done | {today}) - min(done)).days + 1
+            walk = [
+                day
+                for day in (min(done) + timedelta(days=step) for step in range(span))
+                if schedule.is_due(day)
+            ]
+            runs, run = [0], 0
+            for day in walk:
+                run = run + 1 if day in done else 0
+                runs.append(run)
+            current = 0
+            for day in reversed([day for day in walk if day <= today]):
+                if day not in done:
+                    break
+                current += 1
+            self.assertEqual((current, max(runs)), schedule.streaks(done, today))
+        self.assertEqual("MON,WED,FRI", WeekdaySchedule.parse("weekly", "fri, mon,WED").days)
+        self.assertEqual(127, WeekdaySchedule.parse("daily", "MON").mask)
+        with self.assertRaises(ValueError):
+            WeekdaySchedule.parse("weekly", "MON,FUNDAY")
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,9 +1,17 @@
 from datetime import datetime, timedelta
 import sqlite3
 
+import dataclasses
+
+import pytest
+
 from app import parse_log_timestamp
+from data.models import COMPLETED, HabitLog
 from data.migrate import ensure_schema
 from data.repositories import HabitRepository, UserRepository
+from data.write_behind import LogWriteQueue
+from domain.logic import StreakCalculator
+from services.smart_reminders import SmartReminderService
 
 
 def _connection():
@@ -40,9 +48,110 @@ def test_list_logs_since_filters_and_normalizes():
     assert len(logs) == 1
     assert logs[0]["created_at"] == recent.isoformat()
     assert logs[0]["date"] == recent.date().isoformat()
+    assert logs[0]["created_ts"] == int((recent - datetime(1970, 1, 1)).total_seconds())
+    assert logs[0]["day"] == (recent.date() - datetime(1970, 1, 1).date()).days
 
 
 def test_parse_log_timestamp_fallback():
     log = {"timestamp": "2024-01-02T03:04:05"}
     assert parse_log_timestamp(log) == datetime.fromisoformat("2024-01-02T03:04:05")
     assert parse_log_timestamp({"status": "completed"}) is None
+    assert parse_log_timestamp({"created_ts": 86400 + 3600}) == datetime(1970, 1, 2, 1, 0)
+
+
+def _seed_logs(connection, user_id, habit_id, timestamps):
+    connection.executemany(
+        "INSERT INTO habit_logs (user_id, habit_id, date, status, created_at) VALUES (?, ?, ?, ?, ?)",
+        [
+            [user_id, habit_id, moment.date().isoformat(), "completed", moment.isoformat()]
+            for moment in timestamps
+        ],
+    )
+    connection.commit()
+
+
+def test_iter_logs_pages_by_created_at_and_id():
+    connection = _connection()
+    user_id = UserRepository(connection).create_user("pages@example.com", "hash")
+    habit_repo = HabitRepository(connection)
+    habit_repo.add_habit(user_id, {"name": "Leer", "frequency": "daily"})
+    habit_id = habit_repo.list_habits(user_id)[0]["id"]
+    base = datetime(2024, 1, 10, 12, 0, 0)
+    # Duplicate timestamps force the id tie-breaker across page boundaries.
+    _seed_logs(connection, user_id, habit_id, [base, base, base, base - timedelta(days=1), base])
+
+    logs = list(habit_repo.iter_logs(user_id, page_size=2, columns=("status",)))
+    assert [log["id"] for log in logs] == [5, 3, 2, 1, 4]
+    assert set(logs[0]) == {"id", "created_ts", "day", "status"}
+
+    window = list(
+        habit_repo.iter_logs(user_id, since=base - timedelta(hours=1), until=base, page_size=2)
+    )
+    assert window == []
+    assert len(list(habit_repo.iter_logs(user_id, since=base.date(), page_size=2))) == 4
+
+
+def test_iter_log_records_yields_frozen_records_with_queued_events():
+    connection = _connection()
+    user_id = UserRepository(connection).create_user("records@example.com", "hash")
+    habit_repo = HabitRepository(connection)
+    habit_repo.add_habit(user_id, {"name": "Leer", "frequency": "daily"})
+    habit_id = habit_repo.list_habits(user_id)[0]["id"]
+    base = datetime(2024, 1, 10, 12, 0, 0)
+    _seed_logs(connection, user_id, habit_id, [base - timedelta(days=1), base])
+    queued = HabitRepository(connection, log_queue=LogWriteQueue(connection, durability="batched"))
+    queued.log_action(habit_id, "skipped", note="later", user_id=user_id)
+
+    records = list(queued.iter_log_records(user_id, page_size=1))
+    assert [type(record) for record in records] == [HabitLog] * 3
+    assert [record.status for record in records] == ["skipped", "completed", "completed"]
+    assert [record.timestamp for record in records[1:]] == [base, base - timedelta(days=1)]
+    assert records[0].note == "later" and records[0].id is None
+    assert records[1]["status"] == "completed" and records[1].status_code == COMPLETED
+    assert records[1].created_ts == int((base - datetime(1970, 1, 1)).total_seconds())
+    assert StreakCalculator().calculate(records, base.date()) == 2
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        records[1].status_code = 0
+
+
+def test_records_skip_unknown_statuses_and_untimed_legacy_rows():
+    connection = _connection()
+    user_id = UserRepository(connection).create_user("legacy-records@example.com", "hash")
+    habit_repo = HabitRepository(connection)
+    habit_repo.add_habit(user_id, {"name": "Leer", "frequency": "daily"})
+    habit_id = habit_repo.list_habits(user_id)[0]["id"]
+    with pytest.raises(ValueError):
+        habit_repo.log_action(habit_id, "done", user_id=user_id)
+    assert habit_repo.log_actions_bulk([(habit_id, "done", None, None)], user_id=user_id) == ["invalid"]
+
+    base = datetime(2024, 1, 10, 12, 0, 0)
+    _seed_logs(connection, user_id, habit_id, [base - timedelta(days=2), base - timedelta(days=1), base])
+    # A status from an older client and a created_at the epoch backfill could not parse.
+    connection.execute("UPDATE habit_logs SET status = 'done' WHERE created_at = ?", [base.isoformat()])
+    connection.execute(
+        "UPDATE habit_logs SET created_at = 'yesterday', created_ts = NULL, day = NULL "
+        "WHERE created_at = ?",
+        [(base - timedelta(days=2)).isoformat()],
+    )
+    connection.commit()
+
+    records = list(habit_repo.iter_log_records(user_id, page_size=1))
+    assert [(record.status, record.timestamp) for record in records] == [
+        ("completed", base - timedelta(days=1))
+    ]
+
+
+def test_reminders_take_habit_log_records():
+    connection = _connection()
+    user_id = UserRepository(connection).create_user("reminder@example.com", "hash")
+    habit_repo = HabitRepository(connection)
+    habit_repo.add_habit(user_id, {"name": "Leer", "frequency": "daily"})
+    habit_id = habit_repo.list_habits(user_id)[0]["id"]
+    now = datetime.utcnow().replace(hour=19, minute=30, second=0, microsecond=0)
+    _seed_logs(connection, user_id, habit_id, [now - timedelta(days=day) for day in range(3)])
+
+    service = SmartReminderService()
+    records = habit_repo.iter_log_records(user_id, since=now.date() - timedelta(days=13))
+    assert service.build_recommendation(records, 22, 7)["suggested"] == (19, 30)
+    analysis = service.analyze(list(habit_repo.iter_log_records(user_id)), 22, 7, now=now)
+    assert analysis["streak"] == 3 and analysis["best_hour"] == (19, 30)
@@ -0,0 +1,144 @@
+import sqlite3
+
+import pytest
+
+from data.migrate import ensure_schema, latest_version, schema_version
+
+
+def _legacy_connection():
+    connection = sqlite3.connect(":memory:")
+    connection.row_factory = sqlite3.Row
+    connection.execute(
+        "CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, email TEXT NOT NULL UNIQUE, "
+        "password_hash TEXT NOT NULL)"
+    )
+    connection.execute(
+        "CREATE TABLE habits (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, "
+        "frequency TEXT NOT NULL)"
+    )
+    connection.execute(
+        "CREATE TABLE habit_logs (id INTEGER PRIMARY KEY AUTOINCREMENT, habit_id INTEGER NOT NULL, "
+        "status TEXT NOT NULL, timestamp TEXT NOT NULL)"
+    )
+    connection.execute("INSERT INTO users (email, password_hash) VALUES ('old@example.com', 'hash')")
+    connection.execute("INSERT INTO habits (name, frequency) VALUES ('Leer', 'daily')")
+    connection.executemany(
+        "INSERT INTO habit_logs (habit_id, status, timestamp) VALUES (1, 'completed', ?)",
+        [["2023-05-0%dT08:00:00" % day] for day in range(1, 8)],
+    )
+    connection.commit()
+    return connection
+
+
+def test_legacy_database_is_migrated_once(monkeypatch):
+    from data import migrate
+
+    monkeypatch.setattr(migrate, "BACKFILL_BATCH_SIZE", 3)
+    connection = _legacy_connection()
+    ensure_schema(connection)
+
+    assert schema_version(connection) == latest_version()
+    rows = connection.execute(
+        "SELECT created_at, timestamp, created_ts, day FROM habit_logs ORDER BY id"
+    ).fetchall()
+    assert all(row["created_at"] == row["timestamp"] for row in rows)
+    assert rows[0]["created_ts"] == 1682928000
+    assert rows[0]["day"] == 19478
+    assert connection.execute("SELECT created_at FROM users").fetchone()[0] != ""
+
+    statements = []
+    connection.set_trace_callback(statements.append)
+    ensure_schema(connection)
+    assert statements == ["PRAGMA foreign_keys = ON", "PRAGMA user_version"]
+
+
+def test_habit_logs_rebuild_aborts_on_orphaned_logs():
+    connection = _legacy_connection()
+    connection.execute(
+        "INSERT INTO habit_logs (habit_id, status, timestamp) VALUES (99, 'completed', '2023-05-08T08:00:00')"
+    )
+    connection.commit()
+    with pytest.raises(sqlite3.IntegrityError):
+        ensure_schema(connection)
+
+    assert schema_version(connection) == 10
+    table_sql = connection.execute("SELECT sql FROM sqlite_master WHERE name = 'habit_logs'").fetchone()[0]
+    assert "CASCADE" not in table_sql.upper()
+    assert connection.execute("SELECT COUNT(*) FROM habit_logs").fetchone()[0] == 8
+    assert connection.execute("PRAGMA foreign_keys").fetchone()[0] == 1
+
+
+def test_hot_queries_use_indexes():
+    from data.repositories import HabitRepository
+
+    connection = sqlite3.connect(":memory:")
+    connection.row_factory = sqlite3.Row
+    ensure_schema(connection)
+
+    usage = HabitRepository(connection).check_index_usage()
+    assert usage and all(usage.values()), usage
+
+
+def test_analyze_runs_only_when_due():
+    from datetime import datetime, timedelta
+
+    from data.migrate import analyze_if_due
+
+    connection = sqlite3.connect(":memory:")
+    ensure_schema(connection)
+    now = datetime(2024, 1, 1)
+
+    assert analyze_if_due(connection, now=now)
+    assert not analyze_if_due(connection, now=now + timedelta(days=1))
+    assert analyze_if_due(connection, now=now + timedelta(days=8))
+
+
+def test_weekly_template_habits_get_their_schedule_back():
+    connection = _legacy_connection()
+    connection.execute("INSERT INTO habits (name, frequency) VALUES ('Ejercicio', 'weekly')")
+    # 2023-05-01 was a Monday; Saturday is off the MON,WED,FRI schedule.
+    connection.executemany(
+        "INSERT INTO habit_logs (habit_id, status, timestamp) VALUES (2, 'completed', ?)",
+        [["2023-05-0%dT08:00:00" % day] for day in (1, 3, 5, 6)],
+    )
+    connection.commit()
+    ensure_schema(connection)
+
+    habits = connection.execute("SELECT name, days, days_mask FROM habits ORDER BY id").fetchall()
+    assert [tuple(row) for row in habits] == [("Leer", None, 127), ("Ejercicio", "MON,WED,FRI", 21)]
+    state = connection.execute(
+        "SELECT current_streak, longest_streak, last_completed_day FROM streak_state WHERE habit_id = 2"
+    ).fetchone()
+    assert tuple(state) == (3, 3, 19482)
+
+
+def test_batched_migration_stops_once_another_connection_finished_it(tmp_path):
+    from data import migrate
+
+    path = tmp_path / "legacy.db"
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE items (id INTEGER PRIMARY KEY, label TEXT NOT NULL)")
+    connection.executemany("INSERT INTO items (label) VALUES ('')", [[]] * 5)
+    connection.commit()
+    other = sqlite3.connect(path)
+
+    def backfill(connection):
+        while True:
+            with migrate._migration_batch(connection) as pending:
+                if not pending:
+                    return
+                cursor = connection.execute(
+                    "UPDATE items SET label = 'done' "
+                    "WHERE id IN (SELECT id FROM items WHERE label = '' LIMIT 2)"
+                )
+            if cursor.rowcount < 2:
+                return
+            # Another process finishes the migration between two batches.
+            other.execute("PRAGMA user_version = 1")
+
+    migrate._apply_migration(connection, migrate.Migration(1, "backfill_items", backfill, batched=True))
+
+    assert schema_version(connection) == 1
+    assert connection.execute("SELECT COUNT(*) FROM items WHERE label = 'done'").fetchone()[0] == 2
+    other.close()
+    connection.close()
@@ -0,0 +1,105 @@
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+from data.database import ConnectionPool
+from data.migrate import ensure_schema
+from data.purge import HabitPurger
+from data.repositories import HabitRepository, UserRepository
+
+
+def _setup(connection, log_count=23):
+    user_id = UserRepository(connection).create_user("purge@example.com", "hash")
+    habit_repo = HabitRepository(connection)
+    for name in ("Leer", "Correr"):
+        habit_repo.add_habit(user_id, {"name": name, "frequency": "daily"})
+    doomed, kept = [habit["id"] for habit in habit_repo.list_habits(user_id)]
+    start = datetime(2024, 1, 1, 8, 0)
+    records = [(doomed, "completed", start + timedelta(days=day), None) for day in range(log_count)]
+    records.append((kept, "completed", start, None))
+    habit_repo.log_actions_bulk(records, user_id=user_id)
+    return habit_repo, user_id, doomed, kept
+
+
+def test_delete_habit_hides_at_once_and_purges_in_chunks():
+    connection = sqlite3.connect(":memory:")
+    connection.row_factory = sqlite3.Row
+    ensure_schema(connection)
+    habit_repo, user_id, doomed, kept = _setup(connection)
+    purger = HabitPurger(connection, chunk_size=10, pause=0)
+
+    habit_repo.delete_habit(doomed, user_id=user_id)
+    assert [habit["id"] for habit in habit_repo.list_habits(user_id)] == [kept]
+    assert [log["habit_id"] for log in habit_repo.list_all_logs(user_id)] == [kept]
+    assert habit_repo.list_daily_stats(user_id)[0]["completed"] == 1
+    assert habit_repo.verify_streaks(user_id) == []
+    assert purger.progress(doomed)["status"] == "pending"
+
+    assert purger.run_pending(max_chunks=1) == 1
+    progress = purger.progress(doomed)
+    assert (progress["status"], progress["total_logs"], progress["purged_logs"]) == ("purging", 23, 10)
+
+    assert purger.run_pending() == 2
+    assert purger.progress(doomed)["status"] == "done"
+    logs_left = connection.execute("SELECT COUNT(*) FROM habit_logs WHERE habit_id = ?", [doomed])
+    assert logs_left.fetchone()[0] == 0
+    assert connection.execute("SELECT COUNT(*) FROM habits WHERE id = ?", [doomed]).fetchone()[0] == 0
+    assert purger.run_pending() == 0
+
+
+def test_habit_logs_cascade_with_habit_row():
+    connection = sqlite3.connect(":memory:")
+    connection.row_factory = sqlite3.Row
+    ensure_schema(connection)
+    _, _, doomed, kept = _setup(connection, log_count=3)
+
+    connection.execute("DELETE FROM habits WHERE id = ?", [doomed])
+    connection.commit()
+    assert [row[0] for row in connection.execute("SELECT DISTINCT habit_id FROM habit_logs")] == [kept]
+
+
+def test_background_purger_drains_queue(tmp_path):
+    pool = ConnectionPool(tmp_path / "purge.db", size=2)
+    habit_repo, user_id, doomed, _ = _setup(pool, log_count=5)
+    purger = HabitPurger(pool, chunk_size=2, pause=0, poll_interval=0.05).start()
+    try:
+        habit_repo.delete_habit(doomed, user_id=user_id)
+        purger.wake()
+        deadline = time.monotonic() + 5
+        while purger.progress(doomed)["status"] != "done" and time.monotonic() < deadline:
+            time.sleep(0.02)
+        assert purger.progress(doomed)["status"] == "done"
+        assert purger.last_error is None
+    finally:
+        purger.stop(timeout=5)
+        pool.close()
+
+
+def test_background_purger_survives_unexpected_errors(tmp_path, monkeypatch):
+    pool = ConnectionPool(tmp_path / "purge-errors.db", size=2)
+    habit_repo, user_id, doomed, _ = _setup(pool, log_count=5)
+    purger = HabitPurger(pool, chunk_size=2, pause=0, poll_interval=0.01, max_backoff=0.05)
+    purge_chunk = purger.purge_chunk
+    failures = []
+
+    def flaky_chunk(habit_id):
+        if len(failures) < 3:
+            failures.append(habit_id)
+            raise KeyError(habit_id)
+        return purge_chunk(habit_id)
+
+    monkeypatch.setattr(purger, "purge_chunk", flaky_chunk)
+    habit_repo.delete_habit(doomed, user_id=user_id)
+    purger.start()
+    try:
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            if purger.progress(doomed)["status"] == "done" and purger.last_error is None:
+                break
+            time.sleep(0.02)
+        assert failures == [doomed] * 3
+        assert purger.running and purger.progress(doomed)["status"] == "done"
+        assert purger.last_error is None
+    finally:
+        purger.stop(timeout=5)
+        pool.close()
@@ -0,0 +1,144 @@
+import random
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+
+from data.migrate import ensure_schema
+from data.repositories import HabitRepository, UserRepository
+from data.seed import seed_templates
+from data.streaks import habit_schedules
+from domain.logic import StreakCalculator, WeekdaySchedule, WildcardRule
+
+
+def _connection():
+    connection = sqlite3.connect(":memory:")
+    connection.row_factory = sqlite3.Row
+    ensure_schema(connection)
+    return connection
+
+
+def _setup(habit_count=2):
+    connection = _connection()
+    user_id = UserRepository(connection).create_user("streaks@example.com", "hash")
+    habit_repo = HabitRepository(connection)
+    for index in range(habit_count):
+        habit_repo.add_habit(user_id, {"name": f"Habit {index}", "frequency": "daily"})
+    habit_ids = [habit["id"] for habit in habit_repo.list_habits(user_id)]
+    return connection, habit_repo, user_id, habit_ids
+
+
+def test_materialized_streaks_match_streak_calculator():
+    connection, habit_repo, user_id, habit_ids = _setup()
+    today = datetime(2024, 3, 20)
+    rng = random.Random(7)
+    records = []
+    for offset in range(60):
+        for habit_id in habit_ids:
+            if rng.random() < 0.8:
+                status = rng.choice(["completed", "completed", "skipped", "postponed"])
+                moment = today - timedelta(days=offset, hours=rng.randint(0, 5))
+                records.append((habit_id, status, moment, None))
+    # Ingest newest first so the single-row path sees backdated completions.
+    for habit_id, status, moment, _ in records[:20]:
+        habit_repo.log_actions_bulk([(habit_id, status, moment, None)], user_id=user_id)
+    habit_repo.log_actions_bulk(records[20:], user_id=user_id)
+
+    parsed = [
+        {"timestamp": moment, "status": status, "habit_id": habit_id}
+        for habit_id, status, moment, _ in records
+    ]
+    expected_user = StreakCalculator().calculate(parsed, today.date())
+    assert habit_repo.get_streak(user_id, today=today.date())["current"] == expected_user
+    streaks = habit_repo.list_habit_streaks(user_id, today=today.date())
+    for habit_id in habit_ids:
+        habit_logs = [log for log in parsed if log["habit_id"] == habit_id]
+        assert streaks[habit_id]["current"] == StreakCalculator().calculate(habit_logs, today.date())
+    assert habit_repo.has_wildcard(user_id, today.date()) == WildcardRule().has_wildcard(parsed, today.date())
+    assert habit_repo.verify_streaks(user_id) == []
+
+
+def test_incremental_streak_updates_and_verifier_repairs():
+    connection, habit_repo, user_id, habit_ids = _setup(habit_count=1)
+    habit_id = habit_ids[0]
+    for _ in range(2):
+        habit_repo.log_action(habit_id, "completed", user_id=user_id)
+    streak = habit_repo.get_streak(user_id, habit_id)
+    assert (streak["current"], streak["longest"]) == (1, 1)
+    assert habit_repo.has_wildcard(user_id)
+
+    connection.execute("UPDATE streak_state SET longest_streak = 9")
+    connection.commit()
+    assert habit_repo.verify_streaks(user_id) == [(user_id, 0), (user_id, habit_id)]
+    habit_repo.verify_streaks(user_id, repair=True)
+    assert habit_repo.verify_streaks(user_id) == []
+
+    habit_repo.log_action(habit_id, "skipped", user_id=user_id)
+    assert not habit_repo.has_wildcard(user_id)
+    habit_repo.delete_habit(habit_id)
+    assert habit_repo.get_streak(user_id)["longest"] == 0
+    assert habit_repo.has_wildcard(user_id)
+
+
+def test_bulk_ingest_of_postponed_only_habits_verifies_clean():
+    connection, habit_repo, user_id, habit_ids = _setup(habit_count=3)
+    done, postponed, idle = habit_ids
+    start = datetime(2024, 3, 18, 9, 0)
+    records = [(postponed, "postponed", start + timedelta(days=day), None) for day in range(3)]
+    records.append((done, "completed", start, None))
+    habit_repo.log_actions_bulk(records, user_id=user_id)
+
+    states = {row["habit_id"] for row in connection.execute("SELECT habit_id FROM streak_state")}
+    assert states == {0, done}
+    assert habit_repo.verify_streaks(user_id) == []
+    habit_repo.log_actions_bulk([(idle, "postponed", start, None)] * 2, user_id=user_id)
+    assert habit_repo.verify_streaks(user_id) == []
+
+
+def test_weekly_habits_follow_their_schedule():
+    connection = _connection()
+    user_id = UserRepository(connection).create_user("weekly@example.com", "hash")
+    habit_repo = HabitRepository(connection)
+    seed_templates(user_id, "wellbeing", habit_repo)
+    habits = {habit["name"]: habit for habit in habit_repo.list_habits(user_id)}
+    exercise = habits["Ejercicio"]
+    assert (exercise["days"], exercise["days_mask"]) == ("MON,WED,FRI", 0b10101)
+
+    monday = datetime(2024, 3, 4, 8, 0)
+    tuesday = (monday + timedelta(days=1)).date()
+    assert {habit["name"] for habit in habit_repo.list_today_habits(user_id, monday.date())} == set(habits)
+    assert "Ejercicio" not in {habit["name"] for habit in habit_repo.list_today_habits(user_id, tuesday)}
+
+    # Mon, Wed, Fri, the next Mon, then an off-schedule Tuesday, one log at a time.
+    schedule = WeekdaySchedule.parse("weekly", "MON,WED,FRI")
+    logs = []
+    for offset, expected in ((0, 1), (2, 2), (4, 3), (7, 4), (8, 4)):
+        moment = monday + timedelta(days=offset)
+        habit_repo.log_actions_bulk([(exercise["id"], "completed", moment, None)], user_id=user_id)
+        logs.append({"timestamp": moment, "status": "completed"})
+        streak = habit_repo.list_habit_streaks(user_id, today=moment.date())[exercise["id"]]
+        assert streak["current"] == StreakCalculator().calculate(logs, moment.date(), schedule) == expected
+
+    # The run stays current through Thursday and breaks once Wednesday goes unlogged.
+    thursday = (monday + timedelta(days=10)).date()
+    streaks = habit_repo.list_habit_streaks
+    assert streaks(user_id, today=thursday - timedelta(days=2))[exercise["id"]]["current"] == 4
+    assert streaks(user_id, today=thursday)[exercise["id"]]["current"] == 0
+    assert StreakCalculator().calculate(logs, thursday) == 0
+    assert habit_repo.verify_streaks(user_id) == []
+
+
+def test_habit_schedules_only_fall_back_without_days_mask():
+    scheduled = sqlite3.connect(":memory:")
+    scheduled.execute("CREATE TABLE habits (id INTEGER PRIMARY KEY, user_id INTEGER, days_mask INTEGER)")
+    scheduled.executemany("INSERT INTO habits VALUES (?, ?, ?)", [(1, 7, 127), (2, 7, 0b0010101)])
+    assert {key: schedule.mask for key, schedule in habit_schedules(scheduled).items()} == {(7, 2): 0b0010101}
+
+    legacy = sqlite3.connect(":memory:")
+    legacy.execute("CREATE TABLE habits (id INTEGER PRIMARY KEY, user_id INTEGER, name TEXT)")
+    assert habit_schedules(legacy) == {}
+
+    broken = sqlite3.connect(":memory:")
+    broken.execute("CREATE TABLE habits (id INTEGER PRIMARY KEY, days_mask INTEGER)")
+    with pytest.raises(sqlite3.OperationalError):
+        habit_schedules(broken)
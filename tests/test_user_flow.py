@@ -1,4 +1,5 @@
 import sqlite3
+from datetime import datetime
 
 from data.migrate import ensure_schema
 from data.repositories import HabitRepository, SettingsRepository, UserRepository
@@ -52,3 +53,174 @@ def test_settings_theme_persists():
     settings_repo = SettingsRepository(connection)
     settings_repo.set(user_id, "theme", "nord")
     assert settings_repo.get(user_id, "theme") == "nord"
+
+
+def test_writes_do_not_probe_schema():
+    connection = _connection()
+    user_repo = UserRepository(connection)
+    habit_repo = HabitRepository(connection)
+    user_id = user_repo.create_user("schema@example.com", "hash")
+    habit_repo.add_habit(user_id, {"name": "Leer", "frequency": "daily"})
+    habit_id = habit_repo.list_habits(user_id)[0]["id"]
+
+    statements = []
+    connection.set_trace_callback(statements.append)
+    user_repo.create_user("schema2@example.com", "hash")
+    habit_repo.add_habit(user_id, {"name": "Correr", "frequency": "daily"})
+    habit_repo.log_action(habit_id, "completed", user_id=user_id)
+    habit_repo.log_action(habit_id, "skipped", user_id=user_id)
+
+    assert not [statement for statement in statements if "PRAGMA" in statement]
+    assert len(habit_repo.list_all_logs(user_id)) == 2
+
+
+def test_ensure_schema_invalidates_schema_descriptor(tmp_path, monkeypatch):
+    from data import database
+    from data.repositories import schema_for
+
+    monkeypatch.setattr(database, "DB_PATH", tmp_path / "schema.db")
+    connection = database.init_db()
+    descriptor = schema_for(connection)
+    assert schema_for(connection) is descriptor
+
+    ensure_schema(connection)
+    assert schema_for(connection) is descriptor
+
+    connection.execute("PRAGMA user_version = 1")
+    ensure_schema(connection)
+    assert schema_for(connection) is not descriptor
+
+
+def test_bulk_log_ingestion_reports_per_row_outcomes():
+    connection = _connection()
+    user_repo = UserRepository(connection)
+    owner_id = user_repo.create_user("bulk@example.com", "hash")
+    other_id = user_repo.create_user("other@example.com", "hash")
+    habit_repo = HabitRepository(connection)
+    habit_repo.add_habit(owner_id, {"name": "Leer", "frequency": "daily"})
+    habit_repo.add_habit(other_id, {"name": "Correr", "frequency": "daily"})
+    own_habit = habit_repo.list_habits(owner_id)[0]["id"]
+    other_habit = habit_repo.list_habits(other_id)[0]["id"]
+
+    outcomes = habit_repo.log_actions_bulk(
+        [
+            (own_habit, "completed", "2024-01-01T08:00:00", None),
+            (own_habit, "skipped", datetime(2024, 1, 2, 9, 30), "cansado"),
+            (own_habit, "unknown", None, None),
+            (own_habit, "completed", "not-a-date", None),
+            (other_habit, "completed", None, None),
+            (9999, "completed", None, None),
+        ],
+        user_id=owner_id,
+    )
+
+    assert outcomes == ["inserted", "inserted", "invalid", "invalid", "forbidden", "unknown_habit"]
+    logs = habit_repo.list_all_logs(owner_id)
+    assert [log["created_at"] for log in logs] == ["2024-01-02T09:30:00", "2024-01-01T08:00:00"]
+    assert logs[0]["date"] == "2024-01-02"
+
+
+def test_daily_stats_rollup_tracks_log_writes():
+    connection = _connection()
+    user_id = UserRepository(connection).create_user("rollup@example.com", "hash")
+    habit_repo = HabitRepository(connection)
+    habit_repo.add_habit(user_id, {"name": "Leer", "frequency": "daily"})
+    habit_id = habit_repo.list_habits(user_id)[0]["id"]
+
+    habit_repo.log_action(habit_id, "completed", user_id=user_id)
+    habit_repo.log_actions_bulk(
+        [
+            (habit_id, "completed", "2024-01-01T08:00:00", None),
+            (habit_id, "completed", "2024-01-01T18:00:00", None),
+            (habit_id, "postponed", "2024-01-01T19:00:00", None),
+            (habit_id, "skipped", "2024-01-02T08:00:00", None),
+        ],
+        user_id=user_id,
+    )
+
+    stats = habit_repo.list_daily_stats(user_id)
+    assert [(row["completed"], row["skipped"], row["postponed"]) for row in stats] == [
+        (2, 0, 1),
+        (0, 1, 0),
+        (1, 0, 0),
+    ]
+    assert len(habit_repo.list_daily_stats(user_id, since=datetime(2024, 1, 2))) == 2
+
+    connection.execute("DELETE FROM habit_daily_stats")
+    connection.commit()
+    habit_repo.rebuild_daily_stats()
+    assert habit_repo.list_daily_stats(user_id) == stats
+
+    habit_repo.delete_habit(habit_id, user_id=user_id)
+    assert habit_repo.list_daily_stats(user_id) == []
+
+
+def test_settings_cache_loads_each_user_once():
+    from data.repositories import SettingsCache
+
+    connection = _connection()
+    user_repo = UserRepository(connection)
+    first = user_repo.create_user("first@example.com", "hash")
+    second = user_repo.create_user("second@example.com", "hash")
+    cache = SettingsCache(maxsize=1)
+    settings_repo = SettingsRepository(connection, cache=cache)
+    settings_repo.set_many(first, {"theme": "nord", "language": "en"})
+
+    statements = []
+    connection.set_trace_callback(statements.append)
+    for _ in range(3):
+        rerun_repo = SettingsRepository(connection, cache=cache)
+        values = rerun_repo.get_many(first, {"theme": "latte", "language": "es_419", "onboarded": "0"})
+        assert values == {"theme": "nord", "language": "en", "onboarded": "0"}
+    assert len([statement for statement in statements if statement.startswith("SELECT")]) == 1
+
+    settings_repo.set(first, "theme", "latte")
+    assert settings_repo.get(first, "theme") == "latte"
+    assert len([statement for statement in statements if statement.startswith("SELECT")]) == 1
+
+    assert settings_repo.get(second, "theme", "default") == "default"
+    assert cache.get(first) is None
+
+
+def test_habit_list_cache_reuses_snapshot_until_version_changes():
+    connection = _connection()
+    user_id = UserRepository(connection).create_user("versions@example.com", "hash")
+    habit_repo = HabitRepository(connection)
+    habit_repo.seed_template(user_id, "work")
+    version = habit_repo.habits_version(user_id)
+    assert version == 2
+    assert len(habit_repo.list_habits(user_id)) == 2
+
+    statements = []
+    connection.set_trace_callback(statements.append)
+    habits = habit_repo.list_habits(user_id)
+    habits[0]["name"] = "mutated"
+    assert habit_repo.list_habits(user_id)[0]["name"] != "mutated"
+    assert not [statement for statement in statements if "FROM habits" in statement]
+
+    habit_repo.delete_habit(habits[0]["id"], user_id=user_id)
+    assert habit_repo.habits_version(user_id) == version + 1
+    assert len(habit_repo.list_habits(user_id)) == 1
+
+
+def test_rolled_back_onboarding_leaves_no_cached_values():
+    connection = _connection()
+    user_id = UserRepository(connection).create_user("rollback@example.com", "hash")
+    habit_repo = HabitRepository(connection)
+    settings_repo = SettingsRepository(connection)
+    assert settings_repo.get(user_id, "onboarded", "0") == "0"
+
+    try:
+        with settings_repo.transaction(user_id=user_id):
+            with habit_repo.transaction(user_id=user_id):
+                habit_repo.add_habit(user_id, {"name": "Leer", "frequency": "daily"})
+                settings_repo.set(user_id, "onboarded", "1")
+                assert [habit["name"] for habit in habit_repo.list_habits(user_id)] == ["Leer"]
+                raise RuntimeError("commit failed")
+    except RuntimeError:
+        pass
+
+    assert settings_repo.get(user_id, "onboarded", "0") == "0"
+    # The next write reuses the rolled-back version number.
+    habit_repo.add_habit(user_id, {"name": "Correr", "frequency": "daily"})
+    assert [habit["name"] for habit in habit_repo.list_habits(user_id)] == ["Correr"]
@@ -0,0 +1,154 @@
+import shutil
+import sqlite3
+import time
+
+import pytest
+
+from data.database import ConnectionPool
+from data.migrate import ensure_schema
+from data.repositories import HabitRepository, UserRepository
+from data.write_behind import LogWriteQueue
+
+
+def _setup(connection):
+    user_id = UserRepository(connection).create_user("queue@example.com", "hash")
+    habit_repo = HabitRepository(connection)
+    habit_repo.add_habit(user_id, {"name": "Leer", "frequency": "daily"})
+    return user_id, habit_repo.list_habits(user_id)[0]["id"]
+
+
+def test_batched_queue_is_visible_before_flush():
+    connection = sqlite3.connect(":memory:")
+    connection.row_factory = sqlite3.Row
+    ensure_schema(connection)
+    user_id, habit_id = _setup(connection)
+    queue = LogWriteQueue(connection, durability="batched", batch_size=3)
+    habit_repo = HabitRepository(connection, log_queue=queue)
+
+    habit_repo.log_action(habit_id, "completed", user_id=user_id)
+    habit_repo.log_action(habit_id, "skipped", user_id=user_id)
+    assert connection.execute("SELECT COUNT(*) FROM habit_logs").fetchone()[0] == 0
+    assert [log["status"] for log in habit_repo.list_all_logs(user_id)] == ["skipped", "completed"]
+    assert [log["status"] for log in habit_repo.list_log_window(user_id, 1, columns=("status",))] == [
+        "skipped",
+        "completed",
+    ]
+    assert habit_repo.get_streak(user_id)["current"] == 1
+    stats = habit_repo.list_daily_stats(user_id)
+    assert (stats[0]["completed"], stats[0]["skipped"]) == (1, 1)
+    # The overlay was rolled back; nothing reached the rollup tables yet.
+    assert connection.execute("SELECT COUNT(*) FROM habit_daily_stats").fetchone()[0] == 0
+
+    habit_repo.log_action(habit_id, "completed", user_id=user_id)
+    assert queue.pending() == []
+    assert connection.execute("SELECT COUNT(*) FROM habit_logs").fetchone()[0] == 3
+    assert habit_repo.verify_streaks(user_id) == []
+    assert len(habit_repo.list_all_logs(user_id)) == 3
+
+
+def test_reads_merge_queued_rows_without_writing():
+    connection = sqlite3.connect(":memory:")
+    connection.row_factory = sqlite3.Row
+    ensure_schema(connection)
+    user_id, habit_id = _setup(connection)
+    habit_repo = HabitRepository(connection)
+    habit_repo.log_action(habit_id, "completed", user_id=user_id)
+    queue = LogWriteQueue(connection, durability="batched", batch_size=100)
+    queued = HabitRepository(connection, log_queue=queue)
+    for status in ("completed", "skipped", "postponed"):
+        queued.log_action(habit_id, status, user_id=user_id)
+
+    def read_all():
+        return (
+            queued.get_streak(user_id),
+            queued.list_habit_streaks(user_id),
+            queued.has_wildcard(user_id),
+            queued.list_daily_stats(user_id),
+            queued.minute_histogram(user_id, habit_id).buckets,
+        )
+
+    statements = []
+    connection.set_trace_callback(statements.append)
+    before = read_all()
+    connection.set_trace_callback(None)
+    writes = ("INSERT", "UPDATE", "DELETE", "SAVEPOINT", "REPLACE", "BEGIN")
+    assert not [sql for sql in statements if sql.lstrip().upper().startswith(writes)]
+    assert queue.flush() == 3
+    assert read_all() == before
+    assert before[3][0]["completed"] == 2 and before[2] is False
+
+
+def test_journal_replays_unflushed_events_once(tmp_path):
+    pool = ConnectionPool(tmp_path / "queue.db", size=2)
+    journal = tmp_path / "queue.log-journal"
+    try:
+        user_id, habit_id = _setup(pool)
+        queue = LogWriteQueue(pool, durability="journaled", batch_size=100, journal_path=journal)
+        habit_repo = HabitRepository(pool, log_queue=queue)
+        habit_repo.log_action(habit_id, "completed", user_id=user_id)
+        habit_repo.log_action(habit_id, "completed", user_id=user_id)
+        shutil.copy(journal, tmp_path / "crash.log-journal")
+
+        # A fresh queue over the same journal picks up where the "crashed" one stopped.
+        recovered = LogWriteQueue(pool, durability="journaled", journal_path=journal)
+        assert len(recovered.pending(user_id)) == 2
+        assert recovered.flush() == 2
+        assert journal.read_text(encoding="utf-8") == ""
+
+        # Replaying a journal whose rows were already committed writes nothing twice.
+        shutil.copy(tmp_path / "crash.log-journal", journal)
+        assert LogWriteQueue(pool, durability="journaled", journal_path=journal).flush() == 0
+        assert len(HabitRepository(pool).list_all_logs(user_id)) == 2
+    finally:
+        pool.close()
+
+
+def test_flusher_parks_bad_rows_and_keeps_running(tmp_path):
+    pool = ConnectionPool(tmp_path / "park.db", size=3)
+    try:
+        user_id, habit_id = _setup(pool)
+        other_id = UserRepository(pool).create_user("other@example.com", "hash")
+        queue = LogWriteQueue(pool, durability="batched", interval=0.02).start()
+        habit_repo = HabitRepository(pool, log_queue=queue)
+        habit_repo.log_action(habit_id, "completed", user_id=user_id)
+        good = queue.pending()[0]
+        # A row claiming someone else's habit is dropped; one without a valid status is parked.
+        queue.put({**good, "user_id": other_id})
+        queue.put({**good, "status": None})
+        habit_repo.log_action(habit_id, "skipped", user_id=user_id)
+        deadline = time.monotonic() + 5
+        while queue.pending() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert queue.running and queue.pending() == []
+        assert [row["status"] for row in queue.parked] == [None]
+        assert len(HabitRepository(pool).list_all_logs(user_id)) == 2
+        assert HabitRepository(pool).list_all_logs(other_id) == []
+        habit_repo.log_action(habit_id, "completed", user_id=user_id)
+        queue.stop(timeout=5)
+        assert len(HabitRepository(pool).list_all_logs(user_id)) == 3
+    finally:
+        pool.close()
+
+
+def test_background_flush_and_immediate_mode(tmp_path):
+    pool = ConnectionPool(tmp_path / "flush.db", size=3)
+    try:
+        user_id, habit_id = _setup(pool)
+        queue = LogWriteQueue(pool, durability="batched", interval=0.02).start()
+        habit_repo = HabitRepository(pool, log_queue=queue)
+        habit_repo.log_action(habit_id, "completed", user_id=user_id)
+        deadline = time.monotonic() + 5
+        while queue.pending() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        queue.stop(timeout=5)
+        assert queue.pending() == [] and queue.last_error is None
+        assert len(HabitRepository(pool).list_all_logs(user_id)) == 1
+
+        immediate = HabitRepository(pool, log_queue=LogWriteQueue(pool, durability="immediate"))
+        immediate.log_action(habit_id, "skipped", user_id=user_id)
+        assert len(HabitRepository(pool).list_all_logs(user_id)) == 2
+    finally:
+        pool.close()
+
+    with pytest.raises(ValueError):
+        LogWriteQueue(durability="eventually")